@@ -2,11 +2,21 @@ from nltk.corpus import stopwords
 from nltk.stem.porter import *
 import numpy as np
 from inverted_index_gcp import *
+from setops import doc_set, union_counts
+from metrics import span, count, bytes_read, postings_decoded
 import math
 import builtins
+import heapq
+import json
+import os
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 
 corpus_size = 6348910
 TUPLE_SIZE = 6
+# the number of posting list reads a process issues at once
+FETCH_WORKERS = int(os.environ.get('IR_FETCH_WORKERS', 16))
 RE_WORD = re.compile(r"""[\#\@\w](['\-]?\w){2,24}""", re.UNICODE)
 
 # collecting all stopwords
@@ -27,95 +37,290 @@ def tokenize(text):
     return tokens_filtered
 
 
-def get_pl(inverted, term, index_dir, th=500):
+def is_impact_ordered(inverted):
     """
-    Get posting list of a term.
+    Whether the index's posting lists start with their highest-impact postings,
+    so that their first `th` postings are a top-impact slice. Indexes without a
+    recorded order (None) were written by decreasing tf (reduce_word_counts).
     """
-    with closing(MultiFileReader()) as reader:
-        # setting the threshold
-        th = min(inverted.df[term], th)
-        locs = inverted.posting_locs[term]
-        # reading the posting list
-        b = reader.read(locs, th * TUPLE_SIZE, index_dir)
-        posting_list = []
-        # decoding the posting list
-        for i in range(th):
-            doc_id = int.from_bytes(b[i * TUPLE_SIZE:i * TUPLE_SIZE + 4], 'big')
-            tf = int.from_bytes(b[i * TUPLE_SIZE + 4:(i + 1) * TUPLE_SIZE], 'big')
-            posting_list.append((doc_id, tf))
-        return posting_list
+    order = getattr(inverted, 'posting_order', None)
+    return order is None or order in IMPACT_ORDERS
 
 
-def get_cands(query, index, index_dir, th=400):
+def term_df(inverted, term):
     """
-    Get candidate documents for a query.
+    The df of a term the scores use: over the whole corpus when the index is
+    one shard of a document-partitioned index (see `set_global_stats`).
     """
-    cands = set()
-    term_pls = {}
-    # get posting lists for each term
-    for term in set(query):
-        if term in index.df.keys():
-            pl = get_pl(index, term, index_dir, th)
-            term_pls[term] = dict(pl)
-            cands.update([doc for doc, _ in term_pls[term].items()])
-    return cands, term_pls
+    if inverted.global_df is not None:
+        return inverted.global_df[term]
+    return inverted.df[term]
+
+
+def get_pl(inverted, term, index_dir, th=500, reader=None, cache=None):
+    """
+    Get posting list of a term as two parallel arrays (doc_ids, tfs).
+    Only the first `th` postings are read when the index is impact-ordered
+    (see `is_impact_ordered`), those being the `th` highest-impact ones;
+    otherwise a prefix is an arbitrary slice and the whole list is read.
+    Decoded lists are kept in `cache` (a `PostingListCache`) when given.
+    """
+    # setting the threshold
+    th = min(inverted.df[term], th) if is_impact_ordered(inverted) else inverted.df[term]
+    key = (index_dir, term, th)
+    if cache is not None:
+        pl = cache.get(key)
+        if pl is not None:
+            return pl
+    # the reader and its storage are shared, nothing is opened per read
+    reader = MultiFileReader() if reader is None else reader
+    locs = inverted.posting_locs[term]
+    # reading the posting list
+    b = reader.read(locs, inverted.read_size(term, th), index_dir)
+    # decoding the posting list
+    pl = decode_postings(b, th, inverted.posting_format)
+    count(bytes_read, len(b), index=index_dir)
+    count(postings_decoded, th, index=index_dir)
+    if cache is not None:
+        cache.put(key, pl)
+    return pl
+
+
+_fetch_pool = None
+
+
+def fetch_postings(jobs, reader=None, cache=None):
+    """
+    Fetch the posting lists of several (index, index_dir, query, th) jobs at
+    once: every (index, term) read of every job is issued concurrently on a
+    shared pool of FETCH_WORKERS threads and gathered before returning, so
+    the latency follows the slowest read rather than the sum of them.
+    Returns one {term: (doc_ids, tfs)} dict per job, in order.
+    """
+    with span('fetch'):
+        return _fetch_postings(jobs, reader, cache)
+
+
+def _fetch_postings(jobs, reader, cache):
+    global _fetch_pool
+    reads = {}
+    for index, index_dir, query, th in jobs:
+        for term in set(query):
+            if term in index.df:
+                reads[(index_dir, term, th)] = index
+    if len(reads) > 1:
+        if _fetch_pool is None:
+            _fetch_pool = ThreadPoolExecutor(FETCH_WORKERS, thread_name_prefix='fetch')
+        # the reads run in the context of the request (see metrics.py)
+        futures = {key: _fetch_pool.submit(contextvars.copy_context().run,
+                                           get_pl, index, key[1], key[0], key[2], reader, cache)
+                   for key, index in reads.items()}
+        pls = {key: future.result() for key, future in futures.items()}
+    else:
+        pls = {key: get_pl(index, key[1], key[0], key[2], reader, cache) for key, index in reads.items()}
+    return [{term: pls[(index_dir, term, th)] for term in set(query) if term in index.df}
+            for index, index_dir, query, th in jobs]
+
+
+def get_postings(query, index, index_dir, th=400, reader=None, cache=None):
+    """
+    Get the (doc_ids, tfs) posting arrays of every query term in the index.
+    """
+    return fetch_postings([(index, index_dir, query, th)], reader, cache)[0]
+
+
+def term_matches(query, postings):
+    """
+    Get the documents of the query terms' posting lists (sorted) and the
+    number of distinct query terms each one matches.
+    """
+    return union_counts([doc_set(postings[term][0]) for term in set(query) if term in postings])
+
+
+def top_k(doc_ids, scores, k):
+    """
+    Get the positions of the k best scores, best first, ties broken by the
+    smaller doc id. The k are selected with np.partition in linear time and
+    only they are sorted.
+    """
+    doc_ids = np.asarray(doc_ids)
+    scores = np.asarray(scores, dtype=np.float64)
+    n = len(scores)
+    if k <= 0 or n == 0:
+        return np.zeros(0, dtype=np.intp)
+    if k < n:
+        kth = np.partition(scores, n - k)[n - k]
+        above = np.flatnonzero(scores > kth)
+        tied = np.flatnonzero(scores == kth)
+        need = k - len(above)
+        if need < len(tied):
+            tied = tied[np.argpartition(doc_ids[tied], need - 1)[:need]]
+        selected = np.concatenate([above, tied])
+    else:
+        selected = np.arange(n)
+    return selected[np.lexsort((doc_ids[selected], -scores[selected]))]
+
+
+def top_scores(doc_ids, scores, N=5000):
+    """
+    Get the top N of aligned doc_id / score arrays as a {doc_id: score} dict
+    in rank order, see `top_k`.
+    """
+    top = top_k(doc_ids, scores, N)
+    return dict(zip(np.asarray(doc_ids)[top].tolist(), np.asarray(scores)[top].tolist()))
 
 
 def get_top_n(sim_dict, N=5000):
     """
-    Get top N documents from a similarity dictionary.
+    Get top N documents from a similarity dictionary, see `top_k`.
+    """
+    doc_ids, scores = list(sim_dict.keys()), list(sim_dict.values())
+    top = top_k(np.array(doc_ids, dtype=np.int64), np.array(scores, dtype=np.float64), N)
+    return {doc_ids[i]: scores[i] for i in top.tolist()}
+
+
+class CandidateSet:
+    """
+    The documents of the query terms' posting lists as dense rows, so scores
+    can be accumulated term-at-a-time into NumPy arrays.
     """
-    return dict(sorted(sim_dict.items(), key=lambda k: k[1], reverse=True)[:N])
+
+    def __init__(self, postings):
+        """
+        `postings` maps each term to its (doc_ids, tfs) arrays, see `get_postings`.
+        """
+        terms = list(postings)
+        ids = [postings[term][0] for term in terms]
+        if len(terms) == 0:
+            self.doc_ids, inverse = np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.intp)
+        else:
+            self.doc_ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        # the candidate row of every posting, per term
+        self.rows = dict(zip(terms, np.split(inverse, np.cumsum([len(i) for i in ids])[:-1])))
+        self.tfs = {term: postings[term][1].astype(np.float64) for term in terms}
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def accumulate(self, term_weights):
+        """
+        Sum per-posting weights (term -> array aligned with its postings) into
+        one score per candidate.
+        """
+        if len(term_weights) == 0:
+            return np.zeros(len(self))
+        rows = np.concatenate([self.rows[term] for term in term_weights])
+        weights = np.concatenate(list(term_weights.values()))
+        return np.bincount(rows, weights=weights, minlength=len(self))
+
+    def gather(self, mapping, default=0):
+        """
+        Look up every candidate in a doc_id -> value mapping (a dict or a
+        `DocColumn`).
+        """
+        if hasattr(mapping, 'gather'):
+            return mapping.gather(self.doc_ids, default)
+        return np.fromiter((mapping.get(doc_id, default) for doc_id in self.doc_ids.tolist()),
+                           dtype=np.float64, count=len(self))
+
+    def to_dict(self, scores):
+        return dict(zip(self.doc_ids.tolist(), scores.tolist()))
+
+    def top(self, scores, N=5000):
+        """
+        Get the top N candidates by `scores` as a {doc_id: score} dict, see `top_k`.
+        """
+        return top_scores(self.doc_ids, scores, N)
 
 
-def tf_idf(doc_id, query, inverted, word_dict):
+def tf_idf(query, cands, inverted, stats=None):
     """
-    Calculate tf-idf score for a document.
+    Calculate the tf-idf cosine similarity of every candidate to the query.
+    As before, the query norm of a document only counts the query terms it
+    contains. The doc lengths and norms are read from `stats` (a `DocStats`)
+    when given, otherwise from the index.
     """
-    score = 0
     token_count = Counter(query)
-    query_vec = []
-    if doc_id not in inverted.dl: return 0
-    # calculate tf-idf score
-    for token in token_count:
-        if token in inverted.df and doc_id in word_dict[token]:
-            # tf
-            doc_tf = word_dict[token][doc_id] / inverted.dl[doc_id]
-            doc_idf = math.log10(corpus_size / inverted.df[token])
-            query_tf = token_count[token] / len(query)
-            query_idf = doc_idf
-            score += doc_tf * doc_idf * query_tf * query_idf
-            query_vec.append((query_tf * query_idf) ** 2)
-    # calculate cosine similarity
-    query_norm = math.sqrt(sum(query_vec))
-    docs_norm = inverted.d_norms[doc_id]
-    return score / (query_norm * docs_norm)
-
-
-def combine_scores(rel_docs, title_matches, bm_score, cosim_score, pr_score, pv_score):
-    """
-    Combine scores from different models.
-    """
-    # calculate the final score
-    did_score = {rel_doc: np.array([0] * 5, dtype=float) for rel_doc in rel_docs}
-    measures = [title_matches, bm_score, cosim_score, pr_score, pv_score]
-    # combine scores
-    for doc_id in rel_docs:
-        for i, measure in enumerate(measures):
-            if len(measure) != 0 and max(measure.values()) != 0:
-                did_score[doc_id][i] = measure.get(doc_id, 0) / max(measure.values()) - min(measure.values())
-    return did_score
-
-
-def get_matches(query, term_pls, doc_id):
-    """
-    Get number of matched terms in a document.
-    """
-    for term in query:
-        if term not in term_pls.keys() or \
-                doc_id not in term_pls[term].keys():
-            return 0
-    return 1
+    dot, query_sq = {}, {}
+    for token, rows in cands.rows.items():
+        idf = math.log10(corpus_size / term_df(inverted, token))
+        query_w = token_count[token] / len(query) * idf
+        dot[token] = cands.tfs[token] * (idf * query_w)
+        query_sq[token] = np.full(len(rows), query_w ** 2)
+    doc_len = cands.gather(inverted.dl if stats is None else stats.dl)
+    docs_norm = cands.gather(inverted.d_norms if stats is None else stats.norm)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = cands.accumulate(dot) / doc_len / (np.sqrt(cands.accumulate(query_sq)) * docs_norm)
+    scores[~np.isfinite(scores)] = 0
+    return scores
+
+
+# The signals of the fusion matrix, in column order.
+FUSION_SIGNALS = ('title', 'bm25', 'cosine', 'pagerank', 'pageviews')
+# Weight profiles over FUSION_SIGNALS; a query takes the first profile whose
+# max_terms (None for any length) covers its number of tokens.
+FUSION_PROFILES = [
+    {'name': 'short', 'max_terms': 2, 'weights': [3, 3, 2, 3, 2]},
+    {'name': 'long', 'max_terms': None, 'weights': [1, 4, 3, 3, 2]},
+]
+
+
+def fusion_profiles_from_env():
+    """
+    The fusion profiles set by IR_FUSION_PROFILES (a JSON list shaped like
+    FUSION_PROFILES), or FUSION_PROFILES when it is not set.
+    """
+    if 'IR_FUSION_PROFILES' in os.environ:
+        return json.loads(os.environ['IR_FUSION_PROFILES'])
+    return FUSION_PROFILES
+
+
+def select_fusion_profile(query, profiles=FUSION_PROFILES):
+    """
+    Get the fusion profile of a tokenized query.
+    """
+    for profile in profiles:
+        if profile['max_terms'] is None or len(query) <= profile['max_terms']:
+            return profile
+    raise ValueError(f'no fusion profile covers a {len(query)} terms query')
+
+
+def fusion_matrix(doc_ids, signals):
+    """
+    Build the candidates x signals matrix of normalized scores. Every signal
+    (a doc_id -> score dict) is gathered for `doc_ids`, 0 when missing, and
+    normalized once as score / max - min; an empty signal or one whose max is
+    0 gives a column of zeros.
+    """
+    matrix = np.zeros((len(doc_ids), len(signals)))
+    for j, signal in enumerate(signals):
+        if len(signal) == 0:
+            continue
+        values = np.fromiter(signal.values(), dtype=np.float64, count=len(signal))
+        top, bottom = values.max(), values.min()
+        if top == 0:
+            continue
+        column = np.fromiter((signal.get(doc_id, 0) for doc_id in doc_ids), dtype=np.float64, count=len(doc_ids))
+        matrix[:, j] = column / top - bottom
+    return matrix
+
+
+def fuse_scores(doc_ids, signals, weights):
+    """
+    Combine the signals of every candidate into one score with a single
+    matrix-vector product.
+    """
+    return fusion_matrix(doc_ids, signals) @ np.asarray(weights, dtype=np.float64)
+
+
+def fused_top(query, doc_ids, signals, k, profiles=FUSION_PROFILES):
+    """
+    Get the k best of `doc_ids` (an int64 array) by the fused score of their
+    signals, with the weights of the query's fusion profile.
+    """
+    profile = select_fusion_profile(query, profiles)
+    fused = fuse_scores(doc_ids.tolist(), signals, profile['weights'])
+    return doc_ids[top_k(doc_ids, fused, k)]
 
 
 class BM25_from_index:
@@ -123,12 +328,27 @@ class BM25_from_index:
     Calculate BM25 score for a document.
     """
 
-    def __init__(self, index, k1=1.5, b=0.75):
+    def __init__(self, index, k1=1.5, b=0.75, stats=None):
         self.b = b
         self.k1 = k1
         self.index = index
-        self.N = len(index.dl)
-        self.AVGDL = builtins.sum(index.dl.values()) / self.N
+        if stats is None and hasattr(index, 'avgdl'):
+            # a MappedIndex, which keeps them in its header
+            self.dl = index.dl
+            self.N = index.n_docs
+            self.AVGDL = index.avgdl
+        elif stats is None:
+            self.dl = index.dl
+            self.N = len(index.dl)
+            self.AVGDL = builtins.sum(index.dl.values()) / self.N
+        else:
+            self.dl = stats.dl
+            self.N = stats.n_docs
+            self.AVGDL = stats.avgdl
+        if index.global_n_docs is not None:
+            # one shard of the corpus, scored with the corpus-wide N and AVGDL
+            self.N = index.global_n_docs
+            self.AVGDL = index.global_avgdl
 
     def calc_idf(self, list_of_tokens):
         """
@@ -138,33 +358,155 @@ class BM25_from_index:
         # calculate idf for each term
         for term in list_of_tokens:
             if term in self.index.df:
-                term_df = self.index.df[term]
-                idf[term] = math.log(1 + (self.N - term_df + 0.5) / (term_df + 0.5))
+                n = term_df(self.index, term)
+                idf[term] = math.log(1 + (self.N - n + 0.5) / (n + 0.5))
         return idf
 
-    def search(self, query, relevant_docs, word_dict, N=5000):
+    def search(self, query, cands, N=5000):
         """
-        Search for a query.
+        Search for a query: the top N candidates (a `CandidateSet`) by BM25.
         """
-        self.idf = self.calc_idf(set([t for t in query]))
-        # calculate BM25 score for each document
-        return get_top_n(
-            dict([(relevant_doc, self._score(query, relevant_doc, word_dict)) for relevant_doc in relevant_docs]), N)
+        return cands.top(self.score(query, cands), N)
 
-    def _score(self, query, doc_id, word_dict):
+    def score(self, query, cands):
         """
-        Calculate BM25 score for a document.
+        Calculate the BM25 score of every candidate, term-at-a-time.
         """
-        score = 0.0
-        if doc_id == 0.0:
+        idf = self.calc_idf(set(query))
+        query_counts = Counter(query)
+        doc_len = cands.gather(self.dl, self.AVGDL)
+        norm = self.k1 * (1 - self.b + self.b * doc_len / self.AVGDL)
+        weights = {}
+        for term, rows in cands.rows.items():
+            if term in idf:
+                freq = cands.tfs[term]
+                weights[term] = idf[term] * query_counts[term] * freq * (self.k1 + 1) / (freq + norm[rows])
+        scores = cands.accumulate(weights)
+        scores[cands.doc_ids == 0] = 0
+        return scores
+
+    def search_top_k(self, query, postings, k=100):
+        """
+        Exact BM25 top-k over full posting lists with Block-Max WAND pruning.
+        `postings` maps each query term to its complete (doc_ids, tfs) arrays
+        (e.g. `get_postings(..., th=corpus_size)`). The block maxima stored in
+        the index are used when they were built with this k1 and b, otherwise
+        they are computed here from the postings.
+        """
+        idf = self.calc_idf(set(query))
+        query_counts = Counter(query)
+        params = (self.k1, self.b, SCORE_BLOCK_SIZE)
+        stored = self.index.bm25_block_max if self.index.bm25_bounds_params == params else {}
+        cursors = []
+        for term, (doc_ids, tfs) in postings.items():
+            if len(doc_ids) == 0 or term not in idf:
+                continue
+            perm = np.argsort(doc_ids, kind='stable')
+            doc_ids, tfs = doc_ids[perm], tfs[perm]
+            block_max = stored.get(term)
+            if block_max is None:
+                block_max = bm25_block_maxima(doc_ids, tfs, self.dl, self.AVGDL, self.k1, self.b)
+            weight = idf[term] * query_counts[term]
+            cursors.append(_TermCursor(doc_ids.tolist(), tfs.tolist(), (block_max * weight).tolist(), weight))
+        return block_max_wand(cursors, k, self._doc_score)
+
+    def _doc_score(self, doc_id, tf_weights):
+        """
+        BM25 score of a document from its (tf, term weight) pairs.
+        """
+        if doc_id == 0:
             return 0
-        doc_len = self.index.dl[doc_id]
-        for term in query:
-            if term in self.index.df:
-                term_frequencies = word_dict[term]
-                if doc_id in term_frequencies:
-                    freq = term_frequencies[doc_id]
-                    numerator = self.idf[term] * freq * (self.k1 + 1)
-                    denominator = freq + self.k1 * (1 - self.b + self.b * doc_len / self.AVGDL)
-                    score += (numerator / denominator)
-        return score
+        doc_len = self.dl.get(doc_id, self.AVGDL)
+        norm = self.k1 * (1 - self.b + self.b * doc_len / self.AVGDL)
+        return builtins.sum(weight * tf * (self.k1 + 1) / (tf + norm) for tf, weight in tf_weights)
+
+
+class _TermCursor:
+    """
+    A position in one doc_id-sorted posting list, used by `block_max_wand`.
+    """
+
+    def __init__(self, doc_ids, tfs, block_max, weight):
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.block_max = block_max
+        self.max_score = max(block_max)
+        self.weight = weight
+        self.pos = 0
+
+    @property
+    def doc(self):
+        return self.doc_ids[self.pos]
+
+    def exhausted(self):
+        return self.pos >= len(self.doc_ids)
+
+    def advance_to(self, doc_id):
+        self.pos = bisect_left(self.doc_ids, doc_id, self.pos)
+
+    def block_bound(self, doc_id):
+        """
+        (score bound, last doc_id) of the block that would hold `doc_id`.
+        """
+        pos = bisect_left(self.doc_ids, doc_id, self.pos)
+        if pos >= len(self.doc_ids):
+            return 0.0, math.inf
+        block = pos // SCORE_BLOCK_SIZE
+        last = min((block + 1) * SCORE_BLOCK_SIZE, len(self.doc_ids)) - 1
+        return self.block_max[block], self.doc_ids[last]
+
+
+def block_max_wand(cursors, k, doc_score):
+    """
+    Document-at-a-time top-k with Block-Max WAND pruning (Ding & Suel, 2011).
+    A document is only scored when the per-term and then the per-block upper
+    bounds of the lists that may hold it exceed the current k-th best score.
+    `doc_score(doc_id, [(tf, weight), ...])` gives its exact score.
+    Returns a {doc_id: score} dict in descending score order.
+    """
+    heap = []
+    theta = 0.0
+    cursors = [c for c in cursors if not c.exhausted()]
+    while cursors:
+        cursors.sort(key=lambda c: c.doc)
+        # pivot: the first list where the summed term bounds exceed theta
+        acc, pivot = 0.0, None
+        for i, c in enumerate(cursors):
+            acc += c.max_score
+            if acc > theta:
+                pivot = i
+                break
+        if pivot is None:
+            break
+        pivot_doc = cursors[pivot].doc
+        while pivot + 1 < len(cursors) and cursors[pivot + 1].doc == pivot_doc:
+            pivot += 1
+        bounds = [c.block_bound(pivot_doc) for c in cursors[:pivot + 1]]
+        if builtins.sum(bound for bound, _ in bounds) > theta:
+            if cursors[0].doc == pivot_doc:
+                matched = cursors[:pivot + 1]
+                score = doc_score(pivot_doc, [(c.tfs[c.pos], c.weight) for c in matched])
+                if len(heap) < k:
+                    heapq.heappush(heap, (score, -pivot_doc))
+                elif score > heap[0][0]:
+                    heapq.heapreplace(heap, (score, -pivot_doc))
+                if len(heap) == k:
+                    theta = heap[0][0]
+                for c in matched:
+                    c.pos += 1
+            else:
+                # move the lists before the pivot up to it
+                for c in cursors[:pivot]:
+                    if c.doc < pivot_doc:
+                        c.advance_to(pivot_doc)
+        else:
+            # no document up to the end of the shallowest block can make it
+            next_doc = builtins.min(last for _, last in bounds) + 1
+            if pivot + 1 < len(cursors):
+                next_doc = builtins.min(next_doc, cursors[pivot + 1].doc)
+            next_doc = builtins.max(next_doc, pivot_doc + 1)
+            for c in cursors[:pivot + 1]:
+                c.advance_to(next_doc)
+        cursors = [c for c in cursors if not c.exhausted()]
+    top = sorted(heap, reverse=True)
+    return {-neg_doc: score for score, neg_doc in top}
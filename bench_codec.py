@@ -0,0 +1,79 @@
+""" Size and decode-throughput comparison of the posting list formats.
+
+    python bench_codec.py [--df 1000 100000 1000000] [--repeat 5]
+
+For every list size it draws `df` distinct doc ids out of the corpus and
+Zipf-like tf values, and reports the encoded size and the decode throughput
+of FORMAT_RAW (with the old per-tuple int.from_bytes loop and with the NumPy
+decoder) and of FORMAT_VBYTE in doc_id order and in tf (impact) order.
+"""
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+from inverted_index_gcp import (TUPLE_SIZE, FORMAT_RAW, FORMAT_VBYTE, ORDER_TF,
+                                encode_postings, decode_postings, sort_posting_list)
+
+corpus_size = 6348910
+max_doc_id = 70000000
+
+
+def synthetic_posting_list(df, rng):
+    doc_ids = np.sort(rng.choice(max_doc_id, size=df, replace=False)).astype(np.uint32)
+    tfs = np.minimum(rng.zipf(2.0, size=df), 2 ** 16 - 1).astype(np.uint16)
+    return doc_ids, tfs
+
+
+def loop_decode(b, n):
+    """ The decoder get_pl used before the NumPy one, as the baseline. """
+    posting_list = []
+    for i in range(n):
+        doc_id = int.from_bytes(b[i * TUPLE_SIZE:i * TUPLE_SIZE + 4], 'big')
+        tf = int.from_bytes(b[i * TUPLE_SIZE + 4:(i + 1) * TUPLE_SIZE], 'big')
+        posting_list.append((doc_id, tf))
+    return posting_list
+
+
+def best_time(f, repeat):
+    times = []
+    for _ in range(repeat):
+        t_start = perf_counter()
+        f()
+        times.append(perf_counter() - t_start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--df', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    print(f"{'df':>9} {'codec':<18} {'bytes':>11} {'B/posting':>9} {'Mpostings/s':>11}")
+    for df in args.df:
+        doc_ids, tfs = synthetic_posting_list(df, rng)
+        tf_ids, tf_tfs = sort_posting_list(doc_ids, tfs, ORDER_TF)
+        cases = [
+            ('raw, loop', encode_postings(doc_ids, tfs, FORMAT_RAW), lambda b: loop_decode(b, df)),
+            ('raw, numpy', encode_postings(doc_ids, tfs, FORMAT_RAW),
+             lambda b: decode_postings(b, df, FORMAT_RAW)),
+            ('vbyte, doc order', encode_postings(doc_ids, tfs, FORMAT_VBYTE),
+             lambda b: decode_postings(b, df, FORMAT_VBYTE)),
+            ('vbyte, tf order', encode_postings(tf_ids, tf_tfs, FORMAT_VBYTE),
+             lambda b: decode_postings(b, df, FORMAT_VBYTE)),
+        ]
+        for name, b, decode in cases:
+            if name != 'raw, loop':
+                got_ids, got_tfs = decode(b)
+                expected = (doc_ids, tfs) if name != 'vbyte, tf order' else (tf_ids, tf_tfs)
+                assert np.array_equal(got_ids, expected[0]) and np.array_equal(got_tfs, expected[1])
+            repeat = 1 if name == 'raw, loop' and df > 100000 else args.repeat
+            t = best_time(lambda: decode(b), repeat)
+            print(f"{df:>9} {name:<18} {len(b):>11} {len(b) / df:>9.2f} {df / t / 1e6:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
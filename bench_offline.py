@@ -0,0 +1,348 @@
+""" Offline end-to-end benchmark of the search endpoints, no network needed.
+
+    python bench_offline.py [--docs 20000] [--queries 200] [--endpoints search search_body]
+                            [--fmt 1 --order bm25 --bm25-bounds] [--json run.json]
+
+It generates a synthetic Wikipedia-like corpus (Zipf-distributed vocabulary,
+topical bodies and titles, anchor texts taken from the titles of the linked
+pages, in-link based PageRank and page views), builds the title, body and
+anchor indexes with `InvertedIndex` the way indexes_creator.ipynb does into
+`--corpus-dir`, and serves them through search_frontend with
+IR_STORAGE=local. The generated queries are replayed through the real
+endpoint handlers (Flask's test client) and every endpoint gets its
+p50/p95/p99 latency, throughput and MAP@40 against the topical ground truth.
+The corpus is reused as long as its parameters do not change; --json writes
+the results (with the git commit) for comparing runs.
+
+The result cache is disabled unless --result-cache is given, so repeated
+queries measure the pipeline rather than the cache.
+"""
+import argparse
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import zlib
+from collections import Counter, defaultdict
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+
+from inverted_index_gcp import (InvertedIndex, FORMAT_RAW, ORDER_BM25, ORDER_PRIOR,
+                                shard_of, shard_dirs, set_global_stats)
+
+SYLLABLES = [c + v for c in 'bcdfghklmnprstvz' for v in 'aeiou']
+# the same bucketing of the terms as the notebook's partition_postings_and_write
+BUCKET_NUM = 8
+ENDPOINTS = ('search', 'search_body', 'search_title', 'search_anchor')
+
+
+def average_precision(true_list, predicted_list, k=40):
+    """ AP@k of a ranked list, as computed by metrices_and_graphs.ipynb. """
+    true_set = frozenset(true_list)
+    predicted_list = predicted_list[:k]
+    precisions = []
+    for i, doc_id in enumerate(predicted_list):
+        if doc_id in true_set:
+            prec = (len(precisions) + 1) / (i + 1)
+            precisions.append(prec)
+    if len(precisions) == 0:
+        return 0.0
+    return round(sum(precisions) / len(precisions), 3)
+
+
+def make_vocabulary(n_words, rng):
+    """ `n_words` distinct made-up words of 2-4 syllables, none a stopword. """
+    from backend import all_stopwords
+    words = set()
+    while len(words) < n_words:
+        n = rng.integers(2, 5)
+        word = ''.join(SYLLABLES[i] for i in rng.integers(0, len(SYLLABLES), n))
+        if word not in all_stopwords:
+            words.add(word)
+    return sorted(words, key=lambda w: zlib.crc32(w.encode()))
+
+
+def zipf_probs(n, s):
+    p = 1.0 / np.arange(1, n + 1) ** s
+    return p / p.sum()
+
+
+def generate_corpus(n_docs, n_words, n_queries, seed=0, zipf=1.07, docs_per_topic=100):
+    """ A synthetic corpus and query set:
+        docs    - {doc_id: (title, body)} texts
+        anchors - [(target doc_id, anchor text)] of every link
+        queries - {query: [relevant doc_ids]}, the docs of the query's topic
+                  holding all its words in their title or body
+    Every document is about one topic: its body mixes the Zipf background
+    vocabulary with its topic's words and its title is drawn from the
+    topic's most frequent words.
+    """
+    rng = np.random.default_rng(seed)
+    vocab = np.array(make_vocabulary(n_words, rng))
+    background = zipf_probs(n_words, zipf)
+    n_topics = max(1, n_docs // docs_per_topic)
+    # topic words come from the middle of the frequency range, like entity names
+    topic_words = [rng.choice(np.arange(min(100, n_words // 10), n_words), size=30, replace=False)
+                   for _ in range(n_topics)]
+    topic_probs = zipf_probs(30, 1.0)
+
+    doc_ids = np.sort(rng.choice(70_000_000, size=n_docs, replace=False) + 1)
+    topics = rng.integers(0, n_topics, size=n_docs)
+    docs = {}
+    for doc_id, topic in zip(doc_ids.tolist(), topics.tolist()):
+        n_body = int(np.clip(rng.lognormal(5.5, 0.8), 20, 5000))
+        n_topical = rng.binomial(n_body, 0.25)
+        body = np.concatenate([vocab[rng.choice(n_words, size=n_body - n_topical, p=background)],
+                               vocab[topic_words[topic][rng.choice(30, size=n_topical, p=topic_probs)]]])
+        rng.shuffle(body)
+        title = vocab[topic_words[topic][rng.choice(10, size=rng.integers(1, 5))]]
+        docs[doc_id] = (' '.join(title).title(), ' '.join(body))
+
+    # links prefer popular pages; the anchor text is (part of) the target's title
+    popularity = rng.pareto(1.5, size=n_docs) + 1
+    popularity /= popularity.sum()
+    targets = rng.choice(n_docs, size=n_docs * 10, p=popularity)
+    anchors = []
+    for t in targets.tolist():
+        words = docs[doc_ids[t]][0].split()
+        anchors.append((int(doc_ids[t]), ' '.join(words[:rng.integers(1, len(words) + 1)])))
+
+    queries = {}
+    by_topic = defaultdict(list)
+    for doc_id, topic in zip(doc_ids.tolist(), topics.tolist()):
+        by_topic[topic].append(doc_id)
+    while len(queries) < n_queries:
+        topic = int(rng.integers(0, n_topics))
+        words = vocab[topic_words[topic][rng.choice(30, size=rng.integers(1, 4), replace=False, p=topic_probs)]]
+        words = set(words.tolist())
+        relevant = [d for d in by_topic[topic]
+                    if words <= set(docs[d][0].lower().split()) | set(docs[d][1].split())]
+        if relevant:
+            queries[' '.join(sorted(words))] = relevant
+    return docs, anchors, queries
+
+
+def build_index(name, doc_texts, out_dirs, corpus_size, fmt=FORMAT_RAW, order=None, bm25_bounds=False,
+                prior=None, k1=1.5, b=0.75):
+    """ Write the `name` index of the {doc_id: text} `doc_texts` into every
+        directory of `out_dirs` (`name`/ posting files, index_`name`.pkl and
+        its mapped directory), with the same statistics create_index computes.
+        With several directories the documents are partitioned between them
+        by `shard_of` and every shard carries the corpus-wide statistics (see
+        `set_global_stats`), which its norms, BM25 order and bounds use.
+    """
+    from backend import tokenize
+    tokens = {doc_id: tokenize(text) for doc_id, text in doc_texts.items()}
+    n_shards = len(out_dirs)
+    shard_tokens = [{doc_id: t for doc_id, t in tokens.items() if shard_of(doc_id, n_shards) == i}
+                    for i in range(n_shards)]
+    shards = [InvertedIndex(part) for part in shard_tokens]
+    for ii, part in zip(shards, shard_tokens):
+        ii.dl = {doc_id: len(t) for doc_id, t in part.items()}
+    if n_shards > 1:
+        set_global_stats(shards)
+    for ii, part, out in zip(shards, shard_tokens, out_dirs):
+        write_shard(ii, name, part, out, corpus_size, fmt, order, bm25_bounds, prior, k1, b)
+
+
+def write_shard(ii, name, tokens, out, corpus_size, fmt, order, bm25_bounds, prior, k1, b):
+    posting_dir = Path(out) / name
+    posting_dir.mkdir(parents=True, exist_ok=True)
+    dl = ii.dl
+    df = ii.df if ii.global_df is None else ii.global_df
+    if ii.global_avgdl is not None:
+        avgdl = ii.global_avgdl
+    else:
+        avgdl = sum(dl.values()) / len(dl) if dl else 0.0
+    impact_kwargs = {'dl': dl, 'avgdl': avgdl} if order == ORDER_BM25 else {'prior': prior} if order == ORDER_PRIOR else {}
+    bounds = {'dl': dl, 'avgdl': avgdl, 'k1': k1, 'b': b} if bm25_bounds else None
+    buckets = defaultdict(list)
+    for w, pl in ii._posting_list.items():
+        # reduce_word_counts: the postings by decreasing tf
+        buckets[zlib.crc32(w.encode()) % BUCKET_NUM].append((w, sorted(pl, key=lambda x: x[1], reverse=True)))
+    for bucket_id, list_w_pl in buckets.items():
+        InvertedIndex.write_a_posting_list((bucket_id, list_w_pl), None, posting_dir, order=order, fmt=fmt,
+                                           bm25_bounds=bounds, **impact_kwargs)
+
+    def merged(kind):
+        meta = {}
+        for path in sorted(posting_dir.glob(f'*_{kind}.pickle')):
+            with open(path, 'rb') as f:
+                meta.update(pickle.load(f))
+            path.unlink()
+        return meta
+
+    ii.posting_locs = merged('posting_locs')
+    ii.posting_order = order
+    ii.posting_format = fmt
+    if fmt != FORMAT_RAW:
+        ii.posting_bytes = merged('posting_bytes')
+    if bm25_bounds:
+        ii.bm25_block_max = merged('bm25_block_max')
+        ii.bm25_bounds_params = (k1, b, 128)
+    ii._posting_list = defaultdict(list)
+    # doc_norm of indexes_creator.ipynb
+    ii.d_norms = {}
+    for doc_id, t in tokens.items():
+        norm = sum((cnt / dl[doc_id] * np.log(corpus_size / df[term])) ** 2 for term, cnt in Counter(t).items())
+        ii.d_norms[doc_id] = float(np.sqrt(norm))
+    ii.corpus_size = corpus_size
+    ii.write_index(out, f'index_{name}')
+
+
+def build_corpus(out, params):
+    """ Generate the corpus of `params` and write everything search_frontend
+        loads into `out` (into every shard directory of it, see `shard_dirs`).
+    """
+    t_start = perf_counter()
+    docs, anchors, queries = generate_corpus(params['docs'], params['words'], params['queries'], params['seed'])
+    out = Path(out)
+    dirs = shard_dirs(out, params['shards'])
+    for d in dirs:
+        d.mkdir(parents=True, exist_ok=True)
+    inlinks = Counter(target for target, _ in anchors)
+    page_rank = {doc_id: (1 + inlinks[doc_id]) / (1 + len(anchors) / len(docs)) for doc_id in docs}
+    rng = np.random.default_rng(params['seed'] + 1)
+    page_views = {doc_id: int(rng.lognormal(4, 1) * (1 + inlinks[doc_id])) for doc_id in docs}
+    anchor_texts = defaultdict(list)
+    for target, text in anchors:
+        anchor_texts[target].append(text)
+    index_kwargs = dict(corpus_size=len(docs), fmt=params['fmt'], order=params['order'],
+                        bm25_bounds=params['bm25_bounds'], prior=page_rank)
+    build_index('title_idx', {d: title for d, (title, _) in docs.items()}, dirs, **index_kwargs)
+    build_index('body_idx', {d: body for d, (_, body) in docs.items()}, dirs, **index_kwargs)
+    build_index('anchor_idx', {d: ' '.join(texts) for d, texts in anchor_texts.items()}, dirs, **index_kwargs)
+    for i, d in enumerate(dirs):
+        for blob, values in (('page_rank.pkl', page_rank), ('page_views.pkl', page_views),
+                             ('id2title.pkl', {doc_id: title for doc_id, (title, _) in docs.items()})):
+            with open(d / blob, 'wb') as f:
+                pickle.dump({k: v for k, v in values.items() if shard_of(k, len(dirs)) == i}, f)
+    with open(out / 'queries.json', 'w') as f:
+        json.dump(queries, f)
+    # written last: its presence marks a complete corpus
+    with open(out / 'bench.json', 'w') as f:
+        json.dump(params, f)
+    return perf_counter() - t_start
+
+
+def percentile(latencies, q):
+    return float(np.percentile(latencies, q)) if len(latencies) else float('nan')
+
+
+def replay(client, endpoint, queries, repeat=1):
+    """ Send every query `repeat` times to `endpoint`; returns the per-request
+        latencies, the wall time and the MAP@40 of the first pass.
+    """
+    latencies, aps = [], []
+    t_start = perf_counter()
+    for r in range(repeat):
+        for q, true_wids in queries.items():
+            t_query = perf_counter()
+            res = client.get(f'/{endpoint}', query_string={'query': q})
+            latencies.append(perf_counter() - t_query)
+            if res.status_code != 200:
+                raise RuntimeError(f'/{endpoint}?query={q} answered {res.status_code}')
+            if r == 0:
+                aps.append(average_precision(true_wids, [wid for wid, _ in res.get_json()]))
+    wall = perf_counter() - t_start
+    return latencies, wall, sum(aps) / len(aps)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(client, queries, args, params, load_seconds):
+    """ Replay the queries through every endpoint of `args.endpoints` and print their figures. """
+    results = {'commit': git_commit(), 'params': params, 'load_seconds': load_seconds, 'endpoints': {}}
+    print(f"{'endpoint':<14} {'queries':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'QPS':>8} {'MAP@40':>7}")
+    for endpoint in args.endpoints:
+        for _ in range(args.warmup):
+            replay(client, endpoint, queries)
+        latencies, wall, map40 = replay(client, endpoint, queries, args.repeat)
+        row = {'requests': len(latencies), 'p50_ms': percentile(latencies, 50) * 1000,
+               'p95_ms': percentile(latencies, 95) * 1000, 'p99_ms': percentile(latencies, 99) * 1000,
+               'qps': len(latencies) / wall, 'map40': map40}
+        results['endpoints'][endpoint] = row
+        print(f"{endpoint:<14} {len(queries):>7} {row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} "
+              f"{row['p99_ms']:>8.2f} {row['qps']:>8.1f} {row['map40']:>7.3f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--corpus-dir', default='bench_corpus')
+    parser.add_argument('--docs', type=int, default=20000)
+    parser.add_argument('--words', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fmt', type=int, default=FORMAT_RAW, help='posting format, 0 raw or 1 vbyte')
+    parser.add_argument('--order', default=None, help='posting order: tf, bm25 or prior')
+    parser.add_argument('--bm25-bounds', action='store_true', help='store BM25 block maxima')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='partition the documents into this many shards, served by local '
+                             'processes behind coordinator.py')
+    parser.add_argument('--port', type=int, default=8181, help='first port of the shard processes')
+    parser.add_argument('--endpoints', nargs='+', default=list(ENDPOINTS), choices=ENDPOINTS)
+    parser.add_argument('--repeat', type=int, default=3, help='passes over the queries per endpoint')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed passes before measuring')
+    parser.add_argument('--result-cache', action='store_true', help='keep the result cache on')
+    parser.add_argument('--rebuild', action='store_true')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    params = {'docs': args.docs, 'words': args.words, 'queries': args.queries, 'seed': args.seed,
+              'fmt': args.fmt, 'order': args.order, 'bm25_bounds': args.bm25_bounds, 'shards': args.shards}
+    corpus = Path(args.corpus_dir).resolve()
+    meta = corpus / 'bench.json'
+    if args.rebuild or not meta.exists() or json.loads(meta.read_text()) != params:
+        # the doc_stats and titles directories are derived from the previous corpus
+        for stale in ('bench.json', 'doc_stats', 'titles', 'title_idx', 'body_idx', 'anchor_idx',
+                      'index_title_idx', 'index_body_idx', 'index_anchor_idx'):
+            path = corpus / stale
+            if path.is_dir():
+                shutil.rmtree(path)
+            elif path.exists():
+                path.unlink()
+        for path in corpus.glob('shard_*'):
+            shutil.rmtree(path)
+        print(f'building the corpus in {corpus} ...', file=sys.stderr)
+        print(f'built in {build_corpus(corpus, params):.1f}s', file=sys.stderr)
+    queries = json.loads((corpus / 'queries.json').read_text())
+
+    # search_frontend loads the indexes from the environment when imported
+    os.environ['IR_STORAGE'] = 'local'
+    os.environ['IR_LOCAL_DIR'] = str(corpus)
+    os.environ['IR_RELOAD_INTERVAL'] = '0'
+    if not args.result_cache:
+        os.environ['IR_RESULT_CACHE_MB'] = '0'
+    t_start = perf_counter()
+    shard_procs = []
+    if args.shards == 1:
+        import search_frontend
+        client = search_frontend.app.test_client()
+    else:
+        import coordinator
+        shard_procs = coordinator.start_local_shards(shard_dirs(corpus, args.shards), args.port)
+        client = coordinator.app.test_client()
+    load_seconds = perf_counter() - t_start
+    try:
+        results = run_benchmark(client, queries, args, params, load_seconds)
+    finally:
+        if shard_procs:
+            coordinator.stop_local_shards(shard_procs)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
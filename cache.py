@@ -0,0 +1,135 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class PostingListCache:
+    """ An in-process LRU cache of decoded posting lists, shared by all the
+        endpoints. Entries are keyed by (index_dir, term, th) and hold the
+        (doc_ids, tfs) arrays returned by `get_pl`; the least recently used
+        ones are evicted once their total size exceeds `max_bytes`.
+    """
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(value):
+        return sum(a.nbytes for a in value)
+
+    def get(self, key):
+        """ The cached value of `key` (marked most recently used) or None. """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """ Cache `value`, evicting the least recently used entries to make room.
+            Values bigger than the whole budget are not cached. The arrays are
+            made read-only since every reader shares them.
+        """
+        size = self._size(value)
+        if size > self.max_bytes:
+            return
+        for a in value:
+            a.setflags(write=False)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= self._size(old)
+            self._entries[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= self._size(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes,
+                    'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+class ResultCache:
+    """ A size-bounded LRU cache of serialized responses with a TTL. Entries
+        are keyed by (endpoint, query tokens) and hold the JSON body bytes;
+        they expire `ttl` seconds after being stored and all of them are
+        dropped by `invalidate` (when the indexes are reloaded).
+    """
+    def __init__(self, max_bytes=128 * 2 ** 20, ttl=600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ The cached body of `key` or None if it is missing or expired. """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, body, generation=None):
+        """ Cache `body`, evicting the least recently used entries to make room.
+            A body computed before the last `invalidate` (pass the `generation`
+            read before computing it) is not stored.
+        """
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, body)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        _, body = self._entries.pop(key)
+        self._bytes -= len(body)
+
+    def invalidate(self):
+        """ Drop every entry, e.g. after the indexes were reloaded. """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes,
+                    'max_bytes': self.max_bytes, 'ttl': self.ttl,
+                    'generation': self.generation, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
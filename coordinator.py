@@ -0,0 +1,310 @@
+""" Scatter-gather coordinator over a document-partitioned index.
+
+Every shard is a search_frontend server over the indexes of its part of the
+documents, the ones with `shard_of(doc_id, n_shards) == i`, built with the
+corpus-wide df, N and AVGDL (see `set_global_stats`) so that it scores its
+documents as the whole index would. The coordinator serves the same
+endpoints as search_frontend: it sends the query to every shard at once
+(the /shard/... endpoints), merges their top-k lists and, for /search, fuses
+the merged signals and asks the shards holding the winners for their titles.
+
+The candidates of /search and /search_body differ from the unsharded
+index's: every shard keeps the first `th` postings of each query term's
+list (the per-shard truncation of `get_pl`), so the shards score up to
+n_shards * th documents per term where one index scores th, and the merged
+rankings can differ from a single index's.
+
+    IR_SHARDS=http://10.0.0.1:8080,http://10.0.0.2:8080 gunicorn -c gunicorn.conf.py coordinator:app
+
+lists shard i's URL in position i. For testing, the shards can be started as
+local processes on shard directories:
+
+    python coordinator.py --shard-dirs bench_corpus/shard_0 bench_corpus/shard_1 [--port 8080]
+"""
+import argparse
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from flask import Flask, request, jsonify, g
+
+import metrics
+from backend import tokenize, top_k, top_scores, fused_top, fusion_profiles_from_env
+from inverted_index_gcp import shard_of
+from metrics import span
+from setops import union
+
+# the shard URLs, shard i in position i
+SHARDS = [url.rstrip('/') for url in os.environ.get('IR_SHARDS', '').split(',') if url]
+# seconds a shard has to answer
+SHARD_TIMEOUT = float(os.environ.get('IR_SHARD_TIMEOUT', 10))
+# the requests to shards a process has in flight at once
+SCATTER_WORKERS = int(os.environ.get('IR_SCATTER_WORKERS', 64))
+# the fusion weight profiles of /search, as search_frontend's
+FUSION_PROFILES = fusion_profiles_from_env()
+
+app = Flask(__name__)
+app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+
+_pool = None
+_local = threading.local()
+
+
+def _session():
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = _local.session = requests.Session()
+    return session
+
+
+def _call(shard, path, params=None, body=None):
+    url = f'{SHARDS[shard]}{path}'
+    if body is None:
+        res = _session().get(url, params=params, timeout=SHARD_TIMEOUT)
+    else:
+        res = _session().post(url, json=body, timeout=SHARD_TIMEOUT)
+    res.raise_for_status()
+    return res.json()
+
+
+def scatter(path, params=None, bodies=None):
+    """ Call `path` on every shard (or, with `bodies`, a {shard: JSON body}
+        dict, POST to those shards) in parallel; returns the JSON responses,
+        in shard order.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(SCATTER_WORKERS, thread_name_prefix='scatter')
+    calls = [(shard, None) for shard in range(len(SHARDS))] if bodies is None else sorted(bodies.items())
+    with span('scatter'):
+        futures = [_pool.submit(contextvars.copy_context().run, _call, shard, path, params, body)
+                   for shard, body in calls]
+        return [future.result() for future in futures]
+
+
+def by_shard(doc_ids):
+    """ {shard: [doc_id, ...]} of the shards holding `doc_ids`. """
+    groups = {}
+    for doc_id in doc_ids:
+        groups.setdefault(shard_of(doc_id, len(SHARDS)), []).append(doc_id)
+    return groups
+
+
+def merge_top(parts, k):
+    """ The k best [doc_id, score, title] rows of the shards' lists, by score
+        and then by the smaller doc id (as `top_k` ranks a single index).
+    """
+    rows = [row for part in parts for row in part]
+    doc_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    scores = np.array([row[1] for row in rows], dtype=np.float64)
+    return [rows[i] for i in top_k(doc_ids, scores, k).tolist()]
+
+
+def merge_signals(parts):
+    """ The candidates and the corpus-wide signals of /search from the shards'
+        /shard/search responses: every signal keeps its top `n` over all of them.
+        The candidates are the union of the shards' own th-truncated ones
+        (see the module docstring), not the single index's.
+    """
+    candidates = union([np.array(part['candidates'], dtype=np.int64) for part in parts])
+    signals = []
+    for j, first in enumerate(parts[0]['signals']):
+        doc_ids = np.array([d for part in parts for d in part['signals'][j]['doc_ids']], dtype=np.int64)
+        scores = np.array([s for part in parts for s in part['signals'][j]['scores']], dtype=np.float64)
+        signals.append(top_scores(doc_ids, scores, first['n']))
+    return candidates, signals
+
+
+def resolve_titles(doc_ids):
+    """ The (doc_id, title) pairs of a ranked result list, in order, from the
+        shards holding them, leaving out the documents without a title.
+    """
+    groups = by_shard(doc_ids)
+    if not groups:
+        return []
+    titles = {}
+    for pairs in scatter('/shard/titles', bodies=groups):
+        titles.update((doc_id, title) for doc_id, title in pairs)
+    return [(doc_id, titles[doc_id]) for doc_id in doc_ids if doc_id in titles]
+
+
+@app.errorhandler(requests.RequestException)
+def shard_unavailable(e):
+    return jsonify(error=f'a shard did not answer: {e}'), 502
+
+
+@app.errorhandler(requests.HTTPError)
+def shard_error(e):
+    """ A shard's error answer (e.g. for a doc id it does not hold), passed
+        through with its status code: the shard is up, the request failed.
+    """
+    res = e.response
+    return app.response_class(res.content, status=res.status_code,
+                              mimetype=res.headers.get('Content-Type', 'text/plain'))
+
+
+@app.before_request
+def require_shards():
+    """ 503 from every endpoint but the liveness and metrics ones while no
+        shard is configured (IR_SHARDS unset or empty).
+    """
+    if not SHARDS and request.endpoint not in ('healthz', 'metrics_endpoint'):
+        return jsonify(error='no shards configured (IR_SHARDS)'), 503
+
+
+@app.route("/search")
+def search():
+    """ /search over all the shards: the signals of every shard are merged
+        into the corpus-wide ones before they are fused.
+    """
+    query = request.args.get('query', '')
+    tokens = tokenize(query)
+    if len(tokens) == 0:
+        return jsonify([])
+    parts = scatter('/shard/search', {'query': query})
+    with span('merge'):
+        candidates, signals = merge_signals(parts)
+    with span('fusion'):
+        top_d = fused_top(tokens, candidates, signals, 5, FUSION_PROFILES).tolist()
+    with span('titles'):
+        return jsonify(resolve_titles(top_d))
+
+
+@app.route("/search_body")
+def search_body():
+    """ /search_body over all the shards: the 100 best of their top 100s. """
+    query = request.args.get('query', '')
+    if len(tokenize(query)) == 0:
+        return jsonify([])
+    parts = scatter('/shard/search_body', {'query': query})
+    with span('merge'):
+        rows = merge_top(parts, 100)
+    return jsonify([(doc_id, title) for doc_id, _, title in rows if title is not None])
+
+
+def merged_counts(path):
+    query = request.args.get('query', '')
+    if len(tokenize(query)) == 0:
+        return jsonify([])
+    parts = scatter(path, {'query': query})
+    with span('merge'):
+        rows = merge_top(parts, sum(len(part) for part in parts))
+    return jsonify([(doc_id, title) for doc_id, _, title in rows])
+
+
+@app.route("/search_title")
+def search_title():
+    """ /search_title over all the shards, ranked by the distinct query terms matched. """
+    return merged_counts('/shard/search_title')
+
+
+@app.route("/search_anchor")
+def search_anchor():
+    """ /search_anchor over all the shards, ranked by the distinct query terms matched. """
+    return merged_counts('/shard/search_anchor')
+
+
+def routed(path):
+    """ The answers of the shards holding every posted doc id, in order. """
+    wiki_ids = request.get_json()
+    if len(wiki_ids) == 0:
+        return jsonify([])
+    groups = by_shard(wiki_ids)
+    answers = {}
+    for ids, values in zip([ids for _, ids in sorted(groups.items())], scatter(path, bodies=groups)):
+        answers.update(zip(ids, values))
+    return jsonify([answers[wiki_id] for wiki_id in wiki_ids])
+
+
+@app.route("/get_pagerank", methods=['POST'])
+def get_pagerank():
+    """ The PageRank values of the posted wiki ids, from their shards. """
+    return routed('/get_pagerank')
+
+
+@app.route("/get_pageview", methods=['POST'])
+def get_pageview():
+    """ The page views of the posted wiki ids, from their shards. """
+    return routed('/get_pageview')
+
+
+@app.route("/healthz")
+def healthz():
+    return jsonify({'status': 'ok'})
+
+
+@app.route("/readyz")
+def readyz():
+    """ 200 with the index version of every shard once all of them are ready, 503 before. """
+    versions = []
+    for shard in range(len(SHARDS)):
+        try:
+            versions.append(_call(shard, '/readyz')['version'])
+        except requests.RequestException:
+            return jsonify({'status': 'waiting for shard', 'shard': shard}), 503
+    return jsonify({'status': 'ready', 'shards': len(SHARDS), 'versions': versions})
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.before_request
+def start_request_trace():
+    if request.endpoint in ('healthz', 'readyz', 'metrics_endpoint'):
+        return
+    g.trace_token = metrics.start_trace(request.endpoint or 'unknown', request.args.get('query'))
+
+
+@app.teardown_request
+def finish_request_trace(exc=None):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        metrics.finish_trace(token)
+
+
+def start_local_shards(shard_dirs, base_port, server='flask'):
+    """ Serve every shard directory from a local process, on consecutive
+        ports from `base_port`; returns the processes once all are ready.
+    """
+    from load_test import start_server
+    procs = []
+    try:
+        for i, shard_dir in enumerate(shard_dirs):
+            proc, url = start_server(shard_dir, base_port + i, server, workers=1)
+            procs.append(proc)
+            SHARDS.append(url)
+    except Exception:
+        stop_local_shards(procs)
+        raise
+    return procs
+
+
+def stop_local_shards(procs):
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a sharded index from local shard processes.')
+    parser.add_argument('--shard-dirs', nargs='+', required=True, help='shard i directory in position i')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--server', choices=('gunicorn', 'flask'), default='flask',
+                        help='how the shard processes serve')
+    args = parser.parse_args()
+    SHARDS.clear()
+    procs = start_local_shards(args.shard_dirs, args.port + 1, args.server)
+    try:
+        app.run(host='0.0.0.0', port=args.port, threaded=True)
+    finally:
+        stop_local_shards(procs)
+
+
+if __name__ == '__main__':
+    main()
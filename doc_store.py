@@ -0,0 +1,249 @@
+""" Columnar per-document statistics.
+
+The doc lengths and tf-idf norms of the body index and the PageRank and page
+view scores are kept as one NumPy column each, aligned with a sorted array of
+wiki ids (the document ordinals), and memory-mapped read-only so that every
+worker on a machine shares the same pages:
+
+    doc_stats/
+        meta.json      - number of documents with a length and their total length
+        doc_ids.npy    - sorted wiki ids (int64)
+        dl.npy         - doc lengths (int32, -1 when unknown)
+        norm.npy       - tf-idf norms (float64, NaN when unknown)
+        pagerank.npy   - PageRank (float64, NaN when unknown)
+        pageviews.npy  - page views (int64, -1 when unknown)
+
+The titles are kept the same way, as the UTF-8 encoded titles concatenated
+in wiki id order with their offsets:
+
+    titles/
+        doc_ids.npy    - sorted wiki ids (int64)
+        offsets.npy    - start of every title in the blob, plus its end (uint64)
+        blob.npy       - the UTF-8 titles (uint8)
+
+    python doc_store.py --out doc_stats --titles-out titles
+
+builds both directories from the pickles in the storage configured by the
+IR_* environment variables (see `storage_from_env`).
+"""
+import argparse
+import json
+import os
+import pickle
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+# column name -> (dtype, value marking a document without one)
+COLUMNS = {
+    'dl': (np.int32, -1),
+    'norm': (np.float64, np.nan),
+    'pagerank': (np.float64, np.nan),
+    'pageviews': (np.int64, -1),
+}
+
+
+class DocColumn:
+    """ One statistic of every document. Behaves like the doc_id -> value dict
+        it replaces (`get`, `[]`, `in`) and adds `gather` for whole arrays of
+        doc ids.
+    """
+    def __init__(self, doc_ids, values, missing):
+        self._doc_ids = doc_ids
+        self._values = values
+        self._missing = missing
+
+    def _absent(self, values):
+        if np.isnan(self._missing):
+            return np.isnan(values)
+        return values == self._missing
+
+    def gather(self, doc_ids, default=0):
+        """ The values of `doc_ids` as float64, `default` for unknown documents. """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if len(self._doc_ids) == 0:
+            return np.full(len(doc_ids), default, dtype=np.float64)
+        ords = np.minimum(np.searchsorted(self._doc_ids, doc_ids), len(self._doc_ids) - 1)
+        values = self._values[ords]
+        found = (self._doc_ids[ords] == doc_ids) & ~self._absent(values)
+        values = values.astype(np.float64)
+        values[~found] = default
+        return values
+
+    def get(self, doc_id, default=None):
+        i = np.searchsorted(self._doc_ids, doc_id)
+        if i == len(self._doc_ids) or self._doc_ids[i] != doc_id or self._absent(self._values[i]):
+            return default
+        return self._values[i].item()
+
+    def __getitem__(self, doc_id):
+        value = self.get(doc_id)
+        if value is None:
+            raise KeyError(doc_id)
+        return value
+
+    def __contains__(self, doc_id):
+        return self.get(doc_id) is not None
+
+
+class DocStats:
+    """ A doc_stats directory (see the module docstring), memory-mapped. """
+    def __init__(self, path):
+        path = Path(path)
+        with open(path / 'meta.json') as f:
+            meta = json.load(f)
+        self.n_docs = meta['n_docs']
+        self.avgdl = meta['sum_dl'] / self.n_docs if self.n_docs else 0.0
+        self.doc_ids = np.load(path / 'doc_ids.npy', mmap_mode='r')
+        for name, (_, missing) in COLUMNS.items():
+            values = np.load(path / f'{name}.npy', mmap_mode='r')
+            setattr(self, name, DocColumn(self.doc_ids, values, missing))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def column(self, name):
+        return getattr(self, name)
+
+    @staticmethod
+    def exists(path):
+        return (Path(path) / 'meta.json').exists()
+
+    @staticmethod
+    def write(path, dl, d_norms, page_rank, page_views):
+        """ Write a doc_stats directory from the doc_id -> value dicts. """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        columns = {'dl': dl, 'norm': d_norms, 'pagerank': page_rank, 'pageviews': page_views}
+        keys = {name: np.fromiter(d.keys(), dtype=np.int64, count=len(d)) for name, d in columns.items()}
+        doc_ids = np.unique(np.concatenate(list(keys.values())))
+        np.save(path / 'doc_ids.npy', doc_ids)
+        for name, d in columns.items():
+            dtype, missing = COLUMNS[name]
+            values = np.full(len(doc_ids), missing, dtype=dtype)
+            values[np.searchsorted(doc_ids, keys[name])] = np.fromiter(d.values(), dtype=dtype, count=len(d))
+            np.save(path / f'{name}.npy', values)
+        # written last: its presence marks a complete directory
+        tmp = path / 'meta.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'n_docs': len(dl), 'sum_dl': int(sum(dl.values()))}, f)
+        os.replace(tmp, path / 'meta.json')
+
+
+class TitleStore:
+    """ A titles directory (see the module docstring), memory-mapped. """
+    def __init__(self, path):
+        path = Path(path)
+        self.doc_ids = np.load(path / 'doc_ids.npy', mmap_mode='r')
+        self._offsets = np.load(path / 'offsets.npy', mmap_mode='r')
+        self._blob = np.load(path / 'blob.npy', mmap_mode='r')
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id):
+        return self.get(doc_id) is not None
+
+    def _find(self, doc_ids):
+        """ The ordinals of `doc_ids` and whether each one has a title. """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if len(self.doc_ids) == 0:
+            return np.zeros(len(doc_ids), dtype=np.intp), np.zeros(len(doc_ids), dtype=bool)
+        ords = np.minimum(np.searchsorted(self.doc_ids, doc_ids), len(self.doc_ids) - 1)
+        return ords, self.doc_ids[ords] == doc_ids
+
+    def _title(self, o):
+        return self._blob[self._offsets[o]:self._offsets[o + 1]].tobytes().decode('utf-8')
+
+    def get(self, doc_id, default=None):
+        ords, found = self._find([doc_id])
+        return self._title(ords[0]) if found[0] else default
+
+    def has(self, doc_ids):
+        """ Which of `doc_ids` have a title (a bool mask). """
+        return self._find(doc_ids)[1]
+
+    def resolve(self, doc_ids):
+        """ The (doc_id, title) pairs of a ranked result list, in order,
+            leaving out the documents without a title.
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        ords, found = self._find(doc_ids)
+        return [(doc_id, self._title(o)) for doc_id, o in zip(doc_ids[found].tolist(), ords[found].tolist())]
+
+    @staticmethod
+    def exists(path):
+        return (Path(path) / 'blob.npy').exists()
+
+    @staticmethod
+    def write(path, id2title):
+        """ Write a titles directory from a doc_id -> title mapping (or Series). """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        items = sorted((int(doc_id), str(title)) for doc_id, title in id2title.items())
+        encoded = [title.encode('utf-8') for _, title in items]
+        offsets = np.zeros(len(items) + 1, dtype=np.uint64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        np.save(path / 'doc_ids.npy', np.array([doc_id for doc_id, _ in items], dtype=np.int64))
+        np.save(path / 'offsets.npy', offsets)
+        # written last: its presence marks a complete directory
+        with open(path / 'blob.npy.tmp', 'wb') as f:
+            np.save(f, np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        os.replace(path / 'blob.npy.tmp', path / 'blob.npy')
+
+
+def part_dir(path):
+    """ A directory of this process to build `path` in before `publish_dir`. """
+    path = Path(path)
+    tmp = path.with_name(f'{path.name}.part.{os.getpid()}')
+    shutil.rmtree(tmp, ignore_errors=True)
+    return tmp
+
+
+def publish_dir(tmp, path):
+    """ Move the finished directory `tmp` to `path` in one rename. Processes
+        building the same directory at once (e.g. every gunicorn worker on a
+        reload) each build their own `part_dir`; the first rename wins and
+        the others discard theirs.
+    """
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        if not Path(path).exists():
+            raise
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def build_titles_from_storage(storage, path):
+    """ Write a titles directory from the id2title pickle held by `storage`. """
+    tmp = part_dir(path)
+    TitleStore.write(tmp, pickle.loads(storage.read_blob('id2title.pkl')))
+    publish_dir(tmp, path)
+
+
+def build_from_storage(storage, path):
+    """ Write a doc_stats directory from the body index and the PageRank and
+        page view pickles held by `storage`.
+    """
+    body_idx = pickle.loads(storage.read_blob('index_body_idx.pkl'))
+    page_rank = pickle.loads(storage.read_blob('page_rank.pkl'))
+    page_views = pickle.loads(storage.read_blob('page_views.pkl'))
+    tmp = part_dir(path)
+    DocStats.write(tmp, body_idx.dl, body_idx.d_norms, page_rank, page_views)
+    publish_dir(tmp, path)
+
+
+def main():
+    from inverted_index_gcp import storage_from_env
+    parser = argparse.ArgumentParser(description='Build the doc_stats and titles directories.')
+    parser.add_argument('--out', default='doc_stats')
+    parser.add_argument('--titles-out', default='titles')
+    args = parser.parse_args()
+    storage = storage_from_env()
+    build_from_storage(storage, args.out)
+    build_titles_from_storage(storage, args.titles_out)
+
+
+if __name__ == '__main__':
+    main()
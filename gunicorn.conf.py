@@ -0,0 +1,31 @@
+""" Production serving of search_frontend (see README.md):
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+(or of a sharded index's coordinator, `coordinator:app`).
+
+The app is imported once in the master (preload_app), so the indexes are
+opened and memory-mapped before the workers fork and every worker shares
+the same pages. Each worker then watches the published index version and
+reloads on its own (see `watch_index_version`).
+"""
+import multiprocessing
+import os
+import sys
+
+bind = os.environ.get('IR_BIND', '0.0.0.0:8080')
+workers = int(os.environ.get('IR_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('IR_THREADS', 4))
+preload_app = True
+timeout = int(os.environ.get('IR_WORKER_TIMEOUT', 60))
+# in-flight queries finish on SIGTERM / SIGHUP before a worker exits
+graceful_timeout = int(os.environ.get('IR_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+
+def post_fork(server, worker):
+    # search_frontend workers only (not the coordinator.py ones)
+    frontend = sys.modules.get('search_frontend')
+    if frontend is not None:
+        frontend.watch_index_version()
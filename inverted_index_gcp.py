@@ -1,6 +1,9 @@
 # import pyspark
 # import sys
 from collections import Counter, OrderedDict
+from collections.abc import Mapping
+from bisect import bisect_left
+import json
 import itertools
 # from itertools import islice, count, groupby
 # import pandas as pd
@@ -10,10 +13,15 @@ import itertools
 # from time import time
 from pathlib import Path
 import pickle
+import os
+import mmap
+import threading
+import numpy as np
 from google.cloud import storage
 # from collections import defaultdict
 # from contextlib import closing
 import gcsfs
+from doc_store import COLUMNS, DocColumn, part_dir, publish_dir
 
 
 
@@ -21,16 +29,21 @@ import gcsfs
 BLOCK_SIZE = 1999998
 
 class MultiFileWriter:
-    """ Sequential binary writer to multiple files of up to BLOCK_SIZE each. """
-    def __init__(self, base_dir, name, bucket_name):
+    """ Sequential binary writer to multiple files of up to BLOCK_SIZE each.
+        When `bucket_name` is None the files are only kept on local disk.
+    """
+    def __init__(self, base_dir, name, bucket_name=None, prefix='postings_gcp'):
         self._base_dir = Path(base_dir)
         self._name = name
+        self._prefix = prefix
         self._file_gen = (open(self._base_dir / f'{name}_{i:03}.bin', 'wb') 
                           for i in itertools.count())
         self._f = next(self._file_gen)
         # Connecting to google storage bucket. 
-        self.client = storage.Client()
-        self.bucket = self.client.bucket(bucket_name)
+        self.bucket = None
+        if bucket_name is not None:
+            self.client = storage.Client()
+            self.bucket = self.client.bucket(bucket_name)
         
     
     def write(self, b):
@@ -45,7 +58,7 @@ class MultiFileWriter:
                 self._f = next(self._file_gen)
                 pos, remaining = 0, BLOCK_SIZE
             self._f.write(b[:remaining])
-            locs.append((self._f.name, pos))
+            locs.append((Path(self._f.name).name, pos))
             b = b[remaining:]
         return locs
 
@@ -56,36 +69,175 @@ class MultiFileWriter:
         '''
             The function saves the posting files into the right bucket in google storage.
         '''
+        if self.bucket is None:
+            return
         file_name = self._f.name
-        blob = self.bucket.blob(f"postings_gcp/{file_name}")
+        blob = self.bucket.blob(f"{self._prefix}/{Path(file_name).name}")
         blob.upload_from_filename(file_name)
 
-        
+
+class LocalStorage:
+    """ Serves posting files from a local directory. Every `*.bin` file is
+        memory-mapped once and reads return zero-copy memoryview slices.
+        Files are expected under `base_dir`/`index_dir`/`f_name`. With a
+        `version` whose `base_dir`/`version` directory exists, that
+        directory is served instead, so a new index version is published
+        by writing it there before updating INDEX_VERSION; without one the
+        same files are mapped again on every reload.
+    """
+    def __init__(self, base_dir, version=None):
+        base_dir = Path(base_dir)
+        if version and (base_dir / version).is_dir():
+            base_dir = base_dir / version
+        self._base_dir = base_dir
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def preload(self, index_dir):
+        """ Map all the posting files of `index_dir` (call it at startup). """
+        for p in sorted((self._base_dir / index_dir).glob('*.bin')):
+            self._map(index_dir, p.name)
+
+    def _map(self, index_dir, f_name):
+        key = (index_dir, f_name)
+        mv = self._maps.get(key)
+        if mv is not None:
+            return mv
+        with self._lock:
+            if key not in self._maps:
+                path = self._base_dir / index_dir / f_name
+                with open(path, 'rb') as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        self._maps[key] = memoryview(b'')
+                    else:
+                        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                        self._maps[key] = memoryview(mm)
+            return self._maps[key]
+
+    def read(self, index_dir, f_name, offset, n_bytes):
+        return self._map(index_dir, f_name)[offset:offset + n_bytes]
+
+    def read_blob(self, name):
+        """ Read a whole (non-posting) object such as a pickled index. """
+        return (self._base_dir / name).read_bytes()
+
+    def local_dir(self, name):
+        """ A local directory holding the `name` directory of the storage. """
+        return str(self._base_dir / name)
+
+    def close(self):
+        with self._lock:
+            maps, self._maps = self._maps, {}
+        for mv in maps.values():
+            obj = mv.obj
+            mv.release()
+            if isinstance(obj, mmap.mmap):
+                try:
+                    obj.close()
+                except BufferError:
+                    # a slice is still referenced; unmapped once it is collected
+                    pass
+
+
+class GCSStorage:
+    """ Serves posting files from a google storage bucket. A single gcsfs
+        connection is kept per process for the life of the object and every
+        read is a ranged GET, so nothing is re-opened per (file, offset) pair.
+        Files are expected under gs://`bucket_name`/`prefix`/`index_dir`/`f_name`.
+        Directories that are memory-mapped are copied once to `cache_dir`,
+        under a `version` subdirectory when given so that a newly published
+        index version is downloaded next to the one being served.
+    """
+    def __init__(self, bucket_name, prefix='', cache_dir='ir_cache', version=None):
+        self._root = '/'.join(p for p in (bucket_name, prefix.strip('/')) if p)
+        self._fs_conn = None
+        self._fs_pid = None
+        self._cache_dir = Path(cache_dir) / version if version else Path(cache_dir)
+
+    @property
+    def _fs(self):
+        # gcsfs' async client is not fork-safe: a process forked after it was
+        # created (gunicorn workers of the preloading master) opens its own
+        if self._fs_pid != os.getpid():
+            self._fs_conn = gcsfs.GCSFileSystem()
+            self._fs_pid = os.getpid()
+        return self._fs_conn
+
+    def preload(self, index_dir):
+        pass
+
+    def read(self, index_dir, f_name, offset, n_bytes):
+        return self._fs.cat_file(f'{self._root}/{index_dir}/{f_name}',
+                                 start=offset, end=offset + n_bytes)
+
+    def read_blob(self, name):
+        return self._fs.cat_file(f'{self._root}/{name}')
+
+    def local_dir(self, name):
+        local = self._cache_dir / name
+        remote = f'{self._root}/{name}'
+        if not local.exists() and self._fs.exists(remote):
+            # every worker reloading at once downloads its own copy, see publish_dir
+            tmp = part_dir(local)
+            self._cache_dir.mkdir(parents=True, exist_ok=True)
+            self._fs.get(remote, str(tmp), recursive=True)
+            publish_dir(tmp, local)
+        return str(local)
+
+    def close(self):
+        pass
+
+
+def storage_from_env(version=None):
+    """ Build the posting storage backend from the environment:
+          IR_STORAGE   - 'gcs' (default) or 'local'
+          IR_BUCKET    - bucket name for 'gcs' (default 'ln3250')
+          IR_PREFIX    - path prefix inside the bucket (default '')
+          IR_LOCAL_DIR - base directory for 'local' (default '.')
+          IR_CACHE_DIR - local copies of memory-mapped data for 'gcs' (default 'ir_cache')
+        `version` is the published index version the local copies belong to
+        ('gcs') or the subdirectory of IR_LOCAL_DIR holding it ('local').
+    """
+    kind = os.environ.get('IR_STORAGE', 'gcs')
+    if kind == 'local':
+        return LocalStorage(os.environ.get('IR_LOCAL_DIR', '.'), version)
+    if kind == 'gcs':
+        return GCSStorage(os.environ.get('IR_BUCKET', 'ln3250'),
+                          os.environ.get('IR_PREFIX', ''),
+                          os.environ.get('IR_CACHE_DIR', 'ir_cache'), version)
+    raise ValueError(f'unknown IR_STORAGE backend: {kind!r}')
+
+
+_default_storage = None
+
+
+def get_default_storage():
+    """ The process-wide storage backend, created once from the environment. """
+    global _default_storage
+    if _default_storage is None:
+        _default_storage = storage_from_env()
+    return _default_storage
+
 
 class MultiFileReader:
-    """ Sequential binary reader of multiple files of up to BLOCK_SIZE each. """
-    def __init__(self):
-        self._open_files = {}
+    """ Sequential binary reader of multiple files of up to BLOCK_SIZE each. 
+        Reads go through a storage backend (LocalStorage / GCSStorage), which
+        is shared and outlives the reader.
+    """
+    def __init__(self, storage=None):
+        self._storage = storage if storage is not None else get_default_storage()
 
     def read(self, locs, n_bytes, index_dir):
         b = []
-        fs = gcsfs.GCSFileSystem()
-        print("links_index")
         for f_name, offset in locs:
-            with fs.open(f'gs://ln3250/{index_dir}/{f_name}', 'rb') as f:
-                f.seek(offset)
-                n_read = min(n_bytes, BLOCK_SIZE - offset)
-                b.append(f.read(n_read))
-                n_bytes -= n_read
+            if n_bytes <= 0:
+                break
+            n_read = min(n_bytes, BLOCK_SIZE - offset)
+            b.append(self._storage.read(index_dir, Path(f_name).name, offset, n_read))
+            n_bytes -= n_read
+        if len(b) == 1:
+            return b[0]
         return b''.join(b)
-  
-    def close(self):
-        for f in self._open_files.values():
-            f.close()
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.close()
-        return False 
 
 
 from collections import defaultdict
@@ -94,9 +246,230 @@ from contextlib import closing
 TUPLE_SIZE = 6       # We're going to pack the doc_id and tf values in this 
                      # many bytes.
 TF_MASK = 2 ** 16 - 1 # Masking the 16 low bits of an integer
+# The on-disk layout of one posting: a big-endian 4 bytes doc_id followed by
+# a big-endian 2 bytes tf (i.e. `doc_id << 16 | tf` in TUPLE_SIZE bytes).
+POSTING_DTYPE = np.dtype([('doc_id', '>u4'), ('tf', '>u2')])
+
+
+def decode_posting_list(b, n=None):
+    """ Decode a raw posting buffer (bytes or memoryview) in one pass into two
+        parallel NumPy arrays (doc_ids:uint32, tfs:uint16). Only the first `n`
+        postings are decoded when `n` is given.
+    """
+    if n is None:
+        n = len(b) // TUPLE_SIZE
+    records = np.frombuffer(b, dtype=POSTING_DTYPE, count=n)
+    return records['doc_id'].astype(np.uint32), records['tf'].astype(np.uint16)
+
+
+# Orders in which `write_a_posting_list` can lay out a posting list. With any
+# of the impact orders a prefix of the list holds its highest-impact postings.
+ORDER_DOC_ID = 'doc_id'  # ascending doc_id
+ORDER_TF = 'tf'          # descending tf
+ORDER_BM25 = 'bm25'      # descending BM25 term contribution (tf and doc length)
+ORDER_PRIOR = 'prior'    # descending static document prior (e.g. PageRank)
+IMPACT_ORDERS = (ORDER_TF, ORDER_BM25, ORDER_PRIOR)
+
+
+def posting_impacts(doc_ids, tfs, order, dl=None, avgdl=None, prior=None, k1=1.5, b=0.75):
+    """ The per-posting impact used to sort a posting list in `order`.
+        ORDER_BM25 needs the doc lengths `dl` (doc_id -> length, a dict or a
+        `DocColumn`) and their mean `avgdl`; the term's idf is the same for
+        all of its postings so it is left out. ORDER_PRIOR needs `prior` (dict doc_id -> score).
+    """
+    tfs = np.asarray(tfs, dtype=np.float64)
+    if order == ORDER_TF:
+        return tfs
+    if order == ORDER_BM25:
+        if hasattr(dl, 'gather'):
+            lens = dl.gather(doc_ids, avgdl)
+        else:
+            lens = np.fromiter((dl.get(doc_id, avgdl) for doc_id in doc_ids),
+                               dtype=np.float64, count=len(tfs))
+        return tfs * (k1 + 1) / (tfs + k1 * (1 - b + b * lens / avgdl))
+    if order == ORDER_PRIOR:
+        return np.fromiter((prior.get(doc_id, 0) for doc_id in doc_ids),
+                           dtype=np.float64, count=len(tfs))
+    raise ValueError(f'unknown posting order: {order!r}')
+
+
+# The number of postings (in doc_id order) summarized by one BM25 block maximum.
+SCORE_BLOCK_SIZE = 128
+
+
+def bm25_block_maxima(doc_ids, tfs, dl, avgdl, k1=1.5, b=0.75, block_size=SCORE_BLOCK_SIZE):
+    """ Upper bounds of the BM25 term contribution (without the idf) of every
+        `block_size` postings of the list taken in doc_id order, whatever order
+        it is stored in. The maximum of the array bounds the whole list. The
+        bounds are rounded up to float32 so they never fall below the exact score.
+    """
+    doc_ids = np.asarray(doc_ids, dtype=np.uint32)
+    tfs = np.asarray(tfs)
+    perm = np.argsort(doc_ids, kind='stable')
+    impacts = posting_impacts(doc_ids[perm], tfs[perm], ORDER_BM25, dl=dl, avgdl=avgdl, k1=k1, b=b)
+    n_blocks = -(-len(impacts) // block_size)
+    padded = np.zeros(n_blocks * block_size)
+    padded[:len(impacts)] = impacts
+    maxima = padded.reshape(n_blocks, block_size).max(axis=1).astype(np.float32)
+    return np.nextafter(maxima, np.float32(np.inf))
+
+
+def sort_posting_list(doc_ids, tfs, order, **impact_kwargs):
+    """ Reorder the parallel (doc_ids, tfs) arrays in `order`. Ties in the impact
+        orders are broken by ascending doc_id so the layout is deterministic.
+    """
+    doc_ids = np.asarray(doc_ids, dtype=np.uint32)
+    tfs = np.asarray(tfs)
+    if order == ORDER_DOC_ID:
+        perm = np.argsort(doc_ids, kind='stable')
+    else:
+        impacts = posting_impacts(doc_ids, tfs, order, **impact_kwargs)
+        perm = np.lexsort((doc_ids, -impacts))
+    return doc_ids[perm], tfs[perm]
+
+
+def encode_posting_list(doc_ids, tfs):
+    """ The inverse of `decode_posting_list`. """
+    records = np.empty(len(doc_ids), dtype=POSTING_DTYPE)
+    records['doc_id'] = doc_ids
+    records['tf'] = np.asarray(tfs, dtype=np.int64) & TF_MASK
+    return records.tobytes()
+
+
+# Posting list formats (stored in `InvertedIndex.posting_format`).
+FORMAT_RAW = 0    # fixed TUPLE_SIZE bytes per posting, see POSTING_DTYPE
+FORMAT_VBYTE = 1  # per posting: zigzag doc_id delta, tf, both as LEB128 varints
+# Upper bound of a FORMAT_VBYTE posting: a 33 bits zigzag delta takes 5 bytes
+# and a 16 bits tf takes 3.
+MAX_VBYTE_TUPLE_SIZE = 8
+
+
+def _vbyte_encode(values):
+    """ LEB128 encoding of an array of non-negative integers: 7 bits per byte,
+        least significant group first, high bit set on all but the last byte.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        n_bytes += values >= np.uint64(1 << (7 * k))
+    starts = np.cumsum(n_bytes) - n_bytes
+    out = np.empty(int(n_bytes.sum()), dtype=np.uint8)
+    for k in range(int(n_bytes.max(initial=0))):
+        mask = n_bytes > k
+        group = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        more = (n_bytes[mask] - 1 > k).astype(np.uint64) << np.uint64(7)
+        out[starts[mask] + k] = group | more
+    return out.tobytes()
+
+
+def _vbyte_decode(b, n):
+    """ Decode the first `n` LEB128 integers of `b` into an unsigned array. """
+    a = np.frombuffer(b, dtype=np.uint8)
+    ends = np.flatnonzero(a < 0x80)[:n]
+    if len(ends) < n:
+        raise ValueError(f'truncated posting list: {len(ends)} of {n} values')
+    if n == 0:
+        return np.zeros(0, dtype=np.uint64)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    max_length = int(lengths.max())
+    dtype = np.uint32 if max_length <= 4 else np.uint64
+    values = (a[starts] & 0x7f).astype(dtype)
+    # one vectorized pass per byte position, most values are 1-2 bytes long
+    for k in range(1, max_length):
+        idx = np.flatnonzero(lengths > k)
+        values[idx] |= (a[starts[idx] + k] & 0x7f).astype(dtype) << dtype(7 * k)
+    return values
+
+
+def encode_postings(doc_ids, tfs, fmt=FORMAT_RAW):
+    """ Encode the parallel (doc_ids, tfs) arrays in posting format `fmt`.
+        FORMAT_VBYTE stores doc_id deltas zigzag-encoded, so it works for
+        impact-ordered lists too (they just compress less than doc_id order).
+    """
+    if fmt == FORMAT_RAW:
+        return encode_posting_list(doc_ids, tfs)
+    if fmt == FORMAT_VBYTE:
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        deltas = np.diff(doc_ids, prepend=0)
+        values = np.empty(2 * len(doc_ids), dtype=np.uint64)
+        values[0::2] = ((deltas << 1) ^ (deltas >> 63)).astype(np.uint64)
+        values[1::2] = np.asarray(tfs, dtype=np.int64) & TF_MASK
+        return _vbyte_encode(values)
+    raise ValueError(f'unknown posting format: {fmt!r}')
+
+
+def decode_postings(b, n, fmt=FORMAT_RAW):
+    """ Decode the first `n` postings of `b` (posting format `fmt`) into two
+        parallel NumPy arrays (doc_ids:uint32, tfs:uint16).
+    """
+    if fmt == FORMAT_RAW:
+        return decode_posting_list(b, n)
+    if fmt == FORMAT_VBYTE:
+        values = _vbyte_decode(b, 2 * n)
+        zigzag = values[0::2].astype(np.int64)
+        deltas = (zigzag >> 1) ^ -(zigzag & 1)
+        return np.cumsum(deltas).astype(np.uint32), values[1::2].astype(np.uint16)
+    raise ValueError(f'unknown posting format: {fmt!r}')
+
+
+class PostingListWriter:
+    """ Writes (w, [(doc_id, tf), ...]) posting lists one at a time into the
+        posting files of bucket `bucket_id` (see `write_posting_lists`) and
+        keeps their metadata: the posting locations, the encoded byte size
+        and (with `bm25_bounds`) the BM25 block maxima of every list.
+    """
+    def __init__(self, base_dir, bucket_id, bucket_name=None, order=None, fmt=FORMAT_RAW, bm25_bounds=None,
+                 prefix='postings_gcp', **impact_kwargs):
+        self._writer = MultiFileWriter(base_dir, bucket_id, bucket_name, prefix)
+        self._order = order
+        self._fmt = fmt
+        self._bm25_bounds = bm25_bounds
+        self._impact_kwargs = impact_kwargs
+        self.posting_locs = defaultdict(list)
+        self.posting_bytes = {}
+        self.block_max = {}
+
+    def add(self, w, pl):
+        # convert to bytes
+        doc_ids, tfs = zip(*pl) if len(pl) > 0 else ((), ())
+        if self._order is not None:
+            doc_ids, tfs = sort_posting_list(doc_ids, tfs, self._order, **self._impact_kwargs)
+        b = encode_postings(doc_ids, tfs, self._fmt)
+        self.posting_bytes[w] = len(b)
+        if self._bm25_bounds is not None:
+            self.block_max[w] = bm25_block_maxima(doc_ids, tfs, **self._bm25_bounds)
+        # write to file(s) and save the file locations to index
+        self.posting_locs[w].extend(self._writer.write(b))
+
+    def close(self):
+        """ Close the last posting file and upload it. """
+        self._writer.close()
+        self._writer.upload_to_gcp()
+
 
+class InvertedIndex:
+    # The order the posting lists were written in (one of the ORDER_* values).
+    # None means the order the builder handed them over in, which is what
+    # indexes pickled before this attribute existed were written with.
+    posting_order = None
+    # The posting format the lists were written in (FORMAT_RAW or FORMAT_VBYTE)
+    # and, for the variable-size formats, the encoded byte size of every list.
+    posting_format = FORMAT_RAW
+    posting_bytes = {}
+    # BM25 block maxima of every term (see `bm25_block_maxima`) and the
+    # (k1, b, block_size) they were computed with; used for top-k pruning.
+    bm25_block_max = {}
+    bm25_bounds_params = None
+    # For one shard of a document-partitioned index (see `set_global_stats`):
+    # the df of its terms over the whole corpus and the corpus' number of
+    # documents and average length, which its scores are computed with.
+    global_df = None
+    global_n_docs = None
+    global_avgdl = None
 
-class InvertedIndex:  
     def __init__(self, docs={}):
         """ Initializes the inverted index and add documents to it (if provided).
         Parameters:
@@ -134,16 +507,65 @@ class InvertedIndex:
             self._posting_list[w].append((doc_id, cnt))
 
     def write_index(self, base_dir, name):
-        """ Write the in-memory index to disk. Results in the file: 
+        """ Write the in-memory index to disk. Results in: 
             (1) `name`.pkl containing the global term stats (e.g. df).
+            (2) `name`/ holding the same data in the memory-mappable layout
+                opened by `MappedIndex`.
         """
         #### GLOBAL DICTIONARIES ####
         self._write_globals(base_dir, name)
+        self._write_mapped(Path(base_dir) / name)
 
     def _write_globals(self, base_dir, name):
         with open(Path(base_dir) / f'{name}.pkl', 'wb') as f:
             pickle.dump(self, f)
 
+    def _write_mapped(self, path):
+        """ Write the index as flat arrays (see `MappedIndex`): the `Lexicon`,
+            the term totals and BM25 block maxima by term id, and the doc
+            lengths / norms aligned with the sorted doc ids. The header holds
+            the scalars, including N and AVGDL.
+        """
+        path.mkdir(parents=True, exist_ok=True)
+        lexicon = Lexicon.from_index(self)
+        lexicon.save(path)
+        terms = lexicon.terms(range(len(lexicon)))
+        np.save(path / 'term_total.npy', np.array([self.term_total.get(w, 0) for w in terms], dtype=np.uint64))
+        if self.bm25_block_max:
+            blocks = [self.bm25_block_max.get(w, np.zeros(0, dtype=np.float32)) for w in terms]
+            np.save(path / 'bm25_start.npy', _starts([len(b) for b in blocks]))
+            np.save(path / 'bm25_block_max.npy', np.concatenate(blocks).astype(np.float32))
+        if self.global_df is not None:
+            np.save(path / 'global_df.npy', np.array([self.global_df[w] for w in terms], dtype=np.uint32))
+        dl = getattr(self, 'dl', {})
+        d_norms = getattr(self, 'd_norms', {})
+        doc_ids = np.unique(np.fromiter(itertools.chain(dl, d_norms), dtype=np.int64))
+        np.save(path / 'doc_ids.npy', doc_ids)
+        for column, values in (('dl', dl), ('norm', d_norms)):
+            dtype, missing = COLUMNS[column]
+            col = np.full(len(doc_ids), missing, dtype=dtype)
+            keys = np.fromiter(values.keys(), dtype=np.int64, count=len(values))
+            col[np.searchsorted(doc_ids, keys)] = np.fromiter(values.values(), dtype=dtype, count=len(values))
+            np.save(path / f'{column}.npy', col)
+        n_docs = len(dl)
+        header = {
+            'n_terms': len(lexicon),
+            'n_docs': n_docs,
+            'avgdl': sum(dl.values()) / n_docs if n_docs else 0.0,
+            'corpus_size': getattr(self, 'corpus_size', n_docs),
+            'posting_order': self.posting_order,
+            'posting_format': self.posting_format,
+            'bm25_bounds_params': self.bm25_bounds_params,
+            'global_n_docs': self.global_n_docs,
+            'global_avgdl': self.global_avgdl,
+            'file_names': lexicon.file_names,
+            'block_size': lexicon.block_size,
+        }
+        # written last: its presence marks a complete directory
+        with open(path / 'header.json.tmp', 'w') as f:
+            json.dump(header, f)
+        os.replace(path / 'header.json.tmp', path / 'header.json')
+
     def __getstate__(self):
         """ Modify how the object is pickled by removing the internal posting lists
             from the object's state dictionary. 
@@ -152,19 +574,23 @@ class InvertedIndex:
         del state['_posting_list']
         return state
 
-    def posting_lists_iter(self):
+    def read_size(self, w, n):
+        """ The number of bytes to read to decode the first `n` postings of `w`. """
+        if self.posting_format == FORMAT_RAW:
+            return n * TUPLE_SIZE
+        if n >= self.df[w]:
+            return self.posting_bytes[w]
+        return min(self.posting_bytes[w], n * MAX_VBYTE_TUPLE_SIZE)
+
+    def posting_lists_iter(self, index_dir, storage=None):
         """ A generator that reads one posting list from disk and yields 
             a (word:str, [(doc_id:int, tf:int), ...]) tuple.
         """
-        with closing(MultiFileReader()) as reader:
-            for w, locs in self.posting_locs.items():
-                b = reader.read(locs[0], self.df[w] * TUPLE_SIZE)
-                posting_list = []
-                for i in range(self.df[w]):
-                    doc_id = int.from_bytes(b[i*TUPLE_SIZE:i*TUPLE_SIZE+4], 'big')
-                    tf = int.from_bytes(b[i*TUPLE_SIZE+4:(i+1)*TUPLE_SIZE], 'big')
-                    posting_list.append((doc_id, tf))
-                yield w, posting_list
+        reader = MultiFileReader(storage)
+        for w, locs in self.posting_locs.items():
+            b = reader.read(locs, self.read_size(w, self.df[w]), index_dir)
+            doc_ids, tfs = decode_postings(b, self.df[w], self.posting_format)
+            yield w, list(zip(doc_ids.tolist(), tfs.tolist()))
 
     @staticmethod
     def read_index(base_dir, name):
@@ -180,31 +606,306 @@ class InvertedIndex:
 
 
     @staticmethod
-    def write_a_posting_list(b_w_pl, bucket_name):
-        posting_locs = defaultdict(list)
+    def write_a_posting_list(b_w_pl, bucket_name, base_dir=".", order=None,
+                             fmt=FORMAT_RAW, bm25_bounds=None, **impact_kwargs):
+        """ Write the posting lists of one hash bucket to `base_dir` and, unless
+            `bucket_name` is None, upload them to google storage. When `order`
+            is given every list is first sorted with `sort_posting_list` (pass
+            `dl`/`avgdl` for ORDER_BM25 and `prior` for ORDER_PRIOR); record
+            the same value in the index's `posting_order`. The lists are
+            encoded in posting format `fmt` (record it in `posting_format`);
+            for FORMAT_VBYTE the byte size of every list is saved next to the
+            posting locations, in `{bucket_id}_posting_bytes.pickle`. When
+            `bm25_bounds` is given (a dict of `bm25_block_maxima` kwargs: dl,
+            avgdl, k1, b) the BM25 block maxima of every list are saved in
+            `{bucket_id}_bm25_block_max.pickle`.
+        """
         bucket_id, list_w_pl = b_w_pl
-        
-        with closing(MultiFileWriter(".", bucket_id, bucket_name)) as writer:
-            for w, pl in list_w_pl: 
-                # convert to bytes
-                b = b''.join([(doc_id << 16 | (tf & TF_MASK)).to_bytes(TUPLE_SIZE, 'big')
-                              for doc_id, tf in pl])
-                # write to file(s)
-                locs = writer.write(b)
-                # save file locations to index
-                posting_locs[w].extend(locs)
-            writer.upload_to_gcp() 
-            InvertedIndex._upload_posting_locs(bucket_id, posting_locs, bucket_name)
+        posting_locs, posting_bytes, block_max = InvertedIndex.write_posting_lists(
+            bucket_id, list_w_pl, bucket_name, base_dir, order=order, fmt=fmt,
+            bm25_bounds=bm25_bounds, **impact_kwargs)
+        InvertedIndex._upload_posting_locs(bucket_id, posting_locs, bucket_name, base_dir)
+        if fmt != FORMAT_RAW:
+            InvertedIndex._upload_posting_locs(bucket_id, posting_bytes, bucket_name, base_dir,
+                                               kind="posting_bytes")
+        if bm25_bounds is not None:
+            InvertedIndex._upload_posting_locs(bucket_id, block_max, bucket_name, base_dir,
+                                               kind="bm25_block_max")
         return bucket_id
 
     
     @staticmethod
-    def _upload_posting_locs(bucket_id, posting_locs, bucket_name):
-        with open(f"{bucket_id}_posting_locs.pickle", "wb") as f:
+    def write_posting_lists(bucket_id, list_w_pl, bucket_name, base_dir=".", order=None,
+                            fmt=FORMAT_RAW, bm25_bounds=None, prefix='postings_gcp', **impact_kwargs):
+        """ Write the (w, [(doc_id, tf), ...]) pairs of `list_w_pl` (any
+            iterable, consumed once) as the posting files of bucket `bucket_id`,
+            like `write_a_posting_list`, and return their metadata instead of
+            saving it: the posting locations, the encoded byte size and (with
+            `bm25_bounds`) the BM25 block maxima of every list, as dicts.
+            The files are uploaded under `prefix` of the bucket.
+        """
+        with closing(PostingListWriter(base_dir, bucket_id, bucket_name, order, fmt, bm25_bounds, prefix,
+                                       **impact_kwargs)) as writer:
+            for w, pl in list_w_pl:
+                writer.add(w, pl)
+        return writer.posting_locs, writer.posting_bytes, writer.block_max
+
+    @staticmethod
+    def _upload_posting_locs(bucket_id, posting_locs, bucket_name, base_dir=".", kind="posting_locs"):
+        path = Path(base_dir) / f"{bucket_id}_{kind}.pickle"
+        with open(path, "wb") as f:
             pickle.dump(posting_locs, f)
+        if bucket_name is None:
+            return
         client = storage.Client()
         bucket = client.bucket(bucket_name)
-        blob_posting_locs = bucket.blob(f"postings_gcp/{bucket_id}_posting_locs.pickle")
-        blob_posting_locs.upload_from_filename(f"{bucket_id}_posting_locs.pickle")
+        blob_posting_locs = bucket.blob(f"postings_gcp/{bucket_id}_{kind}.pickle")
+        blob_posting_locs.upload_from_filename(str(path))
     
 
+
+def shard_of(doc_id, n_shards):
+    """ The shard holding `doc_id` when the documents are partitioned into
+        `n_shards` shards (works on arrays of doc ids too).
+    """
+    return doc_id % n_shards
+
+
+def shard_dirs(out, n_shards):
+    """ The directories of the shards of a corpus (the corpus' own for one shard). """
+    if n_shards == 1:
+        return [Path(out)]
+    return [Path(out) / f'shard_{i}' for i in range(n_shards)]
+
+
+def set_global_stats(shard_indexes):
+    """ Record the corpus-wide statistics in every shard index of a field
+        (the same field of all the shards, their `dl` set): the df of each of
+        its terms summed over the shards, and the number of documents and
+        average document length of the whole corpus.
+    """
+    df = Counter()
+    for index in shard_indexes:
+        df.update(index.df)
+    n_docs = sum(len(index.dl) for index in shard_indexes)
+    total_dl = sum(sum(index.dl.values()) for index in shard_indexes)
+    for index in shard_indexes:
+        index.global_df = {w: df[w] for w in index.df}
+        index.global_n_docs = n_docs
+        index.global_avgdl = total_dl / n_docs if n_docs else 0.0
+
+
+def _starts(lengths):
+    """ The [start, end) boundaries of consecutive runs of `lengths`. """
+    starts = np.zeros(len(lengths) + 1, dtype=np.uint64)
+    starts[1:] = np.cumsum(lengths)
+    return starts
+
+
+class _SortedTerms:
+    """ The sorted UTF-8 terms of a `MappedIndex`, looked up by binary search. """
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return self._blob[self._offsets[i]:self._offsets[i + 1]].tobytes()
+
+    def row(self, term):
+        """ The row of `term`, or -1 when it is not in the index. """
+        b = term.encode('utf-8')
+        i = bisect_left(self, b)
+        return i if i < len(self) and self[i] == b else -1
+
+
+# One packed record per term, see `Lexicon`.
+LEXICON_DTYPE = np.dtype([('df', '<u4'), ('file_id', '<u4'), ('offset', '<u8'),
+                          ('n_bytes', '<u8'), ('max_score', '<f4')])
+
+
+def _file_order(f_name):
+    """ Sort key putting the posting files of a bucket in writing order. """
+    stem, _, i = Path(f_name).stem.rpartition('_')
+    return (stem, int(i)) if i.isdigit() else (f_name, -1)
+
+
+class Lexicon:
+    """ The vocabulary of an index, sorted by UTF-8 bytes; a term's id is its
+        rank. `records[term_id]` packs where the term's posting list starts
+        (`file_id` into `file_names`, `offset`), its df, its encoded size in
+        bytes and its max_score, the largest BM25 tf component in the list
+        (an upper bound for pruning, 0 when the index has no BM25 bounds).
+        A list longer than the rest of its file continues at offset 0 of the
+        next file, as `MultiFileWriter` writes them, so one location per term
+        is enough. Terms sharing a prefix, or within a range, have
+        consecutive ids, so both lookups are two binary searches.
+    """
+    def __init__(self, terms, records, file_names, block_size=None):
+        self._terms = terms
+        self.records = records
+        self.file_names = file_names
+        self.block_size = block_size if block_size is not None else BLOCK_SIZE
+
+    def __len__(self):
+        return len(self._terms)
+
+    def __contains__(self, term):
+        return self.term_id(term) >= 0
+
+    def term_id(self, term):
+        """ The id of `term`, or -1 when it is not in the lexicon. """
+        return self._terms.row(term)
+
+    def term(self, term_id):
+        return self._terms[term_id].decode('utf-8')
+
+    def terms(self, term_ids):
+        return [self.term(i) for i in term_ids]
+
+    def prefix(self, prefix):
+        """ The ids of the terms starting with `prefix`, as a range. """
+        b = prefix.encode('utf-8')
+        # 0xff never occurs in UTF-8, so it sorts after every continuation
+        return range(bisect_left(self._terms, b), bisect_left(self._terms, b + b'\xff'))
+
+    def range(self, lo=None, hi=None):
+        """ The ids of the terms in [`lo`, `hi`), either bound optional. """
+        start = 0 if lo is None else bisect_left(self._terms, lo.encode('utf-8'))
+        stop = len(self) if hi is None else bisect_left(self._terms, hi.encode('utf-8'))
+        return range(start, max(start, stop))
+
+    def locs(self, term_id):
+        """ The (file_name, offset) locations of the posting list of `term_id`. """
+        record = self.records[term_id]
+        file_id, offset, remaining = int(record['file_id']), int(record['offset']), int(record['n_bytes'])
+        locs = []
+        while remaining > 0:
+            locs.append((self.file_names[file_id], offset))
+            remaining -= self.block_size - offset
+            file_id, offset = file_id + 1, 0
+        return locs
+
+    @classmethod
+    def from_index(cls, index):
+        """ Build the lexicon of an in-memory `InvertedIndex`. """
+        encoded = sorted(w.encode('utf-8') for w in index.df)
+        terms = [b.decode('utf-8') for b in encoded]
+        file_names = sorted({f_name for locs in index.posting_locs.values() for f_name, _ in locs},
+                            key=_file_order)
+        file_ids = {f_name: i for i, f_name in enumerate(file_names)}
+        records = np.zeros(len(terms), dtype=LEXICON_DTYPE)
+        lexicon = cls(_SortedTerms(np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                                   _starts([len(b) for b in encoded])),
+                      records, file_names)
+        for term_id, w in enumerate(terms):
+            locs = index.posting_locs.get(w, [])
+            record = records[term_id]
+            record['df'] = index.df[w]
+            record['n_bytes'] = index.read_size(w, index.df[w]) if locs else 0
+            if locs:
+                record['file_id'], record['offset'] = file_ids[locs[0][0]], locs[0][1]
+            block_max = index.bm25_block_max.get(w)
+            if block_max is not None and len(block_max) > 0:
+                record['max_score'] = np.max(block_max)
+            if lexicon.locs(term_id) != [(f_name, offset) for f_name, offset in locs]:
+                raise ValueError(f'posting list of {w!r} is not laid out as MultiFileWriter writes')
+        return lexicon
+
+    def save(self, path):
+        np.save(path / 'terms.npy', self._terms._blob)
+        np.save(path / 'term_offsets.npy', self._terms._offsets)
+        np.save(path / 'lexicon.npy', self.records)
+
+    @classmethod
+    def load(cls, path, file_names, block_size=None):
+        """ Memory-map the lexicon saved in `path`. """
+        return cls(_SortedTerms(np.load(path / 'terms.npy', mmap_mode='r'),
+                                np.load(path / 'term_offsets.npy', mmap_mode='r')),
+                   np.load(path / 'lexicon.npy', mmap_mode='r'), file_names, block_size)
+
+
+class _TermColumn(Mapping):
+    """ A read-only term -> value view over the rows of a `MappedIndex`. """
+    def __init__(self, terms, value):
+        self._terms = terms
+        self._value = value
+
+    def __getitem__(self, term):
+        row = self._terms.row(term)
+        if row < 0:
+            raise KeyError(term)
+        return self._value(row)
+
+    def __iter__(self):
+        return (self._terms[i].decode('utf-8') for i in range(len(self._terms)))
+
+    def __len__(self):
+        return len(self._terms)
+
+
+class MappedIndex(InvertedIndex):
+    """ A read-only index opened from the directory written by `write_index`.
+        Every array is memory-mapped, so opening it only parses the header
+        and pages are read in when a term or a document is first looked up.
+        `df`, `term_total`, `posting_locs`, `posting_bytes` and
+        `bm25_block_max` are term -> value views (over `lexicon` for the
+        first ones) and `dl` / `d_norms` are `DocColumn`s, so the index serves
+        everywhere an `InvertedIndex` does.
+        `n_docs`, `avgdl` and `corpus_size` come precomputed from the header,
+        as do the global statistics of a shard (with `global_df` by term id).
+    """
+    def __init__(self, path):
+        path = Path(path)
+        with open(path / 'header.json') as f:
+            header = json.load(f)
+
+        def load(name):
+            return np.load(path / f'{name}.npy', mmap_mode='r')
+
+        self.n_docs = header['n_docs']
+        self.avgdl = header['avgdl']
+        self.corpus_size = header['corpus_size']
+        self.posting_order = header['posting_order']
+        self.posting_format = header['posting_format']
+        params = header['bm25_bounds_params']
+        self.bm25_bounds_params = tuple(params) if params is not None else None
+        self.global_n_docs = header.get('global_n_docs')
+        self.global_avgdl = header.get('global_avgdl')
+        self.lexicon = Lexicon.load(path, header['file_names'], header['block_size'])
+        terms, records = self.lexicon._terms, self.lexicon.records
+        term_total = load('term_total')
+        self.df = _TermColumn(terms, lambda row: int(records[row]['df']))
+        self.term_total = _TermColumn(terms, lambda row: int(term_total[row]))
+        self.posting_locs = _TermColumn(terms, self.lexicon.locs)
+        if self.posting_format != FORMAT_RAW:
+            self.posting_bytes = _TermColumn(terms, lambda row: int(records[row]['n_bytes']))
+        if (path / 'bm25_block_max.npy').exists():
+            bm25_start, bm25_block_max = load('bm25_start'), load('bm25_block_max')
+            self.bm25_block_max = _TermColumn(
+                terms, lambda row: np.asarray(bm25_block_max[bm25_start[row]:bm25_start[row + 1]]))
+        if (path / 'global_df.npy').exists():
+            global_df = load('global_df')
+            self.global_df = _TermColumn(terms, lambda row: int(global_df[row]))
+        doc_ids = load('doc_ids')
+        self.dl = DocColumn(doc_ids, load('dl'), COLUMNS['dl'][1])
+        self.d_norms = DocColumn(doc_ids, load('norm'), COLUMNS['norm'][1])
+
+    def add_doc(self, doc_id, tokens):
+        raise TypeError('MappedIndex is read-only')
+
+    @staticmethod
+    def exists(path):
+        return (Path(path) / 'header.json').exists()
+
+
+def open_index(storage, name):
+    """ Open the index `name` from `storage`: memory-mapped when its `name`/
+        directory exists, otherwise by unpickling `name`.pkl.
+    """
+    path = storage.local_dir(name)
+    if MappedIndex.exists(path):
+        return MappedIndex(path)
+    return pickle.loads(storage.read_blob(f'{name}.pkl'))
@@ -0,0 +1,247 @@
+""" Open-loop load test of the search endpoints with a QPS ramp.
+
+    python load_test.py --index-dir bench_corpus --qps 10 20 50 100 200 [--step-seconds 20]
+                        [--mix search=4,search_body=2,search_title=2,search_anchor=2]
+                        [--concurrency 64] [--timeout 5] [--json load.json]
+
+With --index-dir it starts the server itself (gunicorn with gunicorn.conf.py,
+or the Flask server with --server flask) on the indexes of that directory
+(IR_STORAGE=local), waits for /readyz and stops it at the end; --url targets
+a server that is already running instead.
+
+Requests arrive open-loop: at every step of the ramp they are sent at Poisson
+arrival times of the offered rate whether or not the earlier ones have been
+answered, by up to --concurrency threads. Latencies are measured from the
+scheduled send time, so the time a request waits for a free thread counts
+(no coordinated omission). Every step reports the achieved throughput, the
+p50/p95/p99 latency overall and per endpoint, and the error and timeout
+rates. The saturation point is the first step at which the server no longer
+keeps up: it completes less than 90% of the offered rate, its p99 exceeds
+--slo-ms, or more than 1% of the requests fail.
+
+The queries come from --queries, a JSON list of query strings or a
+{query: relevant ids} dict such as queries_train.json, by default the
+queries.json of --index-dir (see bench_offline.py).
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import requests
+
+ENDPOINTS = ('search', 'search_body', 'search_title', 'search_anchor')
+# the server is saturated below this fraction of the offered rate
+MIN_THROUGHPUT_RATIO = 0.9
+# or above this fraction of failed requests
+MAX_ERROR_RATE = 0.01
+
+
+def parse_mix(text):
+    """ 'search=4,search_body=1' -> {'search': 0.8, 'search_body': 0.2} """
+    weights = {}
+    for part in text.split(','):
+        endpoint, _, weight = part.partition('=')
+        if endpoint not in ENDPOINTS:
+            raise ValueError(f'unknown endpoint in --mix: {endpoint!r}')
+        weights[endpoint] = float(weight or 1)
+    total = sum(weights.values())
+    return {endpoint: w / total for endpoint, w in weights.items()}
+
+
+def load_queries(path):
+    with open(path) as f:
+        queries = json.load(f)
+    return list(queries.keys()) if isinstance(queries, dict) else list(queries)
+
+
+def start_server(index_dir, port, server, workers):
+    """ Start serving `index_dir` on `port` in a subprocess and wait until it is ready. """
+    env = dict(os.environ, IR_STORAGE='local', IR_LOCAL_DIR=str(Path(index_dir).resolve()),
+               IR_BIND=f'127.0.0.1:{port}', IR_RELOAD_INTERVAL='0')
+    if workers is not None:
+        env['IR_WORKERS'] = str(workers)
+    here = Path(__file__).resolve().parent
+    if server == 'gunicorn':
+        cmd = [sys.executable, '-m', 'gunicorn', '-c', str(here / 'gunicorn.conf.py'), 'wsgi:app']
+    else:
+        cmd = [sys.executable, '-c',
+               'import logging; logging.getLogger("werkzeug").setLevel(logging.WARNING); '
+               f'from search_frontend import app; app.run(host="127.0.0.1", port={port}, threaded=True)']
+    proc = subprocess.Popen(cmd, cwd=here, env=env)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 300
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'the server exited with status {proc.returncode}')
+        try:
+            if requests.get(f'{url}/readyz', timeout=1).status_code == 200:
+                return proc, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    proc.terminate()
+    raise RuntimeError('the server did not become ready in 300s')
+
+
+class Recorder:
+    """ The outcome of every request of a step: (endpoint, latency, status)
+        with status 'ok', 'error' or 'timeout'.
+    """
+    def __init__(self):
+        self.results = []
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, latency, status):
+        with self._lock:
+            self.results.append((endpoint, latency, status))
+
+
+def percentiles(latencies):
+    if len(latencies) == 0:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99)}
+
+
+def run_step(url, qps, seconds, mix, queries, pool, timeout, rng):
+    """ Offer `qps` requests per second for `seconds`; returns the step's stats. """
+    recorder = Recorder()
+    local = threading.local()
+    endpoints = list(mix)
+    n = rng.poisson(qps * seconds)
+    # arrival times (uniform order statistics of a Poisson process), endpoints and queries
+    arrivals = np.sort(rng.uniform(0, seconds, size=n))
+    picks = rng.choice(len(endpoints), size=n, p=[mix[e] for e in endpoints])
+    query_ids = rng.integers(0, len(queries), size=n)
+
+    def send(scheduled, endpoint, query):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        try:
+            res = session.get(f'{url}/{endpoint}', params={'query': query}, timeout=timeout)
+            status = 'ok' if res.status_code == 200 else 'error'
+        except requests.Timeout:
+            status = 'timeout'
+        except requests.RequestException:
+            status = 'error'
+        latency = time.perf_counter() - scheduled
+        if status == 'ok' and latency > timeout:
+            # answered, but after waiting too long for a free thread
+            status = 'timeout'
+        recorder.add(endpoint, latency, status)
+
+    start = time.perf_counter()
+    futures = []
+    for t, e, q in zip(arrivals.tolist(), picks.tolist(), query_ids.tolist()):
+        delay = start + t - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        futures.append(pool.submit(send, start + t, endpoints[e], queries[q]))
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - start
+
+    ok = [latency for _, latency, status in recorder.results if status == 'ok']
+    stats = {'offered_qps': qps, 'requests': n,
+             'achieved_qps': len(ok) / max(elapsed, seconds),
+             'error_rate': sum(s == 'error' for _, _, s in recorder.results) / max(n, 1),
+             'timeout_rate': sum(s == 'timeout' for _, _, s in recorder.results) / max(n, 1),
+             **percentiles(ok), 'endpoints': {}}
+    for endpoint in endpoints:
+        latencies = [latency for e, latency, status in recorder.results if e == endpoint and status == 'ok']
+        stats['endpoints'][endpoint] = {'requests': sum(e == endpoint for e, _, _ in recorder.results),
+                                        **percentiles(latencies)}
+    return stats
+
+
+def is_saturated(stats, slo_ms):
+    if stats['requests'] == 0:
+        return False
+    if stats['achieved_qps'] < MIN_THROUGHPUT_RATIO * stats['offered_qps']:
+        return True
+    if stats['error_rate'] + stats['timeout_rate'] > MAX_ERROR_RATE:
+        return True
+    return slo_ms is not None and stats['p99_ms'] is not None and stats['p99_ms'] > slo_ms
+
+
+def fmt_ms(value):
+    return f'{value:>8.1f}' if value is not None else f"{'-':>8}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help='a running server, e.g. http://127.0.0.1:8080')
+    target.add_argument('--index-dir', help='start a server on the indexes of this directory')
+    parser.add_argument('--server', choices=('gunicorn', 'flask'), default='gunicorn')
+    parser.add_argument('--workers', type=int, help='IR_WORKERS of the started gunicorn server')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--queries', help='JSON list or dict of queries (default: INDEX_DIR/queries.json)')
+    parser.add_argument('--qps', type=float, nargs='+', default=[5, 10, 20, 50, 100, 200],
+                        help='the offered rate of every step of the ramp')
+    parser.add_argument('--step-seconds', type=float, default=20)
+    parser.add_argument('--mix', default=','.join(ENDPOINTS), type=parse_mix,
+                        help='endpoint=weight,... (default: all four equally)')
+    parser.add_argument('--concurrency', type=int, default=64, help='the most requests in flight')
+    parser.add_argument('--timeout', type=float, default=5, help='seconds before a request counts as timed out')
+    parser.add_argument('--slo-ms', type=float, help='p99 above this is saturation')
+    parser.add_argument('--keep-going', action='store_true', help='run the whole ramp past the saturation point')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    queries_path = args.queries or (Path(args.index_dir) / 'queries.json' if args.index_dir else None)
+    if queries_path is None:
+        parser.error('--queries is required with --url')
+    queries = load_queries(queries_path)
+    proc = None
+    if args.index_dir:
+        proc, url = start_server(args.index_dir, args.port, args.server, args.workers)
+    else:
+        url = args.url.rstrip('/')
+    rng = np.random.default_rng(args.seed)
+    steps, saturation = [], None
+    try:
+        with ThreadPoolExecutor(args.concurrency, thread_name_prefix='load') as pool:
+            print(f"{'offered':>8} {'achieved':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+                  f"{'errors':>7} {'timeouts':>8}")
+            for qps in args.qps:
+                stats = run_step(url, qps, args.step_seconds, args.mix, queries, pool, args.timeout, rng)
+                steps.append(stats)
+                print(f"{qps:>8.1f} {stats['achieved_qps']:>8.1f} {fmt_ms(stats['p50_ms'])} "
+                      f"{fmt_ms(stats['p95_ms'])} {fmt_ms(stats['p99_ms'])} "
+                      f"{stats['error_rate']:>7.1%} {stats['timeout_rate']:>8.1%}")
+                for endpoint, e in stats['endpoints'].items():
+                    print(f"  {endpoint:<14} {e['requests']:>6} {fmt_ms(e['p50_ms'])} "
+                          f"{fmt_ms(e['p95_ms'])} {fmt_ms(e['p99_ms'])}")
+                if saturation is None and is_saturated(stats, args.slo_ms):
+                    saturation = qps
+                    if not args.keep_going:
+                        break
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+    sustained = [s['offered_qps'] for s in steps if saturation is None or s['offered_qps'] < saturation]
+    if saturation is None:
+        print(f'not saturated up to {steps[-1]["offered_qps"]:.1f} QPS')
+    else:
+        print(f'saturated at {saturation:.1f} QPS'
+              + (f', sustained {max(sustained):.1f} QPS' if sustained else ''))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'url': url, 'mix': args.mix, 'concurrency': args.concurrency, 'timeout': args.timeout,
+                       'slo_ms': args.slo_ms, 'steps': steps, 'saturation_qps': saturation,
+                       'sustained_qps': max(sustained) if sustained else None}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,450 @@
+""" A bounded-memory build of the inverted indexes without Spark (SPIMI with an external merge).
+
+    python local_index.py --parquet dumps/*.parquet --out-dir indexes [--indexes body_idx]
+                          [--memory-mb 1024] [--workers 8] [--fmt 1 --order bm25 --bm25-bounds]
+                          [--shards 4]
+    python local_index.py --check
+
+streams the `id`, `title`, `text` and `anchor_text` columns of the Wikipedia
+parquet dumps (local paths or gs:// ones) batch by batch and tokenizes every
+batch in a pool of worker processes. The postings of the tokenized batches
+are collected in memory, per term, until their estimated size reaches
+--memory-mb; the block is then sorted by term and spilled to a run file.
+At the end the runs are k-way merged term by term, which writes the final
+posting files with `InvertedIndex.write_posting_lists` and, from the merged
+lists, the df, term totals and tf-idf norms (no second pass over the
+corpus). Only the postings are bounded: the per-term and per-document
+dictionaries of the index are kept in memory, as the index holds them.
+
+The output is the layout search_frontend serves with IR_STORAGE=local: the
+posting files under `--out-dir`/body_idx/, index_body_idx.pkl and its mapped
+directory, with the statistics of create_index (the same parameters as
+spark_index.py). With --shards N the merged posting lists are split by
+`shard_of` into N indexes, shard i under `--out-dir`/shard_i/, which keep
+the terms of the corpus-wide df and carry the corpus statistics (see
+coordinator.py). Every index reports its docs/sec, the runs it spilled and
+the peak RSS of the builder and of its workers. --check builds a small
+generated anchor index through several runs, whole and in shards, and
+compares it with the index built in memory.
+"""
+import argparse
+import heapq
+import json
+import os
+import pickle
+import resource
+import shutil
+import struct
+import tempfile
+from array import array
+from collections import Counter, defaultdict, deque
+from contextlib import ExitStack, closing
+from itertools import groupby
+from multiprocessing import Pool
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from backend import tokenize
+from inverted_index_gcp import (InvertedIndex, PostingListWriter, FORMAT_RAW, ORDER_BM25, ORDER_PRIOR,
+                                shard_of, shard_dirs, set_global_stats)
+from spark_index import INDEXES
+
+# the estimated in-memory size of a block: bytes per posting and per term
+POSTING_BYTES = 8
+TERM_BYTES = 250
+# a run file entry: term length, number of postings, then the term and the
+# doc ids and tfs as uint32 arrays
+RUN_HEADER = struct.Struct('<HI')
+
+
+def read_batches(paths, index_on, batch_size):
+    """ The (doc_id, text) pairs of the `index_on` field ("title", "text" or
+        "anchor") of the parquet files, in lists of about `batch_size` rows;
+        for "anchor", one pair per link, with the id of the linked document.
+    """
+    columns = ['anchor_text'] if index_on == 'anchor' else ['id', index_on]
+    fs = None
+    for path in paths:
+        if str(path).startswith('gs://'):
+            if fs is None:
+                import gcsfs
+                fs = gcsfs.GCSFileSystem()
+            f = fs.open(str(path), 'rb')
+        else:
+            f = open(path, 'rb')
+        with f:
+            for batch in pq.ParquetFile(f).iter_batches(batch_size=batch_size, columns=columns):
+                if index_on == 'anchor':
+                    yield [(link['id'], link['text']) for links in batch.column('anchor_text').to_pylist()
+                           for link in links or ()]
+                else:
+                    yield [(doc_id, text) for doc_id, text in zip(batch.column('id').to_pylist(),
+                                                                  batch.column(index_on).to_pylist())
+                           if text is not None]
+
+
+def count_rows(paths):
+    """ The number of documents (rows) of the parquet files. """
+    n = 0
+    for path in paths:
+        if str(path).startswith('gs://'):
+            import gcsfs
+            with gcsfs.GCSFileSystem().open(str(path), 'rb') as f:
+                n += pq.ParquetFile(f).metadata.num_rows
+        else:
+            n += pq.ParquetFile(path).metadata.num_rows
+    return n
+
+
+def tokenize_batch(pairs):
+    """ The postings of a batch of (doc_id, text) pairs, in a worker, as flat
+        arrays (cheap to send back): the terms, the start of every term's
+        postings in the doc id and tf arrays plus their end, and the doc ids
+        with their number of tokens, several pairs of the same document
+        counted as one.
+    """
+    counts = defaultdict(Counter)
+    for doc_id, text in pairs:
+        counts[doc_id].update(tokenize(text))
+    postings = defaultdict(list)
+    for doc_id, c in counts.items():
+        for term, tf in c.items():
+            postings[term].append((doc_id, tf))
+    terms = list(postings)
+    flat = [p for term in terms for p in postings[term]]
+    starts = np.zeros(len(terms) + 1, dtype=np.int64)
+    starts[1:] = np.cumsum([len(postings[term]) for term in terms])
+    postings = np.array(flat, dtype=np.uint32).reshape(-1, 2)
+    doc_ids = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    dl = np.fromiter((sum(c.values()) for c in counts.values()), dtype=np.int64, count=len(counts))
+    return terms, starts, postings[:, 0].copy(), postings[:, 1].copy(), doc_ids, dl
+
+
+def combine_postings(doc_ids, tfs):
+    """ The postings of a term by increasing doc id, the tfs of a document
+        that occurs more than once summed.
+    """
+    order = np.argsort(doc_ids, kind='stable')
+    doc_ids, tfs = doc_ids[order], tfs[order]
+    if len(doc_ids) > 1 and np.any(doc_ids[1:] == doc_ids[:-1]):
+        doc_ids, starts = np.unique(doc_ids, return_index=True)
+        tfs = np.add.reduceat(tfs, starts, dtype=tfs.dtype)
+    return doc_ids, tfs
+
+
+def write_run(block, path):
+    """ Spill an in-memory block ({term: (doc_ids, tfs)}) to a run file, by term. """
+    with open(path, 'wb') as f:
+        for term in sorted(block):
+            doc_ids, tfs = block[term]
+            doc_ids, tfs = combine_postings(np.frombuffer(doc_ids, dtype=np.uint32),
+                                            np.frombuffer(tfs, dtype=np.uint32))
+            encoded = term.encode('utf-8')
+            f.write(RUN_HEADER.pack(len(encoded), len(doc_ids)))
+            f.write(encoded)
+            f.write(doc_ids.astype('<u4').tobytes())
+            f.write(tfs.astype('<u4').tobytes())
+
+
+def read_run(path):
+    """ The (term, doc_ids, tfs) entries of a run file, in term order. """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RUN_HEADER.size)
+            if not header:
+                return
+            term_len, n = RUN_HEADER.unpack(header)
+            term = f.read(term_len).decode('utf-8')
+            doc_ids = np.frombuffer(f.read(4 * n), dtype='<u4')
+            tfs = np.frombuffer(f.read(4 * n), dtype='<u4')
+            yield term, doc_ids, tfs
+
+
+def peak_rss_mb():
+    """ The peak resident set size of this process and of its (finished)
+        children, in MB.
+    """
+    # ru_maxrss is in kilobytes on Linux
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return self_kb / 1024, children_kb / 1024
+
+
+class SpimiIndexer:
+    """ Collects the postings of tokenized batches in memory and spills them
+        to a sorted run file in `run_dir` whenever their estimated size
+        reaches `memory_bytes`.
+    """
+    def __init__(self, run_dir, memory_bytes):
+        self.run_dir = Path(run_dir)
+        self.memory_bytes = memory_bytes
+        self.runs = []
+        self._block = {}
+        self._block_bytes = 0
+        self._doc_ids = []
+        self._dl = []
+
+    def add(self, terms, starts, batch_doc_ids, batch_tfs, doc_ids, dl):
+        """ Add the postings of a tokenized batch (see `tokenize_batch`). """
+        for term, start, end in zip(terms, starts[:-1].tolist(), starts[1:].tolist()):
+            entry = self._block.get(term)
+            if entry is None:
+                entry = self._block[term] = (array('I'), array('I'))
+                self._block_bytes += TERM_BYTES
+            entry[0].frombytes(batch_doc_ids[start:end].tobytes())
+            entry[1].frombytes(batch_tfs[start:end].tobytes())
+        self._block_bytes += POSTING_BYTES * len(batch_doc_ids)
+        self._doc_ids.append(doc_ids)
+        self._dl.append(dl)
+        if self._block_bytes >= self.memory_bytes:
+            self.spill()
+
+    def spill(self):
+        if not self._block:
+            return
+        path = self.run_dir / f'run_{len(self.runs):05}.bin'
+        write_run(self._block, path)
+        self.runs.append(path)
+        self._block = {}
+        self._block_bytes = 0
+
+    def doc_lengths(self):
+        """ The sorted doc ids and their lengths, the parts of a document summed. """
+        if not self._doc_ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        doc_ids, dl = combine_postings(np.concatenate(self._doc_ids), np.concatenate(self._dl))
+        return doc_ids, dl
+
+    def merged(self):
+        """ The (term, doc_ids, tfs) of every term over all the runs, by term. """
+        self.spill()
+        entries = heapq.merge(*(read_run(path) for path in self.runs), key=lambda e: e[0])
+        for term, group in groupby(entries, key=lambda e: e[0]):
+            group = list(group)
+            if len(group) == 1:
+                yield group[0]
+                continue
+            yield (term, *combine_postings(np.concatenate([doc_ids for _, doc_ids, _ in group]),
+                                           np.concatenate([tfs for _, _, tfs in group])))
+
+
+def tokenize_all(batches, indexer, workers):
+    """ Tokenize the batches in a pool of `workers` processes, at most two
+        batches per worker in flight, into `indexer`; returns the number of
+        (doc_id, text) pairs read.
+    """
+    n_pairs = 0
+    with Pool(workers) as pool:
+        pending = deque()
+        for batch in batches:
+            n_pairs += len(batch)
+            pending.append(pool.apply_async(tokenize_batch, (batch,)))
+            while len(pending) >= 2 * workers:
+                indexer.add(*pending.popleft().get())
+        while pending:
+            indexer.add(*pending.popleft().get())
+    return n_pairs
+
+
+def build_index(paths, name, index_on, out_dir, filter_size, corpus_size=None, memory_mb=1024, workers=None,
+                batch_size=1000, order=None, prior=None, fmt=FORMAT_RAW, bm25_bounds=False, k1=1.5, b=0.75,
+                tmp_dir=None, shards=1):
+    """ Build the `name` index (e.g. "body_idx") of the `index_on` field of
+        the parquet files into `out_dir`, with the parameters of
+        spark_index.build_index, holding at most about `memory_mb` of
+        postings in memory. With `shards` > 1 every merged posting list is
+        split by `shard_of` between that many indexes, shard i written to
+        shard_i/ of `out_dir`, with the corpus-wide statistics as there.
+        Returns the index (the list of shard indexes with `shards` > 1) and
+        the build statistics.
+    """
+    out_dir = Path(out_dir)
+    t_start = perf_counter()
+    run_dir = Path(tempfile.mkdtemp(prefix=f'{name}_runs_', dir=tmp_dir))
+    try:
+        indexer = SpimiIndexer(run_dir, memory_mb * 2 ** 20)
+        n_pairs = tokenize_all(read_batches(paths, index_on, batch_size), indexer, workers or os.cpu_count())
+        t_tokenized = perf_counter()
+        doc_ids, doc_lens = indexer.doc_lengths()
+        dl = dict(zip(doc_ids.tolist(), doc_lens.tolist()))
+        avgdl = sum(dl.values()) / len(dl) if dl else 0.0
+        n_docs = corpus_size or len(dl)
+        impact_kwargs = {'dl': dl, 'avgdl': avgdl} if order == ORDER_BM25 else \
+            {'prior': prior} if order == ORDER_PRIOR else {}
+        bounds = {'dl': dl, 'avgdl': avgdl, 'k1': k1, 'b': b} if bm25_bounds else None
+
+        dirs = shard_dirs(out_dir, shards)
+        indexes = [InvertedIndex() for _ in dirs]
+        norm2 = np.zeros(len(doc_ids), dtype=np.float64)
+        with ExitStack() as stack:
+            writers = []
+            for d in dirs:
+                posting_dir = d / name
+                posting_dir.mkdir(parents=True, exist_ok=True)
+                writers.append(stack.enter_context(closing(PostingListWriter(
+                    posting_dir, 0, None, order=order, fmt=fmt, bm25_bounds=bounds, **impact_kwargs))))
+            for term, term_doc_ids, tfs in indexer.merged():
+                # the filter and the norms use the df over all the shards
+                if len(term_doc_ids) <= filter_size:
+                    continue
+                # doc_norm of indexes_creator.ipynb, one term at a time
+                ords = np.searchsorted(doc_ids, term_doc_ids)
+                norm2[ords] += (tfs / doc_lens[ords] * np.log(n_docs / len(term_doc_ids))) ** 2
+                # the order of reduce_word_counts: decreasing tf, then increasing doc id
+                by_tf = np.lexsort((term_doc_ids, -tfs.astype(np.int64)))
+                term_doc_ids, tfs = term_doc_ids[by_tf], tfs[by_tf]
+                in_shard = shard_of(term_doc_ids, shards)
+                for i, (ii, writer) in enumerate(zip(indexes, writers)):
+                    part = in_shard == i
+                    if not part.any():
+                        continue
+                    ii.df[term] = int(part.sum())
+                    ii.term_total[term] = int(tfs[part].sum())
+                    writer.add(term, list(zip(term_doc_ids[part].tolist(), tfs[part].tolist())))
+        runs = len(indexer.runs)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    t_merged = perf_counter()
+
+    d_norms = np.sqrt(norm2)
+    for i, (ii, writer, d) in enumerate(zip(indexes, writers, dirs)):
+        ii.posting_locs = writer.posting_locs
+        ii.posting_order = order
+        ii.posting_format = fmt
+        if fmt != FORMAT_RAW:
+            ii.posting_bytes = writer.posting_bytes
+        if bm25_bounds:
+            ii.bm25_block_max = writer.block_max
+            ii.bm25_bounds_params = (k1, b, 128)
+        part = shard_of(doc_ids, shards) == i
+        ii.dl = dict(zip(doc_ids[part].tolist(), doc_lens[part].tolist()))
+        ii.d_norms = dict(zip(doc_ids[part].tolist(), d_norms[part].tolist()))
+        ii.corpus_size = n_docs
+    if shards > 1:
+        set_global_stats(indexes)
+    for ii, d in zip(indexes, dirs):
+        ii.write_index(d, f'index_{name}')
+
+    t_end = perf_counter()
+    self_mb, children_mb = peak_rss_mb()
+    stats = {'index': name, 'docs': len(dl), 'pairs': n_pairs, 'shards': shards,
+             'terms': len(set().union(*(ii.df for ii in indexes))), 'runs': runs,
+             'tokenize_seconds': t_tokenized - t_start, 'merge_seconds': t_merged - t_tokenized,
+             'seconds': t_end - t_start, 'docs_per_second': len(dl) / (t_tokenized - t_start),
+             'peak_rss_mb': self_mb, 'peak_worker_rss_mb': children_mb}
+    return (indexes[0] if shards == 1 else indexes), stats
+
+
+def check_round_trip(tmp_dir=None):
+    """ Build a small anchor index whose target documents repeat within the
+        blocks and across several runs, and check it against the same index
+        built in memory by `InvertedIndex`: df, doc lengths, term totals,
+        norms and every posting list, then the same for it built in 3
+        shards. Raises AssertionError on a mismatch.
+    """
+    import pyarrow as pa
+    from inverted_index_gcp import LocalStorage
+    rng = np.random.default_rng(0)
+    words = [f'term{i:03}' for i in range(300)]
+    doc_ids = list(range(1, 401))
+    links = [[{'id': int(rng.integers(1, 60)), 'text': ' '.join(rng.choice(words, size=rng.integers(1, 4)))}
+              for _ in range(rng.integers(0, 6))] for _ in doc_ids]
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        tmp = Path(tmp)
+        pq.write_table(pa.table({'id': doc_ids, 'anchor_text': links}), tmp / 'links.parquet', row_group_size=50)
+        ii, stats = build_index([tmp / 'links.parquet'], 'anchor_idx', 'anchor', tmp / 'out', 0,
+                                corpus_size=len(doc_ids), memory_mb=0.02, workers=2, batch_size=20)
+        assert stats['runs'] > 1, stats
+        tokens = defaultdict(list)
+        for doc_links in links:
+            for link in doc_links:
+                tokens[link['id']].extend(tokenize(link['text']))
+        ref = InvertedIndex(tokens)
+        assert dict(ii.df) == dict(ref.df)
+        assert dict(ii.term_total) == dict(ref.term_total)
+        assert ii.dl == {doc_id: len(t) for doc_id, t in tokens.items()}
+        norms = {doc_id: np.sqrt(sum((cnt / len(t) * np.log(len(doc_ids) / ref.df[term])) ** 2
+                                     for term, cnt in Counter(t).items()))
+                 for doc_id, t in tokens.items()}
+        for doc_id, norm in norms.items():
+            assert abs(ii.d_norms[doc_id] - norm) < 1e-9
+        written = dict(ii.posting_lists_iter('anchor_idx', LocalStorage(tmp / 'out')))
+        assert written.keys() == ref._posting_list.keys()
+        for term, pl in written.items():
+            assert sorted(pl) == sorted(ref._posting_list[term]), term
+
+        # the same index in 3 shards, the terms in more than 3 documents of the corpus
+        shard_indexes, _ = build_index([tmp / 'links.parquet'], 'anchor_idx', 'anchor', tmp / 'shards', 3,
+                                       corpus_size=len(doc_ids), memory_mb=0.02, workers=2, batch_size=20,
+                                       shards=3)
+        kept = {term for term, n in ref.df.items() if n > 3}
+        for i, shard in enumerate(shard_indexes):
+            assert shard.global_df == {term: ref.df[term] for term in shard.df}
+            assert shard.global_n_docs == len(tokens)
+            assert shard.dl == {doc_id: len(t) for doc_id, t in tokens.items() if shard_of(doc_id, 3) == i}
+            written = dict(shard.posting_lists_iter('anchor_idx', LocalStorage(tmp / 'shards' / f'shard_{i}')))
+            for term in kept:
+                pl = sorted(p for p in ref._posting_list[term] if shard_of(p[0], 3) == i)
+                assert sorted(written.get(term, [])) == pl, term
+            assert written.keys() <= kept
+            # the norms only count the kept terms
+            for doc_id in shard.dl:
+                t = tokens[doc_id]
+                norm = np.sqrt(sum((cnt / len(t) * np.log(len(doc_ids) / ref.df[term])) ** 2
+                                   for term, cnt in Counter(t).items() if term in kept))
+                assert abs(shard.d_norms[doc_id] - norm) < 1e-9
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the inverted indexes of a Wikipedia dump without Spark.')
+    parser.add_argument('--parquet', nargs='+', help='the dump files (local or gs:// paths)')
+    parser.add_argument('--out-dir')
+    parser.add_argument('--indexes', nargs='+', choices=sorted(INDEXES), default=sorted(INDEXES))
+    parser.add_argument('--memory-mb', type=int, default=1024, help='the postings held in memory before a spill')
+    parser.add_argument('--workers', type=int, help='tokenizer processes (default: one per CPU)')
+    parser.add_argument('--batch-size', type=int, default=1000, help='parquet rows per tokenizer task')
+    parser.add_argument('--tmp-dir', help='where the runs are spilled (default: the system temp directory)')
+    parser.add_argument('--fmt', type=int, default=FORMAT_RAW)
+    parser.add_argument('--order', choices=('tf', 'bm25', 'prior'))
+    parser.add_argument('--prior', help='pickle of the doc_id -> prior dict (e.g. page_rank.pkl), for --order prior')
+    parser.add_argument('--bm25-bounds', action='store_true')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='partition the documents into this many indexes, under shard_<i>/ (see coordinator.py)')
+    parser.add_argument('--json', help='also write the build statistics to this file')
+    parser.add_argument('--check', action='store_true',
+                        help='only check the spill/merge round trip on a small generated anchor index')
+    args = parser.parse_args()
+
+    if args.check:
+        stats = check_round_trip(args.tmp_dir)
+        print(f"round trip ok: {stats['docs']} docs, {stats['terms']} terms, {stats['runs']} runs")
+        return
+    if not args.parquet or not args.out_dir:
+        parser.error('--parquet and --out-dir are required')
+    prior = None
+    if args.prior:
+        with open(args.prior, 'rb') as f:
+            prior = pickle.load(f)
+    corpus_size = count_rows(args.parquet)
+    all_stats = []
+    for name in args.indexes:
+        field, _, filter_size = INDEXES[name]
+        _, stats = build_index(args.parquet, name, field, args.out_dir, filter_size, corpus_size=corpus_size,
+                               memory_mb=args.memory_mb, workers=args.workers, batch_size=args.batch_size,
+                               order=args.order, prior=prior, fmt=args.fmt, bm25_bounds=args.bm25_bounds,
+                               tmp_dir=args.tmp_dir, shards=args.shards)
+        all_stats.append(stats)
+        print(f"{name}: {stats['docs']} docs, {stats['terms']} terms, {stats['runs']} runs in "
+              f"{stats['seconds']:.1f}s ({stats['docs_per_second']:.0f} docs/s tokenizing), "
+              f"peak RSS {stats['peak_rss_mb']:.0f} MB, workers {stats['peak_worker_rss_mb']:.0f} MB")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(all_stats, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
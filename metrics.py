@@ -0,0 +1,228 @@
+""" In-process request metrics: per-stage timing spans, counters and
+latency histograms, exported in the Prometheus text format by /metrics.
+
+    with span('bm25'):
+        ...
+
+times a stage of the pipeline into the `ir_stage_seconds` histogram and,
+when a request is being traced (see `start_trace`), into the request's own
+trace, which is logged as a slow-query line when the request takes at least
+IR_SLOW_QUERY_MS milliseconds (0, the default, logs nothing).
+
+The metrics are kept per process: under gunicorn every worker counts the
+requests it served and /metrics reports the worker that answered.
+"""
+import json
+import logging
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+
+# requests at least this slow (in ms) are logged with their stages, 0 for none
+SLOW_QUERY_MS = float(os.environ.get('IR_SLOW_QUERY_MS', 0))
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (0, 10, 100, 1000, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+
+slow_query_log = logging.getLogger('ir.slow_query')
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """ A monotonically increasing count per label set. """
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, n=1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def value(self, **labels):
+        return self._values.get(_labels(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """ The distribution of observed values per label set, in cumulative
+        `buckets` (upper bounds) with their sum and count.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _labels(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts[0][i] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for labels, (counts, total, n) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, c in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += c
+                    out.append((f'{self.name}_bucket', labels + (('le', _format_value(bound)),), cumulative))
+                out.append((f'{self.name}_sum', labels, total))
+                out.append((f'{self.name}_count', labels, n))
+        return out
+
+
+class Gauge:
+    """ A value read when the metrics are exported: `collect()` returns
+        (labels dict, value) pairs.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, collect):
+        self.name = name
+        self.help = help
+        self._collect = collect
+
+    def samples(self):
+        return [(self.name, _labels(labels), value) for labels, value in self._collect()]
+
+
+REGISTRY = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+request_seconds = register(Histogram('ir_request_seconds', 'Request latency by endpoint.'))
+stage_seconds = register(Histogram('ir_stage_seconds', 'Time spent in each pipeline stage.'))
+candidates = register(Histogram('ir_candidates', 'Candidate set sizes by stage.', SIZE_BUCKETS))
+bytes_read = register(Counter('ir_posting_bytes_read_total', 'Posting bytes read from storage by index.'))
+postings_decoded = register(Counter('ir_postings_decoded_total', 'Postings decoded by index.'))
+
+
+def render():
+    """ Every registered metric in the Prometheus text exposition format. """
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class Trace:
+    """ The stage times and counts of one request. Stages that run more than
+        once (e.g. one fetch per batch) are summed.
+    """
+    def __init__(self, endpoint, query=None):
+        self.endpoint = endpoint
+        self.query = query
+        self.start = perf_counter()
+        self.stages = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_count(self, name, n):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+
+_trace = ContextVar('ir_trace', default=None)
+
+
+def current_trace():
+    return _trace.get()
+
+
+def start_trace(endpoint, query=None):
+    """ Start tracing a request in the current context; returns the token
+        to pass to `finish_trace`.
+    """
+    return _trace.set(Trace(endpoint, query))
+
+
+def finish_trace(token):
+    """ Record the latency of the traced request and log it when slow. """
+    trace = _trace.get()
+    _trace.reset(token)
+    if trace is None:
+        return None
+    seconds = perf_counter() - trace.start
+    request_seconds.observe(seconds, endpoint=trace.endpoint)
+    if SLOW_QUERY_MS > 0 and seconds * 1000 >= SLOW_QUERY_MS:
+        slow_query_log.warning(json.dumps({
+            'endpoint': trace.endpoint, 'query': trace.query, 'ms': round(seconds * 1000, 3),
+            'stages_ms': {stage: round(s * 1000, 3) for stage, s in trace.stages.items()},
+            'counts': trace.counts}))
+    return seconds
+
+
+@contextmanager
+def span(stage):
+    """ Time the enclosed block as pipeline stage `stage`. """
+    t_start = perf_counter()
+    try:
+        yield
+    finally:
+        seconds = perf_counter() - t_start
+        stage_seconds.observe(seconds, stage=stage)
+        trace = _trace.get()
+        if trace is not None:
+            trace.add_stage(stage, seconds)
+
+
+def count(counter, n, **labels):
+    """ Add `n` to `counter` and to the count of the traced request. """
+    counter.inc(n, **labels)
+    trace = _trace.get()
+    if trace is not None:
+        trace.add_count(counter.name, n)
+
+
+def observe_candidates(stage, n):
+    """ Record the size of a candidate set. """
+    candidates.observe(n, stage=stage)
+    trace = _trace.get()
+    if trace is not None:
+        trace.add_count(f'candidates_{stage}', n)
@@ -1,21 +1,185 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_request_context
 from backend import *
-from google.cloud import storage
-import pickle
+from cache import PostingListCache, ResultCache
+from doc_store import DocStats, TitleStore, build_from_storage, build_titles_from_storage
+from setops import contains, union
+import metrics
+from metrics import span, observe_candidates
+import os
+import json
+import threading
+import time
 import numpy as np
-import pandas as pd
 
 
-# Connecting to google storage bucket.
-client = storage.Client()
-bucket = client.get_bucket('ln3250')
-title_idx = pickle.loads(bucket.get_blob('index_title_idx.pkl').download_as_string())
-body_idx = pickle.loads(bucket.get_blob('index_body_idx.pkl').download_as_string())
-anchor_idx = pickle.loads(bucket.get_blob('index_anchor_idx.pkl').download_as_string())
-page_views = pickle.loads(bucket.get_blob('page_views.pkl').download_as_string())
-page_rank = pickle.loads(bucket.get_blob('page_rank.pkl').download_as_string())
-id2title = pickle.loads(bucket.get_blob('id2title.pkl').download_as_string())
-bm25 = BM25_from_index(body_idx)
+# BM25 in /search: "truncated" scores the th-truncated candidates, "wand" takes
+# the exact top IR_BM25_TOP_K over the full body posting lists (Block-Max WAND).
+BM25_MODE = os.environ.get('IR_BM25_MODE', 'truncated')
+BM25_TOP_K = int(os.environ.get('IR_BM25_TOP_K', 100))
+# results whose titles are resolved and sent at a time in streamed responses
+STREAM_CHUNK = 1000
+# the length of every signal list /search fuses (the N of `top_scores`)
+SIGNAL_TOP_N = 5000
+# the most queries a batch endpoint takes per request
+BATCH_MAX_QUERIES = int(os.environ.get('IR_BATCH_MAX_QUERIES', 1000))
+# the fusion weight profiles of /search (see FUSION_PROFILES), a JSON list
+FUSION_PROFILES = fusion_profiles_from_env()
+# decoded posting lists shared by all the endpoints, IR_POSTING_CACHE_MB budget
+# (one cache per loaded SearchState)
+POSTING_CACHE_BYTES = int(os.environ.get('IR_POSTING_CACHE_MB', 512)) * 2 ** 20
+# serialized responses per (endpoint, query tokens), IR_RESULT_CACHE_MB budget,
+# entries expire after IR_RESULT_CACHE_TTL seconds
+result_cache = ResultCache(int(os.environ.get('IR_RESULT_CACHE_MB', 128)) * 2 ** 20,
+                           float(os.environ.get('IR_RESULT_CACHE_TTL', 600)))
+# seconds between checks of the published index version, 0 to never reload
+RELOAD_INTERVAL = float(os.environ.get('IR_RELOAD_INTERVAL', 60))
+# the storage object whose content changes when new indexes are published
+VERSION_BLOB = 'INDEX_VERSION'
+
+
+def read_index_version(storage):
+    """ The published index version (the content of VERSION_BLOB), or None. """
+    try:
+        return storage.read_blob(VERSION_BLOB).decode('utf-8').strip()
+    except FileNotFoundError:
+        return None
+
+
+class SearchState:
+    """ The indexes and the per-document data of one published version, and
+        the posting list cache filled from them. Requests take the current
+        state once (see `current_state`), so `load_indexes` replaces it with
+        a single assignment while in-flight requests finish on the old one.
+    """
+    def __init__(self):
+        # Connecting to the posting storage (google storage bucket or local disk,
+        # see `storage_from_env` for the IR_STORAGE / IR_BUCKET / IR_PREFIX /
+        # IR_LOCAL_DIR settings). Local posting files are memory-mapped once, here.
+        # the local copies of a bucket are kept per published version
+        probe = storage_from_env()
+        self.version = read_index_version(probe)
+        probe.close()
+        self.storage = storage_from_env(self.version)
+        for index_dir in ("title_idx", "body_idx", "anchor_idx"):
+            self.storage.preload(index_dir)
+        self.reader = MultiFileReader(self.storage)
+        # memory-mapped when the storage holds the index directories (see
+        # `MappedIndex`), otherwise unpickled whole
+        self.title_idx = open_index(self.storage, 'index_title_idx')
+        self.body_idx = open_index(self.storage, 'index_body_idx')
+        self.anchor_idx = open_index(self.storage, 'index_anchor_idx')
+        # doc lengths, norms, PageRank and page views as memory-mapped columns
+        # (see doc_store.py), built once from the pickles when missing
+        stats_dir = self.storage.local_dir('doc_stats')
+        if not DocStats.exists(stats_dir):
+            build_from_storage(self.storage, stats_dir)
+        self.doc_stats = DocStats(stats_dir)
+        self.body_idx.dl, self.body_idx.d_norms = self.doc_stats.dl, self.doc_stats.norm
+        # the titles as a memory-mapped blob (see doc_store.py), built once from
+        # the id2title pickle when missing
+        titles_dir = self.storage.local_dir('titles')
+        if not TitleStore.exists(titles_dir):
+            build_titles_from_storage(self.storage, titles_dir)
+        self.titles = TitleStore(titles_dir)
+        self.bm25 = BM25_from_index(self.body_idx, stats=self.doc_stats)
+        self.posting_cache = PostingListCache(POSTING_CACHE_BYTES)
+        self.loaded_at = time.time()
+        # the requests using this state (see `acquire`) and whether a newer
+        # one replaced it, in which case the last of them closes it
+        self._pins = 0
+        self._retired = False
+        self._pin_lock = threading.Lock()
+
+    def acquire(self):
+        """ Pin the state for a request; `release` it when the request ends. """
+        with self._pin_lock:
+            self._pins += 1
+        return self
+
+    def release(self):
+        with self._pin_lock:
+            self._pins -= 1
+            done = self._retired and self._pins == 0
+        if done:
+            self.close()
+
+    def retire(self):
+        """ Close the state once the requests still using it are done. """
+        with self._pin_lock:
+            self._retired = True
+            done = self._pins == 0
+        if done:
+            self.close()
+
+    def close(self):
+        """ Unmap the local posting files and drop the indexes and caches
+            (their NumPy memory maps are unmapped once collected).
+        """
+        self.posting_cache.clear()
+        self.title_idx = self.body_idx = self.anchor_idx = self.bm25 = None
+        self.doc_stats = self.titles = None
+        self.storage.close()
+
+
+state = None
+_reload_lock = threading.Lock()
+# taken to swap `state` and to pin the current one
+_state_lock = threading.Lock()
+
+
+def load_indexes():
+    """ (Re)load the indexes and the per-document data, swap them in for new
+        requests and drop the responses cached from the previous ones.
+    """
+    global state
+    with _reload_lock:
+        new_state = SearchState()
+        with _state_lock:
+            old_state, state = state, new_state
+        result_cache.invalidate()
+    if old_state is not None:
+        old_state.retire()
+    return new_state
+
+
+def current_state():
+    """ The SearchState serving the current request (fixed and pinned when
+        it started, released when it ends).
+    """
+    if has_request_context():
+        if 'state' not in g:
+            with _state_lock:
+                g.state = state.acquire() if state is not None else None
+        return g.state
+    return state
+
+
+def watch_index_version(interval=RELOAD_INTERVAL):
+    """ Reload the indexes whenever the published version changes, checking
+        every `interval` seconds from a daemon thread. Call it in every
+        serving process (gunicorn.conf.py does it after each worker forks).
+    """
+    if interval <= 0:
+        return None
+
+    def watch():
+        # the version is published at the root of the storage, not in the
+        # version directory a LocalStorage serves
+        probe = storage_from_env()
+        while True:
+            time.sleep(interval)
+            try:
+                if read_index_version(probe) != state.version:
+                    load_indexes()
+            except Exception:
+                app.logger.exception('index reload failed, still serving version %s', state.version)
+
+    thread = threading.Thread(target=watch, name='index-watcher', daemon=True)
+    thread.start()
+    return thread
+
+
+load_indexes()
 
 
 class MyFlaskApp(Flask):
@@ -27,6 +191,288 @@ app = MyFlaskApp(__name__)
 app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
 
 
+@app.route("/healthz")
+def healthz():
+    """ Liveness: the process is up and answering. """
+    return jsonify({'status': 'ok'})
+
+
+@app.route("/readyz")
+def readyz():
+    """ Readiness: 200 with the index version being served once the indexes
+        are loaded, 503 before that.
+    """
+    s = current_state()
+    if s is None:
+        return jsonify({'status': 'loading'}), 503
+    return jsonify({'status': 'ready', 'version': s.version, 'loaded_at': s.loaded_at})
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """ The request, stage and cache metrics of this process, in the
+        Prometheus text format (see metrics.py).
+    """
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.before_request
+def start_request_trace():
+    if request.endpoint in ('healthz', 'readyz', 'metrics_endpoint'):
+        return
+    g.trace_token = metrics.start_trace(request.endpoint or 'unknown', request.args.get('query'))
+
+
+@app.teardown_request
+def finish_request_trace(exc=None):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        metrics.finish_trace(token)
+
+
+@app.teardown_request
+def release_state(exc=None):
+    s = g.pop('state', None)
+    if s is not None:
+        s.release()
+
+
+def cache_stats():
+    """ The (labels, value) samples of the posting list and result caches. """
+    caches = {'result': result_cache.stats()}
+    if state is not None:
+        caches['posting'] = state.posting_cache.stats()
+    return [({'cache': name, 'stat': stat}, value)
+            for name, stats in caches.items() for stat, value in stats.items()]
+
+
+metrics.register(metrics.Gauge('ir_cache', 'Posting list and result cache statistics.', cache_stats))
+
+
+def cached_response(endpoint, query, run):
+    """ The JSON response of `run(query)` for the tokenized `query`, served
+        from the result cache when the same tokens were answered before.
+    """
+    key = (endpoint, tuple(query))
+    body = result_cache.get(key)
+    if body is None:
+        generation = result_cache.generation
+        body = jsonify(run(query)).get_data()
+        result_cache.put(key, body, generation)
+    return app.response_class(body, mimetype='application/json')
+
+
+def cached_ranking(endpoint, query, rank):
+    """ The ranked doc ids `rank(query)` of the tokenized `query`, kept in the
+        result cache (as int64 bytes) so the pages of a query rank it once.
+    """
+    key = (endpoint, 'ranking', tuple(query))
+    body = result_cache.get(key)
+    if body is None:
+        generation = result_cache.generation
+        body = np.ascontiguousarray(rank(query), dtype=np.int64).tobytes()
+        result_cache.put(key, body, generation)
+    return np.frombuffer(body, dtype=np.int64)
+
+
+def wants_pages():
+    """ Whether the request asks for a page or a stream of the results. """
+    return any(arg in request.args for arg in ('offset', 'limit', 'format'))
+
+
+def paged_response(endpoint, query, rank):
+    """ A page of the ranked results of `rank(query)`, `limit` (default all)
+        results from `offset` (default 0), as a JSON list or, with
+        format=ndjson, streamed as one [wiki_id, title] line per result with
+        the titles resolved STREAM_CHUNK results at a time. X-Total-Count
+        holds the number of results and X-Next-Offset, when there are more,
+        the offset of the next page.
+    """
+    s = current_state()
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', None, type=int)
+    fmt = request.args.get('format', 'json')
+    if offset < 0 or (limit is not None and limit < 0) or fmt not in ('json', 'ndjson'):
+        return jsonify(error='offset and limit must be non-negative, format json or ndjson'), 400
+    doc_ids = cached_ranking(endpoint, query, rank)
+    page = doc_ids[offset:] if limit is None else doc_ids[offset:offset + limit]
+    headers = {'X-Total-Count': str(len(doc_ids))}
+    if offset + len(page) < len(doc_ids):
+        headers['X-Next-Offset'] = str(offset + len(page))
+    if fmt == 'json':
+        with span('titles'):
+            res = jsonify(s.titles.resolve(page))
+        res.headers.update(headers)
+        return res
+
+    def lines():
+        for start in range(0, len(page), STREAM_CHUNK):
+            yield ''.join(json.dumps(pair) + '\n' for pair in s.titles.resolve(page[start:start + STREAM_CHUNK]))
+    # the lines are generated after the request ends: keep the state pinned until then
+    res = app.response_class(lines(), mimetype='application/x-ndjson', headers=headers)
+    res.call_on_close(s.acquire().release)
+    return res
+
+
+def search_jobs(query):
+    """ The posting list reads of /search (see `fetch_postings`). """
+    s = current_state()
+    jobs = [(s.body_idx, "body_idx", query, 400), (s.title_idx, "title_idx", query, 400)]
+    if BM25_MODE == "wand":
+        jobs.append((s.body_idx, "body_idx", query, corpus_size))
+    return jobs
+
+
+def search_signals(query, fetched=None):
+    """ The candidates of /search for the tokenized query (an int64 array)
+        and their signals, the {doc_id: score} dicts of FUSION_SIGNALS, on
+        the postings of `search_jobs(query)` when they were already fetched.
+    """
+    s = current_state()
+    # all the body and title reads of the query are issued at once
+    if fetched is None:
+        fetched = fetch_postings(search_jobs(query), reader=s.reader, cache=s.posting_cache)
+    body_pls = CandidateSet(fetched[0])
+    body_ids = body_pls.doc_ids.astype(np.int64)
+    if BM25_MODE == "wand":
+        with span('bm25'):
+            bm_score = s.bm25.search_top_k(query, fetched[2], k=BM25_TOP_K)
+        body_ids = union([body_ids, np.array(sorted(bm_score), dtype=np.int64)])
+    observe_candidates('body', len(body_ids))
+
+    # title signal: 1 for the body candidates whose title holds every query term
+    with span('title_match'):
+        title_ids, title_counts = term_matches(query, fetched[1])
+        in_body = contains(body_ids, title_ids)
+        title_ids, title_counts = title_ids[in_body], title_counts[in_body]
+        title_matches = top_scores(title_ids, (title_counts == len(set(query))).astype(np.int64))
+    observe_candidates('title', len(title_ids))
+
+    if BM25_MODE != "wand":
+        with span('bm25'):
+            bm_score = s.bm25.search(query, body_pls)
+
+    with span('cosine'):
+        cosim_score = body_pls.top(tf_idf(query, body_pls, s.body_idx, s.doc_stats))
+
+    # the title candidates are all body candidates
+    relevant_ids = body_ids
+    with span('doc_signals'):
+        pagerank_score = top_scores(relevant_ids, s.doc_stats.pagerank.gather(relevant_ids))
+        pageview_score = top_scores(relevant_ids, s.doc_stats.pageviews.gather(relevant_ids))
+    return relevant_ids, [title_matches, bm_score, cosim_score, pagerank_score, pageview_score]
+
+
+def run_search(query, fetched=None):
+    """ The /search pipeline over the tokenized query, on the postings of
+        `search_jobs(query)` when they were already fetched.
+    """
+    s = current_state()
+    relevant_ids, signals = search_signals(query, fetched)
+    # combine all scores
+    with span('fusion'):
+        top_d = fused_top(query, relevant_ids, signals, 5, FUSION_PROFILES).tolist()
+    with span('titles'):
+        res = s.titles.resolve(top_d)
+    return res
+
+
+def search_body_jobs(query):
+    """ The posting list reads of /search_body (see `fetch_postings`). """
+    s = current_state()
+    return [(s.body_idx, "body_idx", query, 500)]
+
+
+def rank_search_body(query, fetched=None):
+    """ The 100 best {doc_id: cosine similarity} of /search_body for the tokenized query. """
+    s = current_state()
+    if fetched is None:
+        fetched = fetch_postings(search_body_jobs(query), reader=s.reader, cache=s.posting_cache)
+    cands = CandidateSet(fetched[0])
+    observe_candidates('body', len(cands))
+    with span('cosine'):
+        return cands.top(tf_idf(query, cands, s.body_idx, s.doc_stats), N=100)
+
+
+def run_search_body(query, fetched=None):
+    """ The /search_body pipeline over the tokenized query. """
+    s = current_state()
+    top_d = list(rank_search_body(query, fetched))
+    with span('titles'):
+        res = s.titles.resolve(top_d)
+    return res
+
+
+def search_title_jobs(query):
+    """ The posting list reads of /search_title (see `fetch_postings`). """
+    s = current_state()
+    return [(s.title_idx, "title_idx", query, corpus_size)]
+
+
+def count_search_title(query, fetched=None):
+    """ The ranked doc ids (with a title) of /search_title for the tokenized
+        query and the number of distinct query terms each one matches.
+    """
+    s = current_state()
+    if fetched is None:
+        fetched = fetch_postings(search_title_jobs(query), reader=s.reader, cache=s.posting_cache)
+    with span('title_match'):
+        doc_ids, counts = term_matches(query, fetched[0])
+        order = top_k(doc_ids, counts, len(doc_ids))
+        doc_ids, counts = doc_ids[order], counts[order]
+    observe_candidates('title', len(doc_ids))
+    has_title = s.titles.has(doc_ids)
+    return doc_ids[has_title], counts[has_title]
+
+
+def rank_search_title(query, fetched=None):
+    """ The ranked doc ids (with a title) of /search_title for the tokenized query. """
+    return count_search_title(query, fetched)[0]
+
+
+def run_search_title(query, fetched=None):
+    """ The /search_title pipeline over the tokenized query. """
+    s = current_state()
+    top_d = rank_search_title(query, fetched)
+    with span('titles'):
+        return s.titles.resolve(top_d)
+
+
+def search_anchor_jobs(query):
+    """ The posting list reads of /search_anchor (see `fetch_postings`). """
+    s = current_state()
+    return [(s.anchor_idx, "anchor_idx", query, corpus_size)]
+
+
+def count_search_anchor(query, fetched=None):
+    """ The ranked doc ids (with a title) of /search_anchor for the tokenized
+        query and the number of distinct query terms each one matches.
+    """
+    s = current_state()
+    if fetched is None:
+        fetched = fetch_postings(search_anchor_jobs(query), reader=s.reader, cache=s.posting_cache)
+    with span('anchor_match'):
+        doc_ids, counts = term_matches(query, fetched[0])
+        order = top_k(doc_ids, counts, len(doc_ids))
+        doc_ids, counts = doc_ids[order], counts[order]
+    observe_candidates('anchor', len(doc_ids))
+    has_title = s.titles.has(doc_ids)
+    return doc_ids[has_title], counts[has_title]
+
+
+def rank_search_anchor(query, fetched=None):
+    """ The ranked doc ids (with a title) of /search_anchor for the tokenized query. """
+    return count_search_anchor(query, fetched)[0]
+
+
+def run_search_anchor(query, fetched=None):
+    """ The /search_anchor pipeline over the tokenized query. """
+    s = current_state()
+    top_d = rank_search_anchor(query, fetched)
+    with span('titles'):
+        return s.titles.resolve(top_d)
+
+
 @app.route("/search")
 def search():
     """ Returns up to a 100 of your best search results for the query. This is
@@ -50,43 +496,11 @@ def search():
     if len(query) == 0:
         return jsonify(res)
     # BEGIN SOLUTION
-    query = tokenize(query)
-    body_cands, body_cands_dict = get_cands(query, body_idx, "body_idx")
-    title_cands, title_cands_dict = get_cands(query, title_idx, "title_idx")
-    title_cands = title_cands.intersection(body_cands)
-
-    # filter out the candidates that do not have the query terms in the title
-    title_cands_updated = {}
-    for term, pls in title_cands_dict.items():
-        for doc_id in pls.keys():
-            if doc_id in body_cands:
-                title_cands_updated[term] = pls
-
-    title_cands_dict = title_cands_updated
-
-    title_sim_dict = {doc_id: get_matches(query, title_cands_dict, doc_id) for doc_id in title_cands}
-    title_matches = get_top_n(title_sim_dict)
-
-    bm_score = bm25.search(query, body_cands, body_cands_dict)
-
-    cosim_dict = {doc_id: tf_idf(doc_id, query, body_idx, body_cands_dict) for doc_id in body_cands}
-    cosim_score = get_top_n(cosim_dict)
-
-    relevant_union = set().union(*[body_cands, title_cands])
-
-    pagerank_score = get_top_n(dict([(doc_id, page_rank.get(doc_id, 0)) for doc_id in relevant_union]))
-    pageview_score = get_top_n(dict([(doc_id, page_views.get(doc_id, 0)) for doc_id in relevant_union]))
-
-    # combine all scores
-    combined_scores = combine_scores(relevant_union, title_matches, bm_score, cosim_score, pagerank_score, pageview_score)
-    ws = np.array([1, 4, 3, 3, 2])
-    if len(query) < 3:
-        ws = np.array([3, 3, 2, 3, 2])
-    # return norm_scores
-    top_d = sorted((combined_scores.keys()), key=lambda x: np.dot(combined_scores[x], ws), reverse=True)[:5]
-    res = [(doc_id, id2title.loc[doc_id]) for doc_id in top_d if doc_id in id2title.index]
+    with span('tokenize'):
+        query = tokenize(query)
+    res = cached_response("search", query, run_search)
     # END SOLUTION
-    return jsonify(res)
+    return res
 
 @app.route("/search_body")
 def search_body():
@@ -109,13 +523,11 @@ def search_body():
     if len(query) == 0:
         return jsonify(res)
     # BEGIN SOLUTION
-    query = tokenize(query)
-    cands, cands_dict = get_cands(query, body_idx, "body_idx", th=500)
-    cosim_dict = {doc_id: tf_idf(doc_id, query, body_idx, cands_dict) for doc_id in cands}
-    top_d = [doc_id for doc_id, _ in get_top_n(cosim_dict, N=100).items()]
-    res = [(doc_id, id2title.loc[doc_id]) for doc_id in top_d if doc_id in id2title.index]
+    with span('tokenize'):
+        query = tokenize(query)
+    res = cached_response("search_body", query, run_search_body)
     # END SOLUTION
-    return jsonify(res)
+    return res
 
 
 @app.route("/search_title")
@@ -137,20 +549,22 @@ def search_title():
     Returns:
     --------
         list of ALL (not just top 100) search results, ordered from best to
-        worst where each element is a tuple (wiki_id, title).
+        worst where each element is a tuple (wiki_id, title). With `offset`
+        and/or `limit` only that page is returned, and format=ndjson streams
+        the results one per line (see `paged_response`).
     """
     res = []
     query = request.args.get('query', '')
     if len(query) == 0:
         return jsonify(res)
     # BEGIN SOLUTION
-    query = tokenize(query)
-    cands, cands_dict = get_cands(query, title_idx, "title_idx", th=corpus_size)
-    sim_dict = {doc_id: get_matches(query, cands_dict, doc_id) for doc_id in cands}
-    top_d = [doc_id for doc_id, _ in get_top_n(sim_dict, N=corpus_size).items()]
-    res = [(doc_id, id2title.loc[doc_id]) for doc_id in top_d if doc_id in id2title.index]
+    with span('tokenize'):
+        query = tokenize(query)
+    if wants_pages():
+        return paged_response("search_title", query, rank_search_title)
+    res = cached_response("search_title", query, run_search_title)
     # END SOLUTION
-    return jsonify(res)
+    return res
 
 
 @app.route("/search_anchor")
@@ -172,20 +586,155 @@ def search_anchor():
     Returns:
     --------
         list of ALL (not just top 100) search results, ordered from best to
-        worst where each element is a tuple (wiki_id, title).
+        worst where each element is a tuple (wiki_id, title). With `offset`
+        and/or `limit` only that page is returned, and format=ndjson streams
+        the results one per line (see `paged_response`).
     """
     res = []
     query = request.args.get('query', '')
     if len(query) == 0:
         return jsonify(res)
     # BEGIN SOLUTION
-    query = tokenize(query)
-    cands, cands_dict = get_cands(query, anchor_idx, "anchor_idx", th=corpus_size)
-    sim_dict = {doc_id: get_matches(query, cands_dict, doc_id) for doc_id in cands}
-    top_d = [doc_id for doc_id, _ in get_top_n(sim_dict, N=corpus_size).items()]
-    res = [(doc_id, id2title.loc[doc_id]) for doc_id in top_d if doc_id in id2title.index]
+    with span('tokenize'):
+        query = tokenize(query)
+    if wants_pages():
+        return paged_response("search_anchor", query, rank_search_anchor)
+    res = cached_response("search_anchor", query, run_search_anchor)
     # END SOLUTION
-    return jsonify(res)
+    return res
+
+
+# endpoint -> (its posting list reads, its pipeline), for the batch endpoints
+BATCH_PIPELINES = {
+    "search": (search_jobs, run_search),
+    "search_body": (search_body_jobs, run_search_body),
+    "search_title": (search_title_jobs, run_search_title),
+    "search_anchor": (search_anchor_jobs, run_search_anchor),
+}
+
+
+def batch_response(endpoint):
+    """ The results of `endpoint` for every query of the JSON list posted,
+        as a JSON list of result lists in the same order. Queries already in
+        the result cache are served from it; the posting lists of all the
+        others are fetched together by one `fetch_postings` call, which
+        reads every (index, term) they share once, before they are scored.
+    """
+    s = current_state()
+    queries = request.get_json(silent=True)
+    if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+        return jsonify(error='expected a JSON list of query strings'), 400
+    if len(queries) > BATCH_MAX_QUERIES:
+        return jsonify(error=f'at most {BATCH_MAX_QUERIES} queries per batch'), 400
+    jobs_of, run = BATCH_PIPELINES[endpoint]
+    with span('tokenize'):
+        tokenized = {q: tuple(tokenize(q)) for q in queries if len(q) > 0}
+    generation = result_cache.generation
+    bodies = {}
+    for tokens in set(tokenized.values()):
+        body = result_cache.get((endpoint, tokens))
+        if body is not None:
+            bodies[tokens] = body
+    pending = [tokens for tokens in set(tokenized.values()) if tokens not in bodies]
+    jobs = [jobs_of(list(tokens)) for tokens in pending]
+    fetched = fetch_postings([job for query_jobs in jobs for job in query_jobs], reader=s.reader, cache=s.posting_cache)
+    start = 0
+    for tokens, query_jobs in zip(pending, jobs):
+        body = jsonify(run(list(tokens), fetched[start:start + len(query_jobs)])).get_data()
+        start += len(query_jobs)
+        result_cache.put((endpoint, tokens), body, generation)
+        bodies[tokens] = body
+    parts = [bodies[tokenized[q]].strip() if len(q) > 0 else b'[]' for q in queries]
+    return app.response_class(b'[' + b','.join(parts) + b']', mimetype='application/json')
+
+
+@app.route("/search_batch", methods=['POST'])
+def search_batch():
+    """ /search for many queries at once: POST a JSON list of query strings,
+        get back a JSON list with the /search results of each, in order.
+    """
+    return batch_response("search")
+
+
+@app.route("/search_body_batch", methods=['POST'])
+def search_body_batch():
+    """ /search_body for a JSON list of queries, see `search_batch`. """
+    return batch_response("search_body")
+
+
+@app.route("/search_title_batch", methods=['POST'])
+def search_title_batch():
+    """ /search_title for a JSON list of queries, see `search_batch`. """
+    return batch_response("search_title")
+
+
+@app.route("/search_anchor_batch", methods=['POST'])
+def search_anchor_batch():
+    """ /search_anchor for a JSON list of queries, see `search_batch`. """
+    return batch_response("search_anchor")
+
+
+def shard_search(query):
+    """ The candidates and signals of /search on this shard (see coordinator.py). """
+    relevant_ids, signals = search_signals(query)
+    limits = [SIGNAL_TOP_N, BM25_TOP_K if BM25_MODE == "wand" else SIGNAL_TOP_N] + [SIGNAL_TOP_N] * 3
+    return {'candidates': relevant_ids.tolist(),
+            'signals': [{'n': n, 'doc_ids': list(signal), 'scores': list(signal.values())}
+                        for n, signal in zip(limits, signals)]}
+
+
+def with_titles(doc_ids, scores):
+    """ [doc_id, score, title] triples, the title None for documents without one. """
+    titles = current_state().titles
+    return [[doc_id, score, titles.get(doc_id)] for doc_id, score in zip(doc_ids, scores)]
+
+
+def shard_search_body_results(query):
+    """ The 100 best [doc_id, score, title] of /search_body on this shard. """
+    top = rank_search_body(query)
+    return with_titles(list(top), list(top.values()))
+
+
+@app.route("/shard/search")
+def shard_search_endpoint():
+    """ The shard side of /search for a coordinator: the candidates of the
+        query on this shard and their {doc_id: score} signals (FUSION_SIGNALS
+        order), each the top `n` of the shard, as JSON.
+    """
+    query = tokenize(request.args.get('query', ''))
+    return cached_response("shard_search", query, shard_search)
+
+
+@app.route("/shard/search_body")
+def shard_search_body():
+    """ The shard side of /search_body: its 100 best [doc_id, score, title]. """
+    query = tokenize(request.args.get('query', ''))
+    return cached_response("shard_search_body", query, shard_search_body_results)
+
+
+@app.route("/shard/search_title")
+def shard_search_title():
+    """ The shard side of /search_title: every [doc_id, matched terms, title]. """
+    query = tokenize(request.args.get('query', ''))
+    return cached_response("shard_search_title", query,
+                           lambda q: with_titles(*(a.tolist() for a in count_search_title(q))))
+
+
+@app.route("/shard/search_anchor")
+def shard_search_anchor():
+    """ The shard side of /search_anchor: every [doc_id, matched terms, title]. """
+    query = tokenize(request.args.get('query', ''))
+    return cached_response("shard_search_anchor", query,
+                           lambda q: with_titles(*(a.tolist() for a in count_search_anchor(q))))
+
+
+@app.route("/shard/titles", methods=['POST'])
+def shard_titles():
+    """ The (wiki_id, title) pairs of the posted doc ids held by this shard. """
+    doc_ids = request.get_json(silent=True)
+    if not isinstance(doc_ids, list):
+        return jsonify(error='expected a JSON list of doc ids'), 400
+    return jsonify(current_state().titles.resolve(doc_ids))
 
 
 @app.route("/get_pagerank", methods=['POST'])
@@ -209,7 +758,8 @@ def get_pagerank():
     if len(wiki_ids) == 0:
         return jsonify(res)
     # BEGIN SOLUTION
-    res = [page_rank[wiki_id] for wiki_id in wiki_ids]
+    s = current_state()
+    res = [s.doc_stats.pagerank[wiki_id] for wiki_id in wiki_ids]
     # END SOLUTION
     return jsonify(res)
 
@@ -237,13 +787,15 @@ def get_pageview():
     if len(wiki_ids) == 0:
         return jsonify(res)
     # BEGIN SOLUTION
-    res = [page_views.get(doc_id, 0) for doc_id in wiki_ids]
+    s = current_state()
+    res = [s.doc_stats.pageviews.get(doc_id, 0) for doc_id in wiki_ids]
     # END SOLUTION
     return jsonify(res)
 
 
 if __name__ == '__main__':
     # run the Flask RESTful API, make the server publicly available (host='0.0.0.0') on port 8080
+    # (development server; serve production traffic with `gunicorn -c gunicorn.conf.py wsgi:app`)
     app.run(host='0.0.0.0', port=8080, debug=True)
 
 
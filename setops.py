@@ -0,0 +1,39 @@
+""" Set operations over sorted, duplicate-free doc id arrays.
+
+Posting lists are turned into such arrays once with `doc_set` (they may be
+stored in impact order) and then combined without per-term dicts:
+membership tests binary search the sorted array, and unions keep how many
+of the inputs every document came from.
+"""
+import numpy as np
+
+
+def doc_set(doc_ids):
+    """ The sorted, duplicate-free doc ids of a posting list. """
+    return np.unique(np.asarray(doc_ids, dtype=np.int64))
+
+
+def contains(haystack, needles):
+    """ Which of `needles` are in the sorted array `haystack` (a bool mask). """
+    needles = np.asarray(needles, dtype=np.int64)
+    if len(haystack) == 0:
+        return np.zeros(len(needles), dtype=bool)
+    i = np.minimum(np.searchsorted(haystack, needles), len(haystack) - 1)
+    return haystack[i] == needles
+
+
+def union(arrays):
+    """ The doc ids in any of the sorted arrays. """
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.unique(np.concatenate(arrays))
+
+
+def union_counts(arrays):
+    """ The doc ids in any of the sorted arrays and the number of arrays
+        holding each of them; with one array per distinct query term that is
+        the number of query terms a document matches.
+    """
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.unique(np.concatenate(arrays), return_counts=True)
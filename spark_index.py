@@ -0,0 +1,378 @@
+""" The Spark build of the inverted indexes (create_index of indexes_creator.ipynb).
+
+    ii, stats = build_index(sc, doc_text_pairs(wiki_corpus, 'text'), 'body_idx', bucket_name,
+                            bucket_num=248, filter_size=50, corpus_size=wiki_corpus.count())
+
+writes the index in the layout search_frontend reads: the posting files under
+gs://`bucket_name`/`prefix`/body_idx/, index_body_idx.pkl and the mapped
+index_body_idx/ directory next to them. With `bucket_name=None` (e.g. on a
+local[*] master) everything stays under `out_dir`.
+
+Every document is tokenized once. Its (doc_id, dl, [(term, tf), ...]) record
+is cached and all the statistics come from it:
+
+    1. doc_stats - the doc lengths, collected and broadcast once for the BM25
+                   order and bounds.
+    2. postings  - one shuffle: every (term, -tf, doc_id) key goes straight to
+                   the partition of its hash bucket, sorted within it, so each
+                   task streams its bucket term by term into the posting files
+                   and returns the locations, byte sizes, block maxima, df and
+                   term totals of what it wrote (nothing is re-read from the
+                   bucket).
+    3. norms     - the tf-idf norms, from the cached records and the
+                   broadcast df.
+
+Anchor texts, several per document, are combined per target document as term
+counts (`combineByKey`) rather than as concatenated strings.
+
+`build_index` also returns the wall time of every stage and what its Spark
+jobs read, shuffled and spilled (from the stage metrics of the Spark UI's REST
+API, when the UI is enabled). The executors need this module and the ones it
+imports, see `add_py_files`.
+"""
+import argparse
+import hashlib
+import json
+import pickle
+import tempfile
+import urllib.request
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from itertools import groupby
+from operator import add
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+from google.cloud import storage
+
+from backend import tokenize
+from inverted_index_gcp import (InvertedIndex, FORMAT_RAW, ORDER_BM25, ORDER_PRIOR,
+                                shard_of, shard_dirs, set_global_stats)
+
+# the modules the executors import, shipped by `add_py_files`
+PY_FILES = ('spark_index.py', 'backend.py', 'inverted_index_gcp.py', 'doc_store.py', 'setops.py', 'metrics.py')
+# the Spark stage metrics `StageTimer` sums per build stage
+SPARK_METRICS = ('inputBytes', 'shuffleReadBytes', 'shuffleWriteBytes', 'shuffleWriteRecords',
+                 'memoryBytesSpilled', 'diskBytesSpilled', 'executorRunTime')
+
+
+def add_py_files(sc, src_dir='.'):
+    """ Ship this module and the ones it imports to the executors. """
+    for name in PY_FILES:
+        sc.addPyFile(str(Path(src_dir) / name))
+
+
+def token2bucket_id(token, bucket_num):
+    """ The hash bucket of `token` (as indexes_creator.ipynb buckets them). """
+    return int(hashlib.blake2b(bytes(token, encoding='utf8'), digest_size=5).hexdigest(), 16) % bucket_num
+
+
+def doc_text_pairs(wiki_corpus, index_on):
+    """ The (doc_id, text) pairs of the `index_on` field ("title", "text" or
+        "anchor") of the corpus DataFrame; for "anchor", one pair per link,
+        with the id of the linked document.
+    """
+    if index_on == 'anchor':
+        return wiki_corpus.select('anchor_text').rdd.flatMap(lambda row: row['anchor_text'])
+    return wiki_corpus.select('id', index_on).rdd.map(tuple)
+
+
+def _add_counts(counts, other):
+    counts.update(other)
+    return counts
+
+
+def doc_records(pairs, combine=False):
+    """ The (doc_id, dl, [(term, tf), ...]) record of every document of the
+        (doc_id, text) `pairs`. With `combine`, several pairs of the same
+        document are merged into one record, their term counts combined on
+        the map side before the shuffle.
+    """
+    counts = pairs.mapValues(lambda text: Counter(tokenize(text)))
+    if combine:
+        counts = counts.combineByKey(lambda c: c, _add_counts, _add_counts)
+    return counts.map(lambda x: (x[0], sum(x[1].values()), list(x[1].items())))
+
+
+def doc_norm(record, df, n_docs):
+    """ The tf-idf norm of a document record (doc_norm of indexes_creator.ipynb),
+        over the terms in `df`.
+    """
+    doc_id, dl, term_counts = record
+    norm = 0.0
+    for term, cnt in term_counts:
+        if term in df:
+            norm += (cnt / dl * np.log(n_docs / df[term])) ** 2
+    return doc_id, float(np.sqrt(norm))
+
+
+def write_bucket(bucket_id, keys, name, bucket_name, out_dir, prefix, filter_size, order, fmt,
+                 impact_kwargs, bm25_bounds, kept_terms=None):
+    """ Write the postings of one hash bucket from its (term, -tf, doc_id)
+        keys, sorted: every term's keys are consecutive and in decreasing tf
+        order (the order of reduce_word_counts). Terms in no more than
+        `filter_size` documents are left out, or with `kept_terms` (the
+        corpus-wide filter of a shard's bucket) the terms not in it. Yields
+        (posting_locs, posting_bytes, block_max, df, term_total) once, for a
+        non-empty bucket.
+    """
+    df, term_total = {}, {}
+
+    def posting_lists():
+        for term, group in groupby(keys, key=lambda k: k[0]):
+            pl = [(doc_id, -neg_tf) for _, neg_tf, doc_id in group]
+            if len(pl) <= filter_size if kept_terms is None else term not in kept_terms:
+                continue
+            df[term] = len(pl)
+            term_total[term] = sum(tf for _, tf in pl)
+            yield term, pl
+
+    lists = posting_lists()
+    first = next(lists, None)
+    if first is None:
+        return
+    base_dir = Path(out_dir) / name
+    base_dir.mkdir(parents=True, exist_ok=True)
+    posting_locs, posting_bytes, block_max = InvertedIndex.write_posting_lists(
+        bucket_id, _chain(first, lists), bucket_name, base_dir, order=order, fmt=fmt,
+        bm25_bounds=bm25_bounds, prefix='/'.join(p for p in (prefix, name) if p), **impact_kwargs)
+    yield dict(posting_locs), posting_bytes, block_max, df, term_total
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
+
+
+class StageTimer:
+    """ The wall time and the Spark metrics of every stage of a build. The
+        jobs started inside `stage(name)` run under their own job group, and
+        the metrics of their Spark stages are summed from the UI's REST API.
+    """
+    def __init__(self, sc, build):
+        self.sc = sc
+        self.build = build
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        group = f'{self.build}:{name}'
+        self.sc.setJobGroup(group, f'{self.build} {name}')
+        t_start = perf_counter()
+        try:
+            yield
+        finally:
+            stats = {'seconds': perf_counter() - t_start}
+            stats.update(self._spark_metrics(group))
+            self.stages[name] = stats
+
+    def _spark_metrics(self, group):
+        tracker = self.sc.statusTracker()
+        stage_ids = []
+        for job_id in tracker.getJobIdsForGroup(group):
+            job = tracker.getJobInfo(job_id)
+            if job is not None:
+                stage_ids.extend(job.stageIds)
+        totals = dict.fromkeys(SPARK_METRICS, 0)
+        totals['spark_stages'] = len(stage_ids)
+        url = self.sc.uiWebUrl
+        if not url:
+            return totals
+        for stage_id in stage_ids:
+            try:
+                with urllib.request.urlopen(
+                        f'{url}/api/v1/applications/{self.sc.applicationId}/stages/{stage_id}', timeout=10) as res:
+                    attempts = json.load(res)
+            except OSError:
+                # skipped stages (their shuffle output was reused) have no attempts
+                continue
+            for attempt in attempts:
+                for metric in SPARK_METRICS:
+                    totals[metric] += attempt.get(metric, 0)
+        return totals
+
+
+def build_index(sc, pairs, name, bucket_name, bucket_num, filter_size, corpus_size=None, combine=False,
+                order=None, prior=None, fmt=FORMAT_RAW, bm25_bounds=False, k1=1.5, b=0.75,
+                prefix='', out_dir=None, shards=1):
+    """ Build the `name` index (e.g. "body_idx") of the (doc_id, text) RDD
+        `pairs` (see `doc_text_pairs`; `combine=True` when a document can
+        have several, as for anchors), with the parameters of create_index:
+        `bucket_num` hash buckets, terms in more than `filter_size`
+        documents, the posting `order` (with the `prior` dict for
+        ORDER_PRIOR), posting format `fmt` and, with `bm25_bounds`, the BM25
+        block maxima for (k1, b). `corpus_size` is the N of the norms (the
+        number of indexed documents when None).
+        With `shards` > 1 the documents are partitioned by `shard_of` into
+        that many indexes, shard i written under shard_i/ of `out_dir` (and
+        of `prefix` in the bucket). They keep the terms of the whole corpus'
+        df and carry its statistics (see `set_global_stats`), which their
+        norms, BM25 order and bounds use.
+        Returns the index (the list of shard indexes with `shards` > 1) and
+        the per-stage statistics of the build.
+    """
+    out_dir = Path(out_dir or tempfile.mkdtemp(prefix=f'{name}_'))
+    timer = StageTimer(sc, name)
+    t_start = perf_counter()
+    records = doc_records(pairs, combine).persist()
+    broadcasts = []
+    try:
+        with timer.stage('doc_stats'):
+            dl = records.map(lambda r: (r[0], r[1])).collectAsMap()
+        avgdl = sum(dl.values()) / len(dl) if dl else 0.0
+        n_docs = corpus_size or len(dl)
+
+        impact_kwargs = {}
+        if order == ORDER_BM25:
+            impact_kwargs = {'dl': dl, 'avgdl': avgdl}
+        elif order == ORDER_PRIOR:
+            impact_kwargs = {'prior': prior}
+        impact_b = sc.broadcast(impact_kwargs)
+        bounds_b = sc.broadcast({'dl': dl, 'avgdl': avgdl, 'k1': k1, 'b': b} if bm25_bounds else None)
+        broadcasts += [impact_b, bounds_b]
+
+        global_df, kept_b = None, None
+        if shards > 1:
+            # a shard's bucket holds part of every posting list: `filter_size`
+            # applies to the df over all the shards
+            with timer.stage('df'):
+                global_df = records.flatMap(lambda r: ((term, 1) for term, _ in r[2])).reduceByKey(add) \
+                    .filter(lambda x: x[1] > filter_size).collectAsMap()
+            kept_b = sc.broadcast(set(global_df))
+            broadcasts.append(kept_b)
+        dirs = shard_dirs(out_dir, shards)
+        local_dirs = [str(d) for d in dirs]
+        prefixes = [prefix] if shards == 1 else ['/'.join(p for p in (prefix, d.name) if p) for d in dirs]
+
+        def write(partition, keys):
+            shard, bucket_id = divmod(partition, bucket_num)
+            for written in write_bucket(bucket_id, (k for k, _ in keys), name, bucket_name, local_dirs[shard],
+                                        prefixes[shard], filter_size, order, fmt, impact_b.value, bounds_b.value,
+                                        None if kept_b is None else kept_b.value):
+                yield (shard, *written)
+
+        with timer.stage('postings'):
+            # partition shard * bucket_num + bucket holds the bucket of a shard
+            buckets = records.flatMap(lambda r: (((term, -tf, r[0]), None) for term, tf in r[2])) \
+                .repartitionAndSortWithinPartitions(
+                    shards * bucket_num,
+                    lambda k: shard_of(k[2], shards) * bucket_num + token2bucket_id(k[0], bucket_num)) \
+                .mapPartitionsWithIndex(write).collect()
+
+        indexes = []
+        for _ in range(shards):
+            ii = InvertedIndex()
+            ii.posting_locs = defaultdict(list)
+            ii.posting_bytes, ii.bm25_block_max = {}, {}
+            indexes.append(ii)
+        for shard, posting_locs, posting_bytes, block_max, df, term_total in buckets:
+            ii = indexes[shard]
+            ii.posting_locs.update(posting_locs)
+            if fmt != FORMAT_RAW:
+                ii.posting_bytes.update(posting_bytes)
+            ii.bm25_block_max.update(block_max)
+            ii.df.update(df)
+            ii.term_total.update(term_total)
+
+        with timer.stage('norms'):
+            df_b = sc.broadcast(dict(indexes[0].df) if global_df is None else global_df)
+            broadcasts.append(df_b)
+            d_norms = records.map(lambda r: doc_norm(r, df_b.value, n_docs)).collectAsMap()
+    finally:
+        records.unpersist()
+        for broadcast in broadcasts:
+            broadcast.destroy()
+
+    for i, ii in enumerate(indexes):
+        ii.posting_order = order
+        ii.posting_format = fmt
+        if bm25_bounds:
+            ii.bm25_bounds_params = (k1, b, 128)
+        if shards == 1:
+            ii.dl, ii.d_norms = dl, d_norms
+        else:
+            ii.dl = {doc_id: n for doc_id, n in dl.items() if shard_of(doc_id, shards) == i}
+            ii.d_norms = {doc_id: norm for doc_id, norm in d_norms.items() if shard_of(doc_id, shards) == i}
+        ii.corpus_size = n_docs
+    if shards > 1:
+        set_global_stats(indexes)
+
+    with timer.stage('index'):
+        for ii, d, shard_prefix in zip(indexes, dirs, prefixes):
+            write_index(ii, name, bucket_name, shard_prefix, d)
+    stats = {'index': name, 'seconds': perf_counter() - t_start, 'docs': len(dl), 'shards': shards,
+             'terms': len(indexes[0].df) if global_df is None else len(global_df),
+             'postings': sum(sum(ii.df.values()) for ii in indexes), 'stages': timer.stages}
+    return (indexes[0] if shards == 1 else indexes), stats
+
+
+def write_index(ii, name, bucket_name, prefix, out_dir):
+    """ Write index_`name`.pkl and its mapped directory to `out_dir` and,
+        unless `bucket_name` is None, upload them under `prefix` of the bucket.
+    """
+    ii.write_index(out_dir, f'index_{name}')
+    if bucket_name is None:
+        return
+    bucket = storage.Client().bucket(bucket_name)
+    root = Path(out_dir)
+    paths = [root / f'index_{name}.pkl'] + sorted(p for p in (root / f'index_{name}').rglob('*') if p.is_file())
+    for path in paths:
+        rel = path.relative_to(root).as_posix()
+        bucket.blob('/'.join(p for p in (prefix, rel) if p)).upload_from_filename(str(path))
+
+
+# the indexes of indexes_creator.ipynb: name -> (field, bucket_num, filter_size)
+INDEXES = {
+    'title_idx': ('title', 124, 0),
+    'body_idx': ('text', 248, 50),
+    'anchor_idx': ('anchor', 248, 20),
+}
+
+
+def main():
+    from pyspark.sql import SparkSession
+    parser = argparse.ArgumentParser(description='Build the inverted indexes of a Wikipedia dump with Spark.')
+    parser.add_argument('--parquet', nargs='+', required=True, help='the gs:// paths of the dump files')
+    parser.add_argument('--bucket', help='the bucket to write to (local files only when not given)')
+    parser.add_argument('--prefix', default='', help='path prefix inside the bucket')
+    parser.add_argument('--out-dir', help='local directory of the index files')
+    parser.add_argument('--indexes', nargs='+', choices=sorted(INDEXES), default=sorted(INDEXES))
+    parser.add_argument('--fmt', type=int, default=FORMAT_RAW)
+    parser.add_argument('--order', choices=('tf', 'bm25', 'prior'))
+    parser.add_argument('--prior', help='pickle of the doc_id -> prior dict (e.g. page_rank.pkl), for --order prior')
+    parser.add_argument('--bm25-bounds', action='store_true')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='partition the documents into this many indexes, under shard_<i>/ (see coordinator.py)')
+    parser.add_argument('--json', help='also write the build statistics to this file')
+    args = parser.parse_args()
+
+    spark = SparkSession.builder.appName('ir-index-build').getOrCreate()
+    sc = spark.sparkContext
+    add_py_files(sc, Path(__file__).resolve().parent)
+    prior = None
+    if args.prior:
+        with open(args.prior, 'rb') as f:
+            prior = pickle.load(f)
+    wiki_corpus = spark.read.parquet(*args.parquet)
+    corpus_size = wiki_corpus.count()
+    all_stats = []
+    for name in args.indexes:
+        field, bucket_num, filter_size = INDEXES[name]
+        _, stats = build_index(sc, doc_text_pairs(wiki_corpus, field), name, args.bucket, bucket_num, filter_size,
+                               corpus_size=corpus_size, combine=field == 'anchor', order=args.order,
+                               prior=prior, fmt=args.fmt, bm25_bounds=args.bm25_bounds, prefix=args.prefix,
+                               out_dir=Path(args.out_dir) / name if args.out_dir else None, shards=args.shards)
+        all_stats.append(stats)
+        print(f"{name}: {stats['docs']} docs, {stats['terms']} terms in {stats['seconds']:.1f}s")
+        for stage, s in stats['stages'].items():
+            print(f"  {stage:<10} {s['seconds']:>8.1f}s  shuffle write {s['shuffleWriteBytes'] / 2 ** 20:>9.1f} MB"
+                  f"  shuffle read {s['shuffleReadBytes'] / 2 ** 20:>9.1f} MB"
+                  f"  spilled {s['diskBytesSpilled'] / 2 ** 20:>9.1f} MB")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(all_stats, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+""" Block-Max WAND (BM25_from_index.search_top_k) against exhaustive BM25, and
+    the BM25 block maxima it prunes with.
+"""
+import math
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from backend import BM25_from_index, tokenize
+from inverted_index_gcp import (InvertedIndex, ORDER_BM25, ORDER_TF, SCORE_BLOCK_SIZE, bm25_block_maxima,
+                                posting_impacts, sort_posting_list)
+
+K1, B = 1.5, 0.75
+
+
+def generated_index(n_docs=3000, n_words=400, seed=0):
+    """ An index of Zipf-distributed words over documents of varied lengths,
+        so that the common terms span many score blocks.
+    """
+    rng = np.random.default_rng(seed)
+    words = [f'w{i}' for i in range(n_words)]
+    p = 1 / np.arange(1, n_words + 1)
+    p /= p.sum()
+    docs = {doc_id: [words[i] for i in rng.choice(n_words, size=rng.integers(3, 300), p=p)]
+            for doc_id in range(1, n_docs + 1)}
+    ii = InvertedIndex(docs)
+    ii.dl = {doc_id: len(tokens) for doc_id, tokens in docs.items()}
+    return ii
+
+
+def postings_of(ii, terms, order=None):
+    """ The full (doc_ids, tfs) arrays of `terms`, as get_postings returns them. """
+    avgdl = sum(ii.dl.values()) / len(ii.dl)
+    postings = {}
+    for term in terms:
+        pl = ii._posting_list.get(term, [])
+        doc_ids = np.array([doc_id for doc_id, _ in pl], dtype=np.uint32)
+        tfs = np.array([tf for _, tf in pl], dtype=np.uint16)
+        if order is not None:
+            doc_ids, tfs = sort_posting_list(doc_ids, tfs, order, dl=ii.dl, avgdl=avgdl)
+        postings[term] = (doc_ids, tfs)
+    return postings
+
+
+def exhaustive_bm25(ii, query):
+    """ The BM25 score of every document matching a query term, from the formula. """
+    n = len(ii.dl)
+    avgdl = sum(ii.dl.values()) / n
+    scores = Counter()
+    for term, qtf in Counter(query).items():
+        if term not in ii.df:
+            continue
+        idf = math.log(1 + (n - ii.df[term] + 0.5) / (ii.df[term] + 0.5))
+        for doc_id, tf in ii._posting_list[term]:
+            norm = K1 * (1 - B + B * ii.dl[doc_id] / avgdl)
+            scores[doc_id] += qtf * idf * tf * (K1 + 1) / (tf + norm)
+    return scores
+
+
+def assert_exact_top_k(result, expected, k):
+    """ `result` is a top k of `expected`: the same scores, and every document
+        above the k-th score in it (documents tied at the k-th score are
+        interchangeable).
+    """
+    ranked = sorted(expected.values(), reverse=True)[:k]
+    assert len(result) == len(ranked)
+    assert list(result.values()) == sorted(result.values(), reverse=True)
+    np.testing.assert_allclose(list(result.values()), ranked, rtol=1e-9)
+    for doc_id, score in result.items():
+        assert score == pytest.approx(expected[doc_id], rel=1e-9)
+    if ranked:
+        kth = ranked[-1]
+        assert {d for d, s in expected.items() if s > kth * (1 + 1e-9)} <= set(result)
+
+
+@pytest.fixture(scope='module')
+def index():
+    return generated_index()
+
+
+@pytest.fixture(scope='module')
+def index_with_bounds():
+    ii = generated_index()
+    avgdl = sum(ii.dl.values()) / len(ii.dl)
+    ii.bm25_block_max = {term: bm25_block_maxima([d for d, _ in pl], [tf for _, tf in pl], ii.dl, avgdl, K1, B)
+                         for term, pl in ii._posting_list.items()}
+    ii.bm25_bounds_params = (K1, B, SCORE_BLOCK_SIZE)
+    return ii
+
+
+QUERIES = [
+    ['w0'],
+    ['w3', 'w40'],
+    ['w1', 'w2', 'w5', 'w90', 'w399'],
+    ['w7', 'w7', 'w150'],
+    ['w60', 'not_a_term'],
+]
+
+
+@pytest.mark.parametrize('query', QUERIES)
+@pytest.mark.parametrize('k', [1, 10, 100])
+@pytest.mark.parametrize('bounds', ['stored', 'computed'])
+def test_wand_equals_exhaustive(request, query, k, bounds):
+    ii = request.getfixturevalue('index_with_bounds' if bounds == 'stored' else 'index')
+    bm25 = BM25_from_index(ii, K1, B)
+    result = bm25.search_top_k(query, postings_of(ii, query), k=k)
+    assert_exact_top_k(result, exhaustive_bm25(ii, query), k)
+
+
+@pytest.mark.parametrize('order', [ORDER_TF, ORDER_BM25])
+def test_wand_impact_ordered_postings(index, order):
+    query = ['w2', 'w11', 'w30']
+    result = BM25_from_index(index, K1, B).search_top_k(query, postings_of(index, query, order), k=20)
+    assert_exact_top_k(result, exhaustive_bm25(index, query), 20)
+
+
+def test_wand_k_above_matches(index):
+    query = ['w398', 'w399']
+    expected = exhaustive_bm25(index, query)
+    result = BM25_from_index(index, K1, B).search_top_k(query, postings_of(index, query), k=len(expected) + 50)
+    assert_exact_top_k(result, expected, len(expected) + 50)
+    assert set(result) == set(expected)
+
+
+def test_wand_prunes(index):
+    query = ['w0', 'w1', 'w250']
+    bm25 = BM25_from_index(index, K1, B)
+    scored = []
+    doc_score = bm25._doc_score
+    bm25._doc_score = lambda doc_id, tf_weights: scored.append(doc_id) or doc_score(doc_id, tf_weights)
+    result = bm25.search_top_k(query, postings_of(index, query), k=10)
+    assert_exact_top_k(result, exhaustive_bm25(index, query), 10)
+    assert len(scored) < len(exhaustive_bm25(index, query))
+
+
+@pytest.mark.parametrize('text', ['', '   ', 'the of and', 'The, OF; and!'])
+def test_wand_empty_and_stopword_queries(index, text):
+    query = tokenize(text)
+    assert query == []
+    assert BM25_from_index(index, K1, B).search_top_k(query, postings_of(index, query), k=10) == {}
+
+
+def test_wand_empty_posting_lists(index):
+    empty = (np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint16))
+    assert BM25_from_index(index, K1, B).search_top_k(['not_a_term'], {'not_a_term': empty}, k=10) == {}
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_block_maxima_bound_every_block(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(1, 2000))
+    doc_ids = rng.choice(10 ** 6, size=n, replace=False).astype(np.uint32)
+    tfs = rng.integers(1, 500, size=n).astype(np.uint16)
+    dl = {int(d): int(rng.integers(1, 5000)) for d in doc_ids}
+    avgdl = float(np.mean(list(dl.values())))
+    maxima = bm25_block_maxima(doc_ids, tfs, dl, avgdl, K1, B)
+    assert maxima.dtype == np.float32
+    assert len(maxima) == -(-n // SCORE_BLOCK_SIZE)
+    # the exact float64 contributions, in the doc id order the blocks follow
+    perm = np.argsort(doc_ids)
+    exact = posting_impacts(doc_ids[perm], tfs[perm], ORDER_BM25, dl=dl, avgdl=avgdl, k1=K1, b=B)
+    for block, bound in enumerate(maxima.tolist()):
+        block_exact = exact[block * SCORE_BLOCK_SIZE:(block + 1) * SCORE_BLOCK_SIZE].max()
+        assert bound >= block_exact
+        assert bound <= block_exact * (1 + 1e-6)
+    # the stored order of the list does not change them
+    by_tf = sort_posting_list(doc_ids, tfs, ORDER_TF)
+    np.testing.assert_array_equal(bm25_block_maxima(*by_tf, dl, avgdl, K1, B), maxima)
+
+
+def test_block_maxima_round_up():
+    # contributions that float32 rounds down: their bound must still cover them
+    impacts = {(tf, length): posting_impacts([1], [tf], ORDER_BM25, dl={1: length}, avgdl=11.0, k1=K1, b=B)[0]
+               for tf in range(1, 20) for length in range(1, 40)}
+    rounded_down = {key: exact for key, exact in impacts.items() if np.float32(exact) < exact}
+    assert rounded_down
+    for (tf, length), exact in rounded_down.items():
+        assert float(bm25_block_maxima([1], [tf], {1: length}, 11.0, K1, B)[0]) >= exact
@@ -0,0 +1,89 @@
+""" Round trips of the posting list formats (encode_postings / decode_postings). """
+import numpy as np
+import pytest
+
+from inverted_index_gcp import (FORMAT_RAW, FORMAT_VBYTE, MAX_VBYTE_TUPLE_SIZE, ORDER_TF, TF_MASK,
+                                decode_postings, encode_postings, sort_posting_list)
+
+FORMATS = (FORMAT_RAW, FORMAT_VBYTE)
+MAX_DOC_ID = 2 ** 32 - 1
+
+
+def round_trip(doc_ids, tfs, fmt):
+    b = encode_postings(doc_ids, tfs, fmt)
+    return decode_postings(b, len(doc_ids), fmt)
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_round_trip_doc_id_order(fmt):
+    rng = np.random.default_rng(0)
+    doc_ids = np.sort(rng.choice(MAX_DOC_ID, size=5000, replace=False)).astype(np.uint32)
+    tfs = rng.integers(1, TF_MASK + 1, size=len(doc_ids)).astype(np.uint16)
+    got_ids, got_tfs = round_trip(doc_ids, tfs, fmt)
+    assert got_ids.dtype == np.uint32 and got_tfs.dtype == np.uint16
+    np.testing.assert_array_equal(got_ids, doc_ids)
+    np.testing.assert_array_equal(got_tfs, tfs)
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_round_trip_impact_order(fmt):
+    # by decreasing tf the doc ids go back and forth: negative zigzag deltas
+    rng = np.random.default_rng(1)
+    doc_ids = rng.choice(10 ** 6, size=2000, replace=False).astype(np.uint32)
+    tfs = np.minimum(rng.zipf(1.5, size=len(doc_ids)), TF_MASK).astype(np.uint16)
+    doc_ids, tfs = sort_posting_list(doc_ids, tfs, ORDER_TF)
+    assert np.any(np.diff(doc_ids.astype(np.int64)) < 0)
+    got_ids, got_tfs = round_trip(doc_ids, tfs, fmt)
+    np.testing.assert_array_equal(got_ids, doc_ids)
+    np.testing.assert_array_equal(got_tfs, tfs)
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_round_trip_extremes(fmt):
+    # the largest positive and negative doc id jumps, doc id 0 and the tf limits
+    doc_ids = [MAX_DOC_ID, 0, MAX_DOC_ID, 1, 0, 3, 2]
+    tfs = [TF_MASK, 0, 1, TF_MASK, 127, 128, 16383]
+    got_ids, got_tfs = round_trip(doc_ids, tfs, fmt)
+    assert got_ids.tolist() == doc_ids
+    assert got_tfs.tolist() == tfs
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_empty_list(fmt):
+    got_ids, got_tfs = round_trip([], [], fmt)
+    assert len(got_ids) == 0 and len(got_tfs) == 0
+
+
+def test_vbyte_largest_tuple():
+    # a 0 -> 2**32-1 jump and back: 33-bit zigzag deltas (5 bytes) with the
+    # largest tf (3 bytes) are the MAX_VBYTE_TUPLE_SIZE bytes read_size assumes
+    first = encode_postings([MAX_DOC_ID], [TF_MASK], FORMAT_VBYTE)
+    assert len(first) == MAX_VBYTE_TUPLE_SIZE
+    both = encode_postings([MAX_DOC_ID, 0], [TF_MASK, TF_MASK], FORMAT_VBYTE)
+    assert len(both) == 2 * MAX_VBYTE_TUPLE_SIZE
+    rng = np.random.default_rng(2)
+    doc_ids = rng.integers(0, MAX_DOC_ID, size=1000, endpoint=True)
+    tfs = rng.integers(0, TF_MASK, size=len(doc_ids), endpoint=True)
+    assert len(encode_postings(doc_ids, tfs, FORMAT_VBYTE)) <= len(doc_ids) * MAX_VBYTE_TUPLE_SIZE
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_decode_prefix(fmt):
+    # get_pl decodes the first `th` postings of a longer read
+    doc_ids, tfs = [7, 3, 900000, 12], [5, 4, 3, 1]
+    b = encode_postings(doc_ids, tfs, fmt)
+    got_ids, got_tfs = decode_postings(b, 2, fmt)
+    assert got_ids.tolist() == [7, 3] and got_tfs.tolist() == [5, 4]
+
+
+def test_vbyte_truncated():
+    b = encode_postings([1, 2, 3], [1, 1, 1], FORMAT_VBYTE)
+    with pytest.raises(ValueError):
+        decode_postings(b[:-1], 3, FORMAT_VBYTE)
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        encode_postings([1], [1], 7)
+    with pytest.raises(ValueError):
+        decode_postings(b'', 0, 7)
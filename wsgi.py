@@ -0,0 +1,2 @@
+""" WSGI entry point: `gunicorn -c gunicorn.conf.py wsgi:app`. """
+from search_frontend import app